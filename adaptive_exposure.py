@@ -0,0 +1,128 @@
+'''
+Adaptive dark exposure for the timelapse loops.
+
+Instead of a fixed dark exposure chosen for the weakest expected signal, pick
+each dark frame's exposure time and ISO from the previous dark frame: bright
+reporters then get short exposures instead of saturating, and the interval can
+be sized for the exposures actually needed.
+
+The signal level of a frame is a high percentile of its brightest channel,
+read from a histogram of a reduced-resolution decode (PIL draft mode, 1/8
+scale), which takes a few tens of milliseconds on the Pi. Assuming the level
+scales with exposure time x ISO, the controller works out the sensitivity that
+would put the level at target_level, then picks the shortest allowed exposure
+that reaches it at some ISO up to the highest allowed, at the lowest such ISO.
+A saturated frame steps the sensitivity down by SATURATED_STEP, since its level
+says nothing about how far over it was.
+
+Every frame's exposure and ISO are in its file name already (see
+frame_names), so downstream values can be normalized to counts per second at
+ISO 100 (frame_names.exposureScale).
+
+'''
+
+import os
+import threading
+
+from frame_names import parseFrameName
+
+# frames under this exposure are named (and treated) as light frames
+DARK_MIN_EXPOSURE = 5 # in seconds
+
+SATURATION_LEVEL = 254
+SATURATED_STEP = 4.0 # sensitivity divisor after a saturated frame
+
+def frameLevel(path, percentile=99.5, black_level=0.0):
+    '''Signal level of a frame: the given percentile of its brightest
+    channel, from a reduced-resolution decode, minus black_level.'''
+    from PIL import Image # only here, so cycle_planner can use DARK_MIN_EXPOSURE without PIL
+    with Image.open(path) as source:
+        source.draft('RGB', (source.width // 8, source.height // 8))
+        histogram = source.convert('RGB').histogram()
+    level = 0
+    for channel in range(3):
+        counts = histogram[channel * 256:(channel + 1) * 256]
+        threshold = sum(counts) * percentile / 100.0
+        running = 0
+        for value, count in enumerate(counts):
+            running += count
+            if running >= threshold:
+                level = max(level, value)
+                break
+    return max(0.0, level - black_level)
+
+def numericIsos(iso_values, max_iso=None):
+    '''The fixed (non-Auto) ISO values, as ints, ascending, up to max_iso.'''
+    isos = sorted(int(x) for x in iso_values if str(x).isdigit())
+    return [x for x in isos if max_iso is None or x <= max_iso]
+
+class AdaptiveExposure(object):
+    '''Choose dark exposure time and ISO from the previous dark frame.
+
+    exposures -- allowed exposure times in seconds (all >= DARK_MIN_EXPOSURE)
+    isos -- allowed fixed ISO values
+    target_level -- 8-bit level to aim the brightest signal at
+
+    next() returns the (exposure_time, iso) to use for the next dark frame.
+    Frames are fed back through submit(image_path), the frame-consumer
+    interface of singleCapture and CapturePipeline; light frames are ignored.
+    Until the first dark frame has been seen, the longest exposure at the
+    lowest ISO is used, i.e. the conservative fixed setting.
+    '''
+
+    def __init__(self, logger, exposures, isos, target_level=180, percentile=99.5, black_level=0.0):
+        exposures = sorted(float(x) for x in exposures)
+        isos = numericIsos(isos)
+        if len(exposures) == 0 or exposures[0] < DARK_MIN_EXPOSURE:
+            raise ValueError('adaptive dark exposures must be at least ' + str(DARK_MIN_EXPOSURE) + ' s, got ' + str(exposures))
+        if len(isos) == 0:
+            raise ValueError('adaptive exposure needs at least one fixed ISO value')
+        self.logger = logger
+        self.exposures = exposures
+        self.isos = isos
+        self.target_level = float(target_level)
+        self.percentile = percentile
+        self.black_level = black_level
+        self.current = (exposures[-1], isos[0])
+        self.history = [] # (file name, exposure, iso, level)
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            exposure, iso = self.current
+        return _formatExposure(exposure), str(iso)
+
+    def submit(self, image_path):
+        info = parseFrameName(image_path)
+        if info is None or not info['tag'] == 'dark' or not info['iso'].isdigit():
+            return
+        try:
+            level = frameLevel(image_path, self.percentile, self.black_level)
+        except (IOError, OSError) as e:
+            self.logger.debug('WARNING: adaptive exposure could not read ' + os.path.basename(image_path) + ': ' + str(e))
+            return
+        with self.lock:
+            self.history.append((os.path.basename(image_path), info['exposure'], int(info['iso']), level))
+            self.current = self.choose(info['exposure'] * int(info['iso']), level)
+            exposure, iso = self.current
+        self.logger.debug('\tAdaptive exposure: level ' + str(level) + ' at ' + ('%g' % info['exposure']) + 's/ISO ' + info['iso'] +
+                          ' -> next dark frame ' + ('%g' % exposure) + 's/ISO ' + str(iso))
+
+    def choose(self, sensitivity, level):
+        '''Pick (exposure, iso) for the next frame, given the previous frame's
+        sensitivity (exposure x ISO) and level.'''
+        if level >= SATURATION_LEVEL:
+            wanted = sensitivity / SATURATED_STEP
+        elif level <= 0:
+            return self.exposures[-1], self.isos[-1]
+        else:
+            wanted = sensitivity * self.target_level / level
+        for exposure in self.exposures:
+            for iso in self.isos:
+                if exposure * iso >= wanted:
+                    return exposure, iso
+        return self.exposures[-1], self.isos[-1]
+
+def _formatExposure(exposure):
+    # keep file names as the fixed setting would write them, e.g. 480 not 480.0
+    return int(exposure) if float(exposure).is_integer() else exposure
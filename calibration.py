@@ -0,0 +1,151 @@
+'''
+Master dark frames for dark-current and bias subtraction.
+
+A master dark is the per-pixel median (or sigma-clipped mean) of a stack of
+frames taken with the lens capped, at the same exposure time and ISO as the
+frames it corrects. One is built per exposure/ISO combination found in a folder
+of calibration frames, named by the singleCapture convention (see
+frame_names.parseFrameName), and saved as float32 .npy in a calibration
+folder:
+
+    master_dark_exp480s_isoAuto.npy
+
+Stacking is streamed, so memory stays bounded however many frames there are:
+each frame is decoded once into a memory-mapped stack on disk, and the stack is
+then reduced a band of rows at a time, with the band height chosen so a band of
+the whole stack fits in max_memory bytes.
+
+Masters are loaded memory-mapped, so worker processes share them through the
+page cache instead of each holding a copy.
+
+'''
+
+import os
+import sys
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from frame_names import parseFrameName
+
+MASTER_DARK_PREFIX = 'master_dark_'
+
+# default memory budget for one band of the stack while reducing it
+MAX_STACK_MEMORY = 256e6
+
+def masterDarkName(exposure, iso):
+    '''File name of the master dark for an exposure time (seconds) and ISO.'''
+    return MASTER_DARK_PREFIX + 'exp' + ('%g' % float(exposure)) + 's_iso' + str(iso) + '.npy'
+
+def groupCalibrationFrames(dark_dir):
+    '''Group the calibration frames in a folder by (exposure, iso). Returns
+    {(exposure, iso): [file names]}.'''
+    groups = {}
+    for x in sorted(os.listdir(dark_dir)):
+        info = parseFrameName(x)
+        if info is None:
+            continue
+        groups.setdefault((info['exposure'], info['iso']), []).append(x)
+    return groups
+
+def loadStack(paths, stack_path):
+    '''Decode frames once each into a uint8 memory-mapped (n, height, width,
+    channels) stack at stack_path.'''
+    stack = None
+    for i, path in enumerate(paths):
+        with Image.open(path) as source:
+            image = np.asarray(source.convert('RGB'))
+        if stack is None:
+            stack = np.lib.format.open_memmap(stack_path, mode='w+', dtype=np.uint8, shape=(len(paths),) + image.shape)
+        elif not image.shape == stack.shape[1:]:
+            raise ValueError(path + ' is ' + str(image.shape) + ', expected ' + str(stack.shape[1:]))
+        stack[i] = image
+    stack.flush()
+    return stack
+
+def sigmaClippedMean(band, sigma=3.0, iterations=3):
+    '''Mean along axis 0, iteratively ignoring values more than sigma
+    standard deviations from the median of the values kept so far. The
+    deviation is estimated from the median absolute deviation, so a single hot
+    frame in a small stack can't hide itself by inflating it.'''
+    band = band.astype(np.float32)
+    for _ in range(iterations):
+        center = np.nanmedian(band, axis=0)
+        spread = 1.4826 * np.nanmedian(np.abs(band - center), axis=0)
+        rejected = np.abs(band - center) > sigma * spread + 0.5 # 0.5: quantization of 8-bit data
+        if not rejected.any():
+            break
+        band[rejected] = np.nan
+    return np.nanmean(band, axis=0)
+
+def reduceStack(stack, output_path, method='median', max_memory=MAX_STACK_MEMORY):
+    '''Combine a (n, height, ...) stack along n into a float32 .npy at
+    output_path, one band of rows at a time.'''
+    n, height = stack.shape[0], stack.shape[1]
+    # working memory per stack value: a uint8 copy for the median, the float32
+    # band plus masks and temporaries for sigma clipping
+    bytes_per_value = 16 if method == 'sigma_clip' else 2
+    row_bytes = stack[0, 0].size * n * bytes_per_value
+    band_rows = max(1, min(height, int(max_memory // row_bytes)))
+    master = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32, shape=stack.shape[1:])
+    for row_start in range(0, height, band_rows):
+        band = stack[:, row_start:row_start + band_rows]
+        if method == 'median':
+            master[row_start:row_start + band_rows] = np.median(band, axis=0)
+        elif method == 'sigma_clip':
+            master[row_start:row_start + band_rows] = sigmaClippedMean(band)
+        else:
+            raise ValueError('method must be "median" or "sigma_clip", not "' + str(method) + '"')
+    master.flush()
+    return output_path
+
+def buildMasterDarks(dark_dir, calibration_dir, method='median', max_memory=MAX_STACK_MEMORY, temp_dir=None):
+    '''Build a master dark for every exposure/ISO combination of the
+    calibration frames in dark_dir, into calibration_dir. The temporary stack
+    goes in temp_dir (default: the system temp folder), which needs room for one
+    group's frames uncompressed. Returns {(exposure, iso): master path}.'''
+    os.makedirs(calibration_dir, exist_ok=True)
+    masters = {}
+    for (exposure, iso), names in sorted(groupCalibrationFrames(dark_dir).items()):
+        print('Stacking ' + str(len(names)) + ' calibration frames at ' + ('%g' % exposure) + ' s, ISO ' + iso)
+        with tempfile.TemporaryDirectory(dir=temp_dir) as stack_dir:
+            stack = loadStack([os.path.join(dark_dir, x) for x in names], os.path.join(stack_dir, 'stack.npy'))
+            master_path = os.path.join(calibration_dir, masterDarkName(exposure, iso))
+            reduceStack(stack, master_path, method, max_memory)
+            del stack
+        masters[(exposure, iso)] = master_path
+    return masters
+
+def findMasterDark(calibration_dir, file_name):
+    '''Path of the master dark matching a frame's exposure and ISO (parsed from
+    its name), or None if there isn't one.'''
+    info = parseFrameName(file_name)
+    if calibration_dir is None or info is None:
+        return None
+    path = os.path.join(calibration_dir, masterDarkName(info['exposure'], info['iso']))
+    return path if os.path.exists(path) else None
+
+def loadMasterDark(path):
+    return np.load(path, mmap_mode='r')
+
+def subtractDark(image, master):
+    '''Dark-subtracted copy of a frame, as float32 (negative values kept, so
+    means over ROIs stay unbiased).'''
+    return image.astype(np.float32) - master
+
+def calibrateFrame(image, calibration_dir, file_name):
+    '''Subtract the matching master dark from a uint8 frame, clipping to
+    0..255, for the processing steps that work on 8-bit images. Frames without
+    a matching master are returned unchanged.'''
+    path = findMasterDark(calibration_dir, file_name)
+    if path is None:
+        return image
+    return np.clip(np.rint(subtractDark(image, loadMasterDark(path))), 0, 255).astype(np.uint8)
+
+if __name__ == "__main__":
+
+    # usage: python calibration.py <calibration frame dir> <calibration dir> [median|sigma_clip]
+    method = sys.argv[3] if len(sys.argv) > 3 else 'median'
+    for (exposure, iso), path in buildMasterDarks(sys.argv[1], sys.argv[2], method).items():
+        print(path)
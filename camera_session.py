@@ -0,0 +1,535 @@
+'''
+Persistent camera connection for gphoto_capture_control, built on the
+libgphoto2 Python binding (pip package 'gphoto2').
+
+Every command in the original wrapper spawned its own gphoto2 process, and each
+of those had to claim the USB interface, negotiate PTP and release it again. A
+CameraSession opens the camera once and keeps the connection for config reads
+and writes, bulb release and download.
+
+'''
+
+import contextlib
+import os
+import threading
+import time
+
+from capture_metrics import getMetrics
+
+try:
+    import gphoto2 as gp
+    CameraError = gp.GPhoto2Error
+except ImportError:
+    # off the Pi: only the simulator backend (capture_backends.SimulatedCameraSession) is usable
+    gp = None
+    class CameraError(Exception):
+        pass
+
+# eosremoterelease choice indices on the 80D (same ones the CLI capture used)
+EOS_REMOTE_RELEASE_IMMEDIATE = 5
+EOS_REMOTE_RELEASE_FULL = 4
+
+# Download timeout model: fixed allowance for the camera to write the file and
+# report it, plus the expected file size at a conservative USB transfer rate.
+# Until a file of the same kind has been seen, DEFAULT_FILE_SIZE is assumed.
+DOWNLOAD_TIMEOUT_BASE = 5.0 # in seconds
+DOWNLOAD_MIN_RATE = 2.0e6 # in bytes per second
+DEFAULT_FILE_SIZE = 30.0e6 # in bytes
+
+# Background downloads (see capture_pipeline) read a file in chunks of this
+# size, each one short enough to fit between the capture loop's own commands.
+TRANSFER_CHUNK_SIZE = 1 << 20 # in bytes
+# margin on the measured transfer rate when deciding whether a chunk fits in
+# what is left of an open exposure
+TRANSFER_SAFETY_FACTOR = 2.0
+
+def downloadTimeout(expected_size):
+    '''Return the longest we should wait (in seconds) for a file of
+    expected_size bytes to be reported and transferred.'''
+    return DOWNLOAD_TIMEOUT_BASE + 2 * expected_size / DOWNLOAD_MIN_RATE
+
+def verifyDownload(filename, expected_size=None):
+    '''Return True iff filename exists and, if expected_size is given, has
+    exactly that many bytes. One stat call, no directory scan.'''
+    try:
+        size = os.stat(filename).st_size
+    except OSError:
+        return False
+    if expected_size is None:
+        return size > 0
+    return size == expected_size
+
+class SessionLock(object):
+    '''Reentrant lock on a camera connection, for three kinds of user. When
+    several wait for it, they are served in this order:
+
+        with lock: ...          -- commands: config reads and writes, the
+                                   release, file info
+        with lock.background(): -- one chunk of a background download
+        with lock.idle(): ...   -- event polling while the capture loop waits
+                                   on an open shutter or for a new file
+
+    so a background download fills the time the capture loop spends waiting,
+    without delaying its commands. Usable with threading.Condition.
+    '''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._state = threading.Condition(threading.Lock())
+        self._waiting = 0 # commands waiting for the lock
+        self._background_waiting = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        with self._state:
+            self._waiting += 1
+        try:
+            return self._lock.acquire(blocking, timeout)
+        finally:
+            with self._state:
+                self._waiting -= 1
+                self._state.notify_all()
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+    # for threading.Condition
+    def _is_owned(self):
+        return self._lock._is_owned()
+
+    def _release_save(self):
+        return self._lock._release_save()
+
+    def _acquire_restore(self, state):
+        self._lock._acquire_restore(state)
+
+    def _acquireAfter(self, ready):
+        # take the lock once ready() holds; a thread that already owns it
+        # just re-enters, as waiting on others could then deadlock
+        if not self._lock._is_owned():
+            with self._state:
+                while not ready():
+                    self._state.wait()
+        self._lock.acquire()
+
+    @contextlib.contextmanager
+    def background(self):
+        '''Hold the lock once no command is waiting for it.'''
+        with self._state:
+            self._background_waiting += 1
+        try:
+            self._acquireAfter(lambda: self._waiting == 0)
+        finally:
+            with self._state:
+                self._background_waiting -= 1
+                self._state.notify_all()
+        try:
+            yield
+        finally:
+            self._lock.release()
+
+    @contextlib.contextmanager
+    def idle(self):
+        '''Hold the lock once neither a command nor a background chunk is
+        waiting for it.'''
+        self._acquireAfter(lambda: self._waiting == 0 and self._background_waiting == 0)
+        try:
+            yield
+        finally:
+            self._lock.release()
+
+class CameraSession(object):
+    '''Long-lived connection to a single camera.
+
+    Use as a context manager, or call open()/close() explicitly. Nothing else
+    may talk to the camera while the session is open (including the gphoto2
+    command line tool), since the USB interface is claimed for the lifetime of
+    the session.
+
+    libgphoto2 is not thread safe, so every call into the camera goes through
+    self.lock (a SessionLock). That lets a background download (see
+    capture_pipeline) share the connection with the capture loop: it reads
+    the file in chunks (downloadFileInChunks), which go in whenever the loop is
+    only polling for events, i.e. while a shutter is open or the camera is
+    writing a new file.
+
+    port -- libgphoto2 port path (e.g. 'usb:001,005') of the camera to use when
+    several are attached; by default the first camera found is used.
+    model -- camera model name as reported by autodetect, used together with
+    port to skip model detection
+    '''
+
+    # longest single wait_for_event call during an exposure, so that other
+    # threads get a turn at the connection while the shutter is open
+    EVENT_POLL_SLICE = 0.1 # in seconds
+
+    def __init__(self, logger, port=None, model=None):
+        self.logger = logger
+        self.port = port
+        self.model = model
+        self.camera = None
+        self.file_sizes = {} # size_key -> size of the last file of that kind
+        self.lock = SessionLock()
+        self.exposure_changed = threading.Condition(self.lock)
+        self.exposure_end = None # monotonic time the open shutter is due to close
+        self.measured_transfer_rate = None # bytes per second of the last chunk read
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def open(self):
+        '''Claim the camera. Safe to call on an already open session.'''
+        with self.lock:
+            if self.camera is not None:
+                return
+            self.logger.debug('Opening camera session' + ('' if self.port is None else ' on ' + self.port) + '...')
+            if gp is None:
+                raise CameraError('libgphoto2 binding not installed (pip install gphoto2)')
+            camera = gp.Camera()
+            if self.model is not None:
+                abilities_list = gp.CameraAbilitiesList()
+                abilities_list.load()
+                camera.set_abilities(abilities_list[abilities_list.lookup_model(self.model)])
+            if self.port is not None:
+                port_info_list = gp.PortInfoList()
+                port_info_list.load()
+                camera.set_port_info(port_info_list[port_info_list.lookup_path(self.port)])
+            camera.init()
+            self.camera = camera
+            self.logger.debug('...done')
+
+    def close(self):
+        '''Release the camera.'''
+        with self.lock:
+            if self.camera is None:
+                return
+            try:
+                self.camera.exit()
+            except CameraError as e:
+                self.logger.debug('WARNING: error while closing camera session: ' + str(e))
+            self.camera = None
+            self.logger.debug('Camera session closed')
+
+    def getConfig(self, setting):
+        '''Return current value of a single config setting as a string.'''
+        with self.lock:
+            widget = self.camera.get_single_config(setting)
+            return str(widget.get_value())
+
+    def setConfig(self, setting, value):
+        '''Write a single config setting by value. Return True iff the camera
+        accepted the write (verification is left to the caller).'''
+        try:
+            with self.lock:
+                widget = self.camera.get_single_config(setting)
+                widget.set_value(str(value))
+                self.camera.set_single_config(setting, widget)
+        except CameraError as e:
+            self.logger.debug('Failed to set ' + setting + '=' + str(value) + ': ' + str(e))
+            return False
+        return True
+
+    def getConfigValues(self, settings):
+        '''Return {setting: current value} for several settings from a single
+        read of the camera's config tree.'''
+        with self.lock:
+            config = self.camera.get_config()
+        values = {}
+        for setting in settings:
+            values[setting] = str(config.get_child_by_name(setting).get_value())
+        return values
+
+    def getConfigSnapshot(self):
+        '''Return {setting: value} for every readable setting on the camera,
+        from a single read of the config tree.'''
+        with self.lock:
+            config = self.camera.get_config()
+        snapshot = {}
+        widgets = [config]
+        while len(widgets) > 0:
+            widget = widgets.pop()
+            widget_type = widget.get_type()
+            if widget_type in (gp.GP_WIDGET_WINDOW, gp.GP_WIDGET_SECTION):
+                widgets.extend(widget.get_children())
+            elif not widget_type == gp.GP_WIDGET_BUTTON:
+                try:
+                    snapshot[widget.get_name()] = str(widget.get_value())
+                except CameraError:
+                    pass
+        return snapshot
+
+    def setConfigValues(self, values):
+        '''Write several settings in one transaction: the config tree is read
+        once, every widget is changed locally and the tree is pushed back in a
+        single set_config call. Return True iff the camera accepted the write.'''
+        try:
+            with self.lock:
+                config = self.camera.get_config()
+                for setting, value in values.items():
+                    config.get_child_by_name(setting).set_value(str(value))
+                self.camera.set_config(config)
+        except CameraError as e:
+            self.logger.debug('Failed to set ' + str(values) + ': ' + str(e))
+            return False
+        return True
+
+    def setConfigIndex(self, setting, index):
+        '''Write a single radio/menu config setting by choice index.'''
+        with self.lock:
+            widget = self.camera.get_single_config(setting)
+            widget.set_value(widget.get_choice(index))
+            self.camera.set_single_config(setting, widget)
+
+    def waitForEvents(self, duration):
+        '''Service camera events for duration seconds, discarding them.
+
+        Equivalent of the CLI --wait-event option; keeps the connection busy so
+        the camera doesn't drop into a power-save state mid-exposure. The lock
+        is only held for one EVENT_POLL_SLICE at a time, and yields to
+        background download chunks (see SessionLock.idle).
+        '''
+        deadline = time.monotonic() + duration
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            with self.lock.idle():
+                self.camera.wait_for_event(max(1, int(min(remaining, self.EVENT_POLL_SLICE) * 1000)))
+
+    def waitForFileAdded(self, timeout):
+        '''Wait up to timeout seconds for the camera to report a new file.
+        Return the CameraFilePath of the new file, or None on timeout.
+
+        Returns as soon as the FileAdded event arrives; a CaptureComplete event
+        seen before it is fine, we only need the path. Polls in slices like
+        waitForEvents, so background downloads go on while the camera writes.
+        '''
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            with self.lock.idle():
+                event_type, event_data = self.camera.wait_for_event(max(1, int(min(remaining, self.EVENT_POLL_SLICE) * 1000)))
+            if event_type == gp.GP_EVENT_FILE_ADDED:
+                return event_data
+
+    def downloadFile(self, camera_path, target_filename):
+        '''Copy a file off the camera to target_filename on the local disk.
+        Return the size in bytes the camera reports for the file.'''
+        with self.lock:
+            info = self.camera.file_get_info(camera_path.folder, camera_path.name)
+            camera_file = self.camera.file_get(camera_path.folder, camera_path.name, gp.GP_FILE_TYPE_NORMAL)
+        camera_file.save(target_filename)
+        return info.file.size
+
+    def fileSize(self, camera_path):
+        '''Size in bytes the camera reports for a file.'''
+        with self.lock:
+            info = self.camera.file_get_info(camera_path.folder, camera_path.name)
+        return info.file.size
+
+    def readFileChunk(self, camera_path, offset, buffer):
+        '''Read part of a file, from offset, into buffer (a writable
+        memoryview of the chunk length). Return the number of bytes read.'''
+        with self.lock:
+            return self.camera.file_read(camera_path.folder, camera_path.name, gp.GP_FILE_TYPE_NORMAL, offset, buffer)
+
+    def chunkDuration(self, length):
+        '''Conservative estimate of the time to read length bytes.'''
+        if self.measured_transfer_rate is None:
+            return length / DOWNLOAD_MIN_RATE
+        return TRANSFER_SAFETY_FACTOR * length / self.measured_transfer_rate
+
+    def downloadFileInChunks(self, camera_path, target_filename, chunk_size=TRANSFER_CHUNK_SIZE):
+        '''Copy a file off the camera like downloadFile, but as a series of
+        chunk reads, each in a transferWindow of its own, so the capture loop
+        keeps the connection in between. Return the size in bytes the camera
+        reports for the file.'''
+        size = self.fileSize(camera_path)
+        view = memoryview(bytearray(chunk_size))
+        offset = 0
+        with open(target_filename, 'wb') as f:
+            while offset < size:
+                length = min(chunk_size, size - offset)
+                with self.transferWindow(self.chunkDuration(length)):
+                    started = time.monotonic()
+                    read = self.readFileChunk(camera_path, offset, view[:length])
+                    elapsed = time.monotonic() - started
+                if read <= 0:
+                    raise CameraError('camera returned no data for ' + camera_path.name + ' at byte ' + str(offset))
+                if elapsed > 0:
+                    self.measured_transfer_rate = read / elapsed
+                f.write(view[:read])
+                offset += read
+        return size
+
+    def expectedFileSize(self, size_key):
+        '''Best guess at the size of the next file of the given kind.'''
+        return self.file_sizes.get(size_key, DEFAULT_FILE_SIZE)
+
+    @contextlib.contextmanager
+    def transferWindow(self, expected_duration):
+        '''Hold the connection for a background transfer of expected_duration
+        seconds (see SessionLock.background), first waiting until it can run
+        without delaying the close of an open shutter.'''
+        with self.lock.background():
+            while self.exposure_end is not None and self.exposure_end - time.monotonic() < expected_duration:
+                self.exposure_changed.wait(max(0.05, self.exposure_end - time.monotonic()))
+            yield
+
+    def bulbExpose(self, exposure_time, timeout=None, size_key=None):
+        '''Take a bulb exposure of exposure_time seconds and wait for the camera
+        to report the new file. Return its CameraFilePath, or None on failure.
+
+        timeout caps how long we wait (in seconds) after closing the shutter;
+        by default it is derived from the size of the last file with the same
+        size_key (e.g. light vs. dark frames, whose JPEG sizes differ a lot).
+        '''
+        if timeout is None:
+            timeout = downloadTimeout(self.expectedFileSize(size_key))
+        metrics = getMetrics()
+        try:
+            with self.exposure_changed:
+                with metrics.span('release', action='press'):
+                    self.setConfigIndex('eosremoterelease', EOS_REMOTE_RELEASE_IMMEDIATE)
+                self.exposure_end = time.monotonic() + float(exposure_time)
+                self.exposure_changed.notify_all()
+            with metrics.span('exposure', exposure_time=float(exposure_time)):
+                self.waitForEvents(float(exposure_time))
+            with self.exposure_changed:
+                with metrics.span('release', action='release'):
+                    self.setConfigIndex('eosremoterelease', EOS_REMOTE_RELEASE_FULL)
+                self.exposure_end = None
+                self.exposure_changed.notify_all()
+            with metrics.span('file_wait'):
+                camera_path = self.waitForFileAdded(float(timeout))
+        except CameraError as e:
+            self.logger.debug('WARNING: bulb capture failed: ' + str(e))
+            with self.exposure_changed:
+                self.exposure_end = None
+                self.exposure_changed.notify_all()
+            return None
+        if camera_path is None:
+            self.logger.debug('WARNING: camera reported no new file within ' + str(round(timeout, 1)) + 's')
+        return camera_path
+
+    def fetchFile(self, camera_path, target_filename, size_key=None, chunked=False):
+        '''Download and verify a file reported by bulbExpose. Return True iff
+        the file on disk is complete; a partial file is deleted. With
+        chunked=True the file is read in background chunks (see
+        downloadFileInChunks).'''
+        try:
+            with getMetrics().span('download', file=os.path.basename(target_filename)):
+                if chunked:
+                    size = self.downloadFileInChunks(camera_path, target_filename)
+                else:
+                    size = self.downloadFile(camera_path, target_filename)
+        except CameraError as e:
+            self.logger.debug('WARNING: download of ' + target_filename + ' failed: ' + str(e))
+            self._discard(target_filename)
+            return False
+        if not verifyDownload(target_filename, size):
+            self.logger.debug('WARNING: ' + target_filename + ' is incomplete (expected ' + str(size) + ' bytes)')
+            self._discard(target_filename)
+            return False
+        self.file_sizes[size_key] = size
+        return True
+
+    def _discard(self, target_filename):
+        # so a truncated frame is never mistaken for a captured one
+        try:
+            os.remove(target_filename)
+        except OSError:
+            pass
+
+    def bulbCapture(self, exposure_time, target_filename, timeout=None, size_key=None):
+        '''Take a bulb exposure of exposure_time seconds and download the result
+        to target_filename. Return True iff the file arrived complete.
+
+        Completion is driven by the camera's FileAdded event rather than a fixed
+        wait, and the download is verified by comparing the size on disk with
+        the size the camera reports.
+        '''
+        camera_path = self.bulbExpose(exposure_time, timeout, size_key)
+        if camera_path is None:
+            return False
+        return self.fetchFile(camera_path, target_filename, size_key)
+
+
+class CameraSettings(object):
+    '''Settings-state layer on top of a CameraSession.
+
+    Holds the accepted value tables (loaded once by the caller) and the last
+    camera state that was confirmed by a read-back. apply() only writes the
+    settings that differ from the confirmed state, batches them into one
+    transaction and verifies them with a single read.
+
+    NOTE: the cache assumes nobody touches the camera dials during a run. Any
+    failed write or verification drops the cached state so that the next
+    apply() writes everything again.
+    '''
+
+    def __init__(self, logger, session, accepted_values):
+        '''accepted_values -- {setting: iterable of accepted value strings}'''
+        self.logger = logger
+        self.session = session
+        self.accepted_values = dict((k, set(v)) for k, v in accepted_values.items())
+        self.confirmed = {}
+
+    def invalidate(self):
+        '''Forget the cached camera state.'''
+        self.confirmed = {}
+
+    def seed(self, snapshot):
+        '''Take the confirmed state from a config snapshot read off the camera
+        (see CameraSession.getConfigSnapshot), so the first apply() of a run
+        can already skip settings that don't change.'''
+        for setting in self.accepted_values:
+            if setting in snapshot:
+                self.confirmed[setting] = snapshot[setting]
+
+    def apply(self, values):
+        '''Bring the camera to the given {setting: value} state. Return True iff
+        every setting is verified.'''
+        for setting, value in values.items():
+            if not setting in self.accepted_values:
+                self.logger.debug('WARNING: "' + setting + '" is not a configurable parameter')
+                return False
+            if not value in self.accepted_values[setting]:
+                self.logger.debug('WARNING: "' + str(value) + '" is not an accepted value for the "' + setting + '" parameter')
+                return False
+        changes = dict((k, v) for k, v in values.items() if self.confirmed.get(k) != v)
+        if len(changes) == 0:
+            self.logger.debug('\tSettings unchanged, nothing to write')
+            return True
+        self.logger.debug('\tSetting ' + ', '.join(k + '=' + str(v) for k, v in sorted(changes.items())) + '...')
+        if not self.session.setConfigValues(changes):
+            self.invalidate()
+            return False
+        try:
+            current = self.session.getConfigValues(list(changes))
+        except CameraError as e:
+            self.logger.debug('WARNING: Failed to read back ' + ', '.join(sorted(changes)) + ': ' + str(e))
+            self.invalidate()
+            return False
+        self.confirmed.update(current)
+        for setting, value in changes.items():
+            if not current[setting] == value:
+                self.logger.debug('WARNING: Failed to change ' + setting + ' to ' + str(value) + ', camera reports ' + current[setting])
+                self.invalidate()
+                return False
+        self.logger.debug('\t...verified')
+        return True
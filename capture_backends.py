@@ -0,0 +1,217 @@
+'''
+Pluggable hardware backends for gphoto_capture_control.
+
+The capture loops talk to the camera through a CameraSession and to the lights
+through a relay backend. On the Pi these are the libgphoto2 session
+(camera_session.CameraSession) and GPIORelayBackend. Off the Pi, the simulated
+backends below stand in for them, so the capture logic can be imported, run,
+profiled and benchmarked (see capture_benchmark) without hardware.
+
+The simulator models the costs that matter for cycle overhead: a fixed latency
+per config round trip, the exposure itself, the camera's write time after the
+shutter closes and the USB transfer rate. Every modelled delay is recorded as a
+(phase, start, duration) entry in SimulatedCameraSession.phases.
+
+'''
+
+import threading
+import time
+
+from camera_session import CameraSession, CameraError
+
+class GPIORelayBackend(object):
+    '''Relays on the Pi's GPIO header, addressed by BCM pin number.'''
+
+    def __init__(self):
+        import RPi.GPIO as GPIO # only importable on the Pi
+        self.GPIO = GPIO
+
+    def setup(self, pins):
+        self.GPIO.setwarnings(False) #turn off warnings
+        self.GPIO.cleanup() # reset any previous settings that may have been run
+        self.GPIO.setmode(self.GPIO.BCM) # control pins by BCM number, NOT native Pi number
+        for pin in pins:
+            self.GPIO.setup(pin, self.GPIO.OUT, initial=self.GPIO.LOW) # relay initially off
+
+    def output(self, pin, state):
+        self.GPIO.output(pin, self.GPIO.HIGH if state else self.GPIO.LOW)
+
+class SimulatedRelayBackend(object):
+    '''Relay stand-in that records every switch as (time, pin, state).'''
+
+    def __init__(self, switch_latency=0.01):
+        self.switch_latency = switch_latency # in seconds
+        self.states = {}
+        self.switches = []
+
+    def setup(self, pins):
+        for pin in pins:
+            self.states[pin] = False
+
+    def output(self, pin, state):
+        time.sleep(self.switch_latency)
+        self.states[pin] = state
+        self.switches.append((time.monotonic(), pin, state))
+
+# values the simulated camera accepts, same as the 80D value tables
+SIMULATED_ACCEPTED_VALUES = {
+    'aperture': ['2.8', '3.2', '3.5', '4', '4.5', '5', '5.6', '6.3', '7.1', '8', '9', '10', '11', '13', '14', '16', '18', '20', '22'],
+    'iso': ['Auto', '100', '125', '160', '200', '250', '320', '400', '500', '640', '800', '1000', '1250', '1600', '2000', '2500', '3200', '4000', '5000', '6400', '8000', '10000', '12800', '16000'],
+}
+SIMULATED_RELEASE_CHOICES = ['None', 'Press Half', 'Press Full', 'Release Half', 'Release Full', 'Immediate']
+
+class SimulatedFilePath(object):
+    '''Stand-in for a libgphoto2 CameraFilePath.'''
+
+    def __init__(self, folder, name):
+        self.folder = folder
+        self.name = name
+
+class SimulatedCameraSession(CameraSession):
+    '''In-process camera with the CameraSession interface.
+
+    config_latency -- seconds per config read or write round trip
+    write_latency -- seconds from shutter close until the file is reported
+    transfer_rate -- USB download rate, in bytes per second
+    light_file_size, dark_file_size -- JPEG sizes in bytes; exposures of 5 s
+    or more count as dark, like the naming in singleCapture
+    '''
+
+    def __init__(self, logger, port=None, model=None, config_latency=0.12, write_latency=0.8, transfer_rate=15.0e6,
+                 light_file_size=9.0e6, dark_file_size=22.0e6):
+        CameraSession.__init__(self, logger, port, model)
+        self.config_latency = config_latency
+        self.write_latency = write_latency
+        self.transfer_rate = transfer_rate
+        self.light_file_size = int(light_file_size)
+        self.dark_file_size = int(dark_file_size)
+        self.config = {'cameramodel': 'Canon EOS 80D', 'aperture': '2.8', 'iso': 'Auto', 'shutterspeed': 'bulb', 'eosremoterelease': 'None'}
+        self.files = {} # camera file name -> size
+        self.pending = [] # (ready_at, camera file name) not yet reported
+        self.shutter_opened = None
+        self.phases = []
+        self.phases_lock = threading.Lock()
+
+    def _phase(self, phase, duration):
+        start = time.monotonic()
+        if duration > 0:
+            time.sleep(duration)
+        with self.phases_lock:
+            self.phases.append((phase, start, time.monotonic() - start))
+
+    def open(self):
+        with self.lock:
+            if self.camera is None:
+                self.logger.debug('Opening simulated camera session...')
+                self.camera = self
+
+    def close(self):
+        with self.lock:
+            self.camera = None
+
+    def getConfig(self, setting):
+        with self.lock:
+            self._phase('config_read', self.config_latency)
+            return self.config[setting]
+
+    def setConfig(self, setting, value):
+        return self.setConfigValues({setting: value})
+
+    def getConfigValues(self, settings):
+        with self.lock:
+            self._phase('config_read', self.config_latency)
+            return dict((setting, self.config[setting]) for setting in settings)
+
+    def getConfigSnapshot(self):
+        with self.lock:
+            self._phase('config_read', self.config_latency)
+            return dict(self.config)
+
+    def setConfigValues(self, values):
+        with self.lock:
+            self._phase('config_write', self.config_latency)
+            for setting, value in values.items():
+                accepted = SIMULATED_ACCEPTED_VALUES.get(setting)
+                if accepted is not None and not str(value) in accepted:
+                    self.logger.debug('Failed to set ' + str(values) + ': simulated camera rejects ' + setting + '=' + str(value))
+                    return False
+            for setting, value in values.items():
+                self.config[setting] = str(value)
+            return True
+
+    def setConfigIndex(self, setting, index):
+        with self.lock:
+            self._phase('release', self.config_latency)
+            value = SIMULATED_RELEASE_CHOICES[index] if setting == 'eosremoterelease' else str(index)
+            self.config[setting] = value
+            if setting != 'eosremoterelease':
+                return
+            now = time.monotonic()
+            if value == 'Immediate':
+                self.shutter_opened = now
+            elif value == 'Release Full' and self.shutter_opened is not None:
+                exposed = now - self.shutter_opened
+                self.shutter_opened = None
+                name = 'IMG_%04d.JPG' % (len(self.files) + 1)
+                self.files[name] = self.dark_file_size if exposed >= 5 else self.light_file_size
+                self.pending.append((now + self.write_latency, name))
+
+    def _poll(self, phase, until):
+        # poll in EVENT_POLL_SLICE steps as the real session does, yielding the
+        # connection to background transfers; recorded as one phase
+        start = time.monotonic()
+        while True:
+            remaining = until() - time.monotonic()
+            if remaining <= 0:
+                break
+            with self.lock.idle():
+                time.sleep(max(0.0, min(remaining, self.EVENT_POLL_SLICE, until() - time.monotonic())))
+        with self.phases_lock:
+            self.phases.append((phase, start, time.monotonic() - start))
+
+    def waitForEvents(self, duration):
+        phase = 'exposure' if self.shutter_opened is not None else 'events'
+        deadline = time.monotonic() + duration
+        self._poll(phase, lambda: deadline)
+
+    def waitForFileAdded(self, timeout):
+        start = time.monotonic()
+        with self.lock:
+            ready_at, name = self.pending[0] if len(self.pending) > 0 else (None, None)
+            if ready_at is not None and ready_at - start <= timeout:
+                self.pending.pop(0)
+        if ready_at is None or ready_at - start > timeout:
+            self._poll('file_wait', lambda: start + timeout)
+            return None
+        self._poll('file_wait', lambda: ready_at)
+        return SimulatedFilePath('/store_00020001/DCIM/100CANON', name)
+
+    def downloadFile(self, camera_path, target_filename):
+        with self.lock:
+            if not camera_path.name in self.files:
+                raise CameraError('simulated camera has no file ' + camera_path.name)
+            size = self.files[camera_path.name]
+            self._phase('transfer', size / self.transfer_rate)
+        with open(target_filename, 'wb') as f:
+            f.truncate(size)
+        return size
+
+    def fileSize(self, camera_path):
+        with self.lock:
+            if not camera_path.name in self.files:
+                raise CameraError('simulated camera has no file ' + camera_path.name)
+            return self.files[camera_path.name]
+
+    def readFileChunk(self, camera_path, offset, buffer):
+        with self.lock:
+            length = max(0, min(len(buffer), self.fileSize(camera_path) - offset))
+            self._phase('transfer', length / self.transfer_rate)
+            return length
+
+CAMERA_BACKENDS = {'gphoto2': CameraSession, 'simulator': SimulatedCameraSession}
+
+def makeCameraSession(backend, logger, port=None, model=None, **options):
+    '''Return an (unopened) camera session for the named backend.'''
+    if not backend in CAMERA_BACKENDS:
+        raise ValueError('Unknown camera backend "' + str(backend) + '"; use one of ' + str(sorted(CAMERA_BACKENDS)))
+    return CAMERA_BACKENDS[backend](logger, port, model, **options)
@@ -0,0 +1,145 @@
+'''
+Benchmark suite for the capture loops, run against the simulated camera and
+relay backends (see capture_backends), so no Pi or camera is needed.
+
+Each profile drives the real singleCapture, seriesCapture or dualSeriesCapture
+code with short exposures and intervals, then reports per phase (config reads
+and writes, release, exposure, file wait, transfer) how much time each cycle
+spent, the overhead per cycle, i.e. the wall time the camera was busy with
+anything but the exposure itself (phases that overlap, like a pipelined
+download during the next exposure, count once), and the cycle time. The burst
+profile takes frames back to back, so its cycle time is the fastest cadence the
+capture path can keep up.
+
+Usage: python capture_benchmark.py [single] [series] [dual_series] [burst] [--pipelined] [--metrics]
+
+With --metrics, the capture code's own instrumentation (see capture_metrics) is
+also written to capture_benchmark_metrics.jsonl and .prom.
+
+'''
+
+import logging
+import shutil
+import sys
+import tempfile
+import time
+
+from camera_session import CameraSettings
+from capture_metrics import CaptureMetrics, getMetrics, setMetrics
+from capture_backends import SIMULATED_ACCEPTED_VALUES, SimulatedCameraSession, SimulatedRelayBackend
+from gphoto_capture_control import dualSeriesCapture, getRelayBackend, seriesCapture, setRelayBackend, singleCapture
+
+# Short enough that a full run takes about a minute; exposures of 5 s or more
+# count as dark frames, so dark_exposure is the shortest "real" dark frame.
+PROFILES = {
+    'single': {'captures': 5, 'exposure': 0.05, 'aperture': '7.1', 'iso': 'Auto', 'lights': 'off'},
+    'series': {'interval': 4.0, 'cycles': 5, 'exposure': 0.5, 'aperture': '2.8', 'iso': 'Auto', 'lights': 'off'},
+    'burst': {'interval': 0.5, 'cycles': 8, 'exposure': 0.5, 'aperture': '2.8', 'iso': 'Auto', 'lights': 'off'},
+    'dual_series': {'interval': 12.0, 'cycles': 3, 'light_exposure': 0.05, 'dark_exposure': 5.0,
+                    'aperture_light': '7.1', 'aperture_dark': '2.8', 'iso_light': 'Auto', 'iso_dark': 'Auto'},
+}
+
+def runProfile(logger, name, session, settings, output_dir, pipelined=False):
+    '''Run one benchmark profile. Return a list of (start, end) monotonic time
+    windows, one per cycle (or per call, for the single profile).'''
+    profile = PROFILES[name]
+    windows = []
+    if name == 'single':
+        for i in range(profile['captures']):
+            start = time.monotonic()
+            singleCapture(logger, None, profile['exposure'], profile['aperture'], profile['iso'], 'benchmark', 'call' + str(i),
+                          profile['lights'], session, settings, output_dir=output_dir)
+            windows.append((start, time.monotonic()))
+        return windows
+    if name in ['series', 'burst']:
+        # burst: every cycle overruns the interval and catches up at once
+        scheduler = seriesCapture(logger, profile['interval'], None, profile['cycles'], None, profile['exposure'], profile['aperture'],
+                                  profile['iso'], 'benchmark', profile['lights'], session, settings, pipelined,
+                                  overrun_policy='catchup' if name == 'burst' else 'skip', output_dir=output_dir)
+    else:
+        scheduler = dualSeriesCapture(logger, profile['interval'], None, profile['cycles'], None, profile['light_exposure'], profile['dark_exposure'],
+                                      profile['aperture_light'], profile['aperture_dark'], profile['iso_light'], profile['iso_dark'], 'benchmark',
+                                      session=session, settings=settings, pipelined=pipelined, output_dir=output_dir)
+    starts = [scheduler.start + r['start'] for r in scheduler.records if r['start'] is not None]
+    ends = starts[1:] + [time.monotonic()]
+    return list(zip(starts, ends))
+
+def busyTime(phases, start, end):
+    '''Return the wall time covered by the recorded phases starting in
+    [start, end), counting overlapping phases once.'''
+    intervals = sorted((phase_start, phase_start + duration) for phase, phase_start, duration in phases if start <= phase_start < end)
+    busy = 0.0
+    covered = float('-inf')
+    for interval_start, interval_end in intervals:
+        if interval_end > covered:
+            busy += interval_end - max(interval_start, covered)
+            covered = interval_end
+    return busy
+
+def phaseTotals(phases, start, end):
+    '''Return {phase: seconds} for the recorded phases starting in [start, end).'''
+    totals = {}
+    for phase, phase_start, duration in phases:
+        if start <= phase_start < end:
+            totals[phase] = totals.get(phase, 0.0) + duration
+    return totals
+
+def report(name, windows, phases, pipelined):
+    '''Return the per-phase and per-cycle overhead report for one profile as
+    a list of text lines.'''
+    per_cycle = [phaseTotals(phases, start, end) for start, end in windows]
+    phase_names = sorted(set(phase for totals in per_cycle for phase in totals))
+    lines = ['== ' + name + ' (' + str(len(windows)) + ' cycles, pipelined=' + str(pipelined) + ') ==',
+             '%-14s %10s %12s' % ('phase', 'total s', 'per cycle s')]
+    for phase in phase_names:
+        total = sum(totals.get(phase, 0.0) for totals in per_cycle)
+        lines.append('%-14s %10.3f %12.3f' % (phase, total, total / max(1, len(windows))))
+    overheads = [busyTime(phases, start, end) - totals.get('exposure', 0.0) for (start, end), totals in zip(windows, per_cycle)]
+    if name == 'single':
+        # for single calls, also count everything the phases don't cover
+        # (python, relay warm-up, file checks)
+        overheads = [(end - start) - totals.get('exposure', 0.0) for (start, end), totals in zip(windows, per_cycle)]
+    if len(overheads) > 0:
+        lines.append('overhead per cycle: mean %.3f s, min %.3f s, max %.3f s' % (sum(overheads) / len(overheads), min(overheads), max(overheads)))
+    # the last window runs to the end of the run, not to a next cycle
+    cycle_times = [end - start for start, end in windows[:-1]]
+    if len(cycle_times) > 0:
+        lines.append('cycle time: mean %.3f s, min %.3f s, max %.3f s' % (sum(cycle_times) / len(cycle_times), min(cycle_times), max(cycle_times)))
+    return lines
+
+def runBenchmarks(logger, names, pipelined=False):
+    '''Run the named profiles and return the combined report lines.'''
+    setRelayBackend(SimulatedRelayBackend())
+    getRelayBackend().setup([2])
+    lines = []
+    for name in names:
+        output_dir = tempfile.mkdtemp(prefix='capture_benchmark_')
+        try:
+            session = SimulatedCameraSession(logger)
+            session.open()
+            settings = CameraSettings(logger, session, SIMULATED_ACCEPTED_VALUES)
+            windows = runProfile(logger, name, session, settings, output_dir, pipelined)
+            session.close()
+            lines.extend(report(name, windows, session.phases, pipelined))
+        finally:
+            shutil.rmtree(output_dir)
+    return lines
+
+if __name__ == "__main__":
+
+    ''' Specify configurable parameters '''
+    args = sys.argv[1:]
+    pipelined = '--pipelined' in args
+    if '--metrics' in args:
+        setMetrics(CaptureMetrics('capture_benchmark_metrics.jsonl', 'capture_benchmark_metrics.prom'))
+    names = [x for x in args if not x.startswith('--')]
+    if len(names) == 0:
+        names = ['single', 'series', 'dual_series', 'burst']
+    for name in names:
+        if not name in PROFILES:
+            sys.exit('Unknown profile "' + name + '"; use any of ' + ', '.join(sorted(PROFILES)))
+
+    logger = logging.getLogger('capture_benchmark')
+    logger.addHandler(logging.NullHandler())
+    print('\n'.join(runBenchmarks(logger, names, pipelined)))
+    getMetrics().close()
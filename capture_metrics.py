@@ -0,0 +1,247 @@
+'''
+Per-phase timing instrumentation for the capture path.
+
+The capture code wraps each phase of a cycle in a span:
+
+    with getMetrics().span('config_apply'):
+        settings.apply(...)
+
+Phases recorded (see camera_session, gphoto_capture_control and
+capture_scheduler):
+
+    config_apply   -- CameraSettings.apply (aperture/ISO write and verify)
+    release        -- each eosremoterelease write (shutter press or release)
+    exposure       -- shutter open, i.e. the bulb exposure itself
+    file_wait      -- shutter close until the camera reports the new file
+    download       -- USB transfer and verification of the file
+    relay_switch   -- a relay (lights) output change
+    lights_warmup  -- waiting for the lights to come up to temp
+    sleep          -- scheduler sleep until the next deadline (the slack)
+
+With the default NullMetrics nothing is recorded. A CaptureMetrics instance set
+with setMetrics() appends every span, and one summary per cycle, as JSON lines:
+
+    {"type": "span", "phase": "download", "start": <unix time>, "duration": 2.41, "thread": "box1", "cycle": 3, ...}
+    {"type": "cycle", "cycle": 3, "thread": "box1", "jitter": 0.002, "busy": 493.1,
+     "exposure": 480.05, "background": 2.4, "overhead": 15.45, "slack": 406.9, "phases": {...}}
+
+where busy is the time the cycle spent capturing, background the time work
+submitted during the cycle (pipelined downloads) ran on other threads while the
+capture thread was idle, overhead busy plus background minus the exposure, and
+slack the time the cycle slept, including what was left before the next
+deadline, less the background work done meanwhile. After every cycle it also rewrites a Prometheus
+text-format snapshot of the totals so far, for node_exporter's textfile
+collector or a quick look.
+
+Spans are attributed to the thread they run on; in the rig controller every
+camera has its own thread, named after it. Work handed to another thread can
+carry its origin along: take attribution() where the work is submitted and
+record inside attributed() where it runs, as the pipelined download does (see
+capture_pipeline), so its spans count toward the submitting camera and cycle.
+
+'''
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+class NullMetrics(object):
+    '''Metrics sink that records nothing.'''
+
+    @contextlib.contextmanager
+    def span(self, phase, **labels):
+        yield
+
+    def record(self, phase, duration, **labels):
+        pass
+
+    def attribution(self):
+        return None
+
+    @contextlib.contextmanager
+    def attributed(self, attribution):
+        yield
+
+    def startCycle(self, cycle, jitter):
+        pass
+
+    def endCycle(self, slack):
+        pass
+
+    def close(self):
+        pass
+
+class CaptureMetrics(object):
+    '''Metrics sink writing JSON lines and a Prometheus snapshot.'''
+
+    def __init__(self, jsonl_filename='capture_metrics.jsonl', prom_filename='capture_metrics.prom'):
+        self.jsonl_filename = jsonl_filename
+        self.prom_filename = prom_filename
+        self.lock = threading.Lock()
+        self.jsonl = open(jsonl_filename, 'a')
+        self.totals = {} # (phase, thread) -> [count, sum, max]
+        self.cycles = {} # thread -> state of the cycle in progress
+        self.last_cycle = {} # thread -> summary of the last finished cycle
+        self.local = threading.local() # .attribution, while inside attributed()
+
+    def close(self):
+        with self.lock:
+            self.jsonl.close()
+
+    @contextlib.contextmanager
+    def span(self, phase, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(phase, time.monotonic() - start, **labels)
+
+    def record(self, phase, duration, **labels):
+        '''Record a phase that took duration seconds, ending now.'''
+        attribution = getattr(self.local, 'attribution', None)
+        now = time.monotonic()
+        with self.lock:
+            if attribution is None:
+                thread = threading.current_thread().name
+                cycle = self.cycles.get(thread)
+            else:
+                thread = attribution['thread']
+                cycle = attribution['state']
+            entry = dict(labels, type='span', phase=phase, start=time.time() - duration, duration=duration, thread=thread,
+                         cycle=None if cycle is None else cycle['cycle'])
+            self._write(entry)
+            total = self.totals.setdefault((phase, thread), [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += duration
+            total[2] = max(total[2], duration)
+            if cycle is not None:
+                cycle['phases'][phase] = cycle['phases'].get(phase, 0.0) + duration
+                if attribution is not None:
+                    cycle['background'].append((now - duration, now))
+                elif phase == 'exposure':
+                    cycle['exposure'] += duration
+                elif phase == 'sleep':
+                    cycle['sleeps'].append((now - duration, now))
+
+    def attribution(self):
+        '''Where work submitted from the calling thread belongs: its name and
+        the cycle in progress, for attributed(). The cycle's summary is held
+        back until every attributed() block for it has finished.'''
+        thread = threading.current_thread().name
+        with self.lock:
+            cycle = self.cycles.get(thread)
+            if cycle is not None:
+                cycle['pending'] += 1
+            return {'thread': thread, 'cycle': None if cycle is None else cycle['cycle'], 'state': cycle}
+
+    @contextlib.contextmanager
+    def attributed(self, attribution):
+        '''Record the spans of this block as if on the thread and in the cycle
+        of an attribution() taken elsewhere (None: as usual). Enter it exactly
+        once per attribution().'''
+        previous = getattr(self.local, 'attribution', None)
+        self.local.attribution = attribution
+        try:
+            yield
+        finally:
+            self.local.attribution = previous
+            cycle = None if attribution is None else attribution['state']
+            if cycle is not None:
+                with self.lock:
+                    cycle['pending'] -= 1
+                    if cycle['pending'] == 0 and cycle['ended'] is not None:
+                        self._finishCycle(attribution['thread'], cycle)
+
+    def startCycle(self, cycle, jitter):
+        '''Start attributing spans on this thread to a scheduler cycle.'''
+        with self.lock:
+            self.cycles[threading.current_thread().name] = {'cycle': cycle, 'jitter': jitter, 'started': time.monotonic(),
+                                                            'ended': None, 'slack': None, 'phases': {}, 'exposure': 0.0,
+                                                            'sleeps': [], 'background': [], 'pending': 0}
+
+    def endCycle(self, slack):
+        '''Close the cycle in progress on this thread, given the slack left
+        before the next deadline, and refresh the snapshot (once work submitted
+        during the cycle, e.g. pipelined downloads, is done).'''
+        thread = threading.current_thread().name
+        with self.lock:
+            cycle = self.cycles.pop(thread, None)
+            if cycle is None:
+                return
+            cycle['ended'] = time.monotonic()
+            cycle['slack'] = slack
+            if cycle['pending'] == 0:
+                self._finishCycle(thread, cycle)
+
+    def _finishCycle(self, thread, cycle):
+        # time slept within the cycle (e.g. before the light frame of a dual
+        # series) is slack, not capture time
+        sleep = sum(end - start for start, end in cycle['sleeps'])
+        busy = cycle['ended'] - cycle['started'] - sleep
+        # work done for the cycle on other threads adds to its overhead where
+        # the capture thread wasn't busy anyway: after the cycle ended, or
+        # while it slept
+        idle = [(float('-inf'), cycle['started']), (cycle['ended'], float('inf'))] + cycle['sleeps']
+        background = 0.0
+        for start, end in cycle['background']:
+            background += sum(max(0.0, min(end, idle_end) - max(start, idle_start)) for idle_start, idle_end in idle)
+        summary = {'type': 'cycle', 'cycle': cycle['cycle'], 'thread': thread, 'jitter': cycle['jitter'], 'busy': busy,
+                   'exposure': cycle['exposure'], 'background': background, 'overhead': busy + background - cycle['exposure'],
+                   'slack': cycle['slack'] + sleep - background, 'phases': cycle['phases']}
+        self._write(summary)
+        self.last_cycle[thread] = summary
+        self._writeSnapshot()
+
+    def _write(self, entry):
+        self.jsonl.write(json.dumps(entry, sort_keys=True) + '\n')
+        self.jsonl.flush()
+
+    def snapshot(self):
+        '''Prometheus text exposition of the totals so far.'''
+        with self.lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        lines = ['# HELP capture_phase_seconds Time spent per capture phase.',
+                 '# TYPE capture_phase_seconds summary']
+        for (phase, thread), (count, total, longest) in sorted(self.totals.items()):
+            labels = '{phase="' + phase + '",thread="' + thread + '"}'
+            lines.append('capture_phase_seconds_count' + labels + ' ' + str(count))
+            lines.append('capture_phase_seconds_sum' + labels + ' ' + repr(total))
+        lines += ['# HELP capture_phase_seconds_max Longest single occurrence per capture phase.',
+                  '# TYPE capture_phase_seconds_max gauge']
+        for (phase, thread), (count, total, longest) in sorted(self.totals.items()):
+            lines.append('capture_phase_seconds_max{phase="' + phase + '",thread="' + thread + '"} ' + repr(longest))
+        for name, key, description in [('capture_cycle_overhead_seconds', 'overhead', 'Capture time not spent exposing, last cycle.'),
+                                       ('capture_cycle_slack_seconds', 'slack', 'Time slept within and after the last cycle.'),
+                                       ('capture_cycle_jitter_seconds', 'jitter', 'Cycle start minus its deadline, last cycle.')]:
+            lines += ['# HELP ' + name + ' ' + description, '# TYPE ' + name + ' gauge']
+            for thread, summary in sorted(self.last_cycle.items()):
+                if summary[key] is not None:
+                    lines.append(name + '{thread="' + thread + '"} ' + repr(summary[key]))
+        lines += ['# HELP capture_cycle_last Number of the last finished cycle.', '# TYPE capture_cycle_last gauge']
+        for thread, summary in sorted(self.last_cycle.items()):
+            lines.append('capture_cycle_last{thread="' + thread + '"} ' + str(summary['cycle']))
+        return '\n'.join(lines) + '\n'
+
+    def _writeSnapshot(self):
+        if self.prom_filename is None:
+            return
+        temp_path = self.prom_filename + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self._snapshot())
+        os.replace(temp_path, self.prom_filename) # scrapers never see a partial file
+
+_metrics = NullMetrics()
+
+def setMetrics(metrics):
+    '''Select where capture timing goes, e.g. a CaptureMetrics; None turns
+    recording off again.'''
+    global _metrics
+    _metrics = NullMetrics() if metrics is None else metrics
+
+def getMetrics():
+    '''Return the metrics sink in use (NullMetrics unless set otherwise).'''
+    return _metrics
@@ -0,0 +1,124 @@
+'''
+Pipelined download for the timelapse capture loops.
+
+In the serial path, singleCapture exposes, downloads and verifies a frame before
+it returns. With a CapturePipeline, singleCapture hands the camera-side file to
+a background worker as soon as the camera reports it, and goes on to the next
+frame while the worker downloads and verifies this one and passes it on to the
+consumers.
+
+There is only one USB connection to the camera, so the worker reads the file in
+chunks (CameraSession.downloadFileInChunks), and the capture loop's commands
+(config writes, the release) go before any chunk that is waiting. The chunks
+fill the time the loop only polls for events: while the next frame's shutter
+is open, as long as a chunk can finish before it is due to close, and while the
+camera writes the next frame. A frame's download therefore overlaps the next
+frame's exposure and write, and back-to-back frames come at a shorter cycle
+than in the serial path (see the burst profile of capture_benchmark).
+
+'''
+
+import queue
+import threading
+import time
+
+from capture_metrics import getMetrics
+
+class FrameResult(object):
+    '''Outcome of one pipelined download.'''
+
+    def __init__(self, filename, success, duration, error=None):
+        self.filename = filename
+        self.success = success
+        self.duration = duration # in seconds, from hand-off to verified file
+        self.error = error
+
+class CapturePipeline(object):
+    '''Background downloader sharing a CameraSession with the capture loop.
+
+    At most max_in_flight frames are in flight, counting the one being
+    downloaded; submit() blocks while that many are, so a slow link throttles
+    the capture loop rather than piling up frames in camera RAM. Download
+    chunks are held back while the shutter is open if they might not finish
+    before it is due to close (see CameraSession.transferWindow), so exposure
+    timing is not disturbed.
+
+    Download timing is recorded for the thread that submitted the frame and its
+    cycle (see capture_metrics), and the worker thread is named after the
+    thread that creates the pipeline, e.g. box1-download in the rig controller.
+
+    Per-frame outcomes are collected in self.results; failures are also logged
+    as they happen. Verified frames are passed on to each of consumers, objects
+    with a non-blocking submit(image_path) such as preview_pyramid.PreviewWorker.
+    '''
+
+    def __init__(self, logger, session, max_in_flight=2, consumers=()):
+        self.logger = logger
+        self.session = session
+        self.consumers = list(consumers or ())
+        self.pending = queue.Queue()
+        self.slots = threading.BoundedSemaphore(max_in_flight) # taken on submit, returned once the download is over
+        self.results = []
+        self.results_lock = threading.Lock()
+        self.worker = threading.Thread(target=self._run, name=threading.current_thread().name + '-download', daemon=True)
+        self.worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def submit(self, camera_path, target_filename, size_key=None):
+        '''Queue a frame reported by CameraSession.bulbExpose for download.'''
+        self.slots.acquire()
+        self.pending.put((camera_path, target_filename, size_key, time.monotonic(), getMetrics().attribution()))
+
+    def drain(self):
+        '''Block until every submitted frame has been downloaded or failed.'''
+        self.pending.join()
+
+    def close(self):
+        '''Drain outstanding downloads and stop the worker.'''
+        self.drain()
+        self.pending.put(None)
+        self.worker.join()
+
+    def failures(self):
+        '''Return the FrameResults of frames that failed so far.'''
+        with self.results_lock:
+            return [r for r in self.results if not r.success]
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.task_done()
+                return
+            try:
+                camera_path, target_filename, size_key, submitted, attribution = item
+                error = None
+                with getMetrics().attributed(attribution):
+                    try:
+                        success = self.session.fetchFile(camera_path, target_filename, size_key, chunked=True)
+                        if not success:
+                            error = 'download incomplete'
+                    except Exception as e:
+                        success = False
+                        error = str(e)
+                result = FrameResult(target_filename, success, time.monotonic() - submitted, error)
+                with self.results_lock:
+                    self.results.append(result)
+                if success:
+                    self.logger.debug('\tDownloaded ' + target_filename + ' (' + str(round(result.duration, 1)) + 's after exposure)')
+                    for consumer in self.consumers:
+                        try:
+                            consumer.submit(target_filename)
+                        except Exception as e:
+                            self.logger.debug('WARNING: ' + type(consumer).__name__ + ' failed on ' + target_filename + ': ' + str(e))
+                else:
+                    self.logger.debug('WARNING: pipelined download of ' + target_filename + ' failed: ' + error)
+            finally:
+                self.slots.release()
+                self.pending.task_done()
@@ -0,0 +1,152 @@
+'''
+Drift-free cycle scheduling for the timelapse capture loops.
+
+Every cycle is planned against an absolute deadline on the monotonic clock,
+counted from the start of the batch (cycle i starts at start + i * interval),
+instead of sleeping "interval minus however long the last capture took". Time
+spent outside the capture call, sleep overshoot and wall-clock adjustments
+(NTP on the Pi) therefore can't accumulate over a 24 h run.
+
+'''
+
+import time
+
+from capture_metrics import getMetrics
+
+# What to do when a cycle is ready to start after its deadline has passed:
+#   skip     -- run late if still within the cycle's own slot, otherwise drop the
+#               cycles whose slots are already over and run the current one
+#               right away, late within its slot
+#   catchup  -- run every missed cycle, back to back, until back on schedule
+#   compress -- run now, then spread the remaining cycles evenly over the time
+#               left until the planned end of the batch
+OVERRUN_POLICIES = ['skip', 'catchup', 'compress']
+
+class CycleScheduler(object):
+    '''Iterate over the cycles of a batch, sleeping until each cycle's deadline.
+
+        scheduler = CycleScheduler(logger, interval, cycles)
+        for i in scheduler:
+            ... capture ...
+
+    Each started or skipped cycle is recorded in self.records as a dict with
+    the cycle number, its deadline and actual start (in seconds since the batch
+    start), the jitter (actual - deadline) and a status of 'on_time', 'late' or
+    'skipped'.
+
+    If idle is given (a threading or multiprocessing Event), it is set while
+    the scheduler sleeps and cleared when it wakes, so background work can
+    confine itself to the slack in each cycle.
+    '''
+
+    # a cycle starting less than this late counts as on time
+    ON_TIME_TOLERANCE = 0.5 # in seconds
+
+    def __init__(self, logger, interval, cycles, overrun_policy='skip', start=None, idle=None):
+        if not overrun_policy in OVERRUN_POLICIES:
+            raise ValueError('Unknown overrun policy "' + str(overrun_policy) + '"; use one of ' + str(OVERRUN_POLICIES))
+        self.logger = logger
+        self.interval = float(interval)
+        self.cycles = int(cycles)
+        self.overrun_policy = overrun_policy
+        if start is None:
+            start = time.monotonic()
+        self.start = start
+        self.end = start + self.cycles * self.interval
+        # deadline(i) = base_time + (i - base_cycle) * cycle_interval; the
+        # compress policy re-plans these for the rest of the batch
+        self.base_cycle = 0
+        self.base_time = start
+        self.cycle_interval = self.interval
+        self.current = None
+        self.records = []
+        self.idle = idle
+
+    def deadline(self, cycle):
+        '''Monotonic start time planned for the given cycle.'''
+        return self.base_time + (cycle - self.base_cycle) * self.cycle_interval
+
+    def nextDeadline(self):
+        '''Monotonic start time of the cycle after the current one.'''
+        return self.deadline(self.current + 1)
+
+    def sleepUntil(self, target):
+        '''Sleep until the monotonic clock reaches target. Return the slack, i.e.
+        how long we slept (negative if target had already passed).'''
+        started = time.monotonic()
+        slack = target - started
+        if slack > 0 and self.idle is not None:
+            self.idle.set()
+        try:
+            while True:
+                remaining = target - time.monotonic()
+                if remaining <= 0:
+                    return slack
+                time.sleep(remaining)
+        finally:
+            if self.idle is not None:
+                self.idle.clear()
+            if slack > 0:
+                getMetrics().record('sleep', time.monotonic() - started)
+
+    def _record(self, cycle, actual, status):
+        deadline = self.deadline(cycle)
+        record = {'cycle': cycle,
+                  'deadline': deadline - self.start,
+                  'start': None if actual is None else actual - self.start,
+                  'jitter': None if actual is None else actual - deadline,
+                  'status': status}
+        self.records.append(record)
+        return record
+
+    def __iter__(self):
+        cycle = 0
+        while cycle < self.cycles:
+            deadline = self.deadline(cycle)
+            now = time.monotonic()
+            if now < deadline:
+                self.sleepUntil(deadline)
+            elif self.overrun_policy == 'skip' and cycle + 1 < self.cycles and now >= self.deadline(cycle + 1):
+                # missed the whole slot: drop every cycle whose slot is over
+                while cycle + 1 < self.cycles and now >= self.deadline(cycle + 1):
+                    self._record(cycle, None, 'skipped')
+                    self.logger.debug('WARNING: cycle ' + str(cycle + 1) + ' skipped, capture overran its slot')
+                    cycle += 1
+                continue
+            elif self.overrun_policy == 'compress' and now - deadline > self.ON_TIME_TOLERANCE:
+                remaining = self.cycles - cycle
+                self.base_cycle = cycle
+                self.base_time = now
+                self.cycle_interval = max(0.0, (self.end - now) / remaining)
+                self.logger.debug('WARNING: schedule compressed, remaining ' + str(remaining) + ' cycles at ' + str(round(self.cycle_interval, 1)) + 's intervals')
+            actual = time.monotonic()
+            if actual - self.deadline(cycle) > self.ON_TIME_TOLERANCE:
+                status = 'late'
+            else:
+                status = 'on_time'
+            record = self._record(cycle, actual, status)
+            self.logger.debug('\tCycle ' + str(cycle + 1) + ' started ' + str(round(record['jitter'], 3)) + 's after its deadline')
+            self.current = cycle
+            metrics = getMetrics()
+            metrics.startCycle(cycle, record['jitter'])
+            try:
+                yield cycle
+            finally:
+                # also on an early exit from the loop, so the cycle that ended it is recorded
+                metrics.endCycle(self.deadline(cycle + 1) - time.monotonic())
+            cycle += 1
+
+    def summary(self):
+        '''Return a dict of jitter statistics over the cycles run so far.'''
+        jitters = [r['jitter'] for r in self.records if r['jitter'] is not None]
+        summary = {'cycles_run': len(jitters),
+                   'cycles_late': len([r for r in self.records if r['status'] == 'late']),
+                   'cycles_skipped': len([r for r in self.records if r['status'] == 'skipped'])}
+        if len(jitters) > 0:
+            summary['mean_jitter'] = sum(jitters) / len(jitters)
+            summary['max_jitter'] = max(jitters)
+        return summary
+
+    def logSummary(self):
+        summary = self.summary()
+        self.logger.debug('Schedule summary: ' + ', '.join(k + '=' + str(round(v, 3) if isinstance(v, float) else v) for k, v in sorted(summary.items())))
@@ -0,0 +1,183 @@
+'''
+Config-driven cycle planner for the timelapse capture loops.
+
+The 'cycle' capture profile describes one timelapse cycle as an ordered list of
+phases, each taking one frame with its own lights state and camera settings:
+
+    phases = dark, light
+    dark_lights = off
+    dark_shutterspeed = 480
+    dark_aperture = 2.8
+    dark_iso = Auto
+    light_lights = on
+    light_shutterspeed = 0.05
+    light_aperture = 7.1
+    light_iso = Auto
+    light_at = end
+
+Optional keys per phase:
+
+    <phase>_settle -- seconds the lights need after switching before this
+                      phase may expose (default LIGHTS_WARMUP if lit, else 0)
+    <phase>_at     -- exposure start in seconds from the cycle start, or 'end'
+                      to close CYCLE_MARGIN seconds before the next cycle, which
+                      gives the lights the longest warm-up; by default a phase
+                      starts as soon as the one before it is done
+
+compilePlan() turns the phases into a timeline before the run starts and
+rejects plans that don't fit the interval. The timeline overlaps work rather
+than running it back to back: the relay is switched for a phase as soon as the
+shutter of the phase before it closes, so the lights warm up (or go dark) while
+the previous frame downloads and this phase's aperture and ISO are written, and
+only what is left of the settle time is waited for. A second lit phase thus
+adds little more than its own exposure and download to the cycle.
+
+All phases of a plan drive the one relay of their imaging box (see
+rig_controller).
+
+'''
+
+from adaptive_exposure import DARK_MIN_EXPOSURE
+from camera_session import DEFAULT_FILE_SIZE, DOWNLOAD_MIN_RATE
+
+PHASE_KEYS = ['lights', 'shutterspeed', 'aperture', 'iso']
+OPTIONAL_PHASE_KEYS = ['settle', 'at']
+
+# planning estimates, in seconds
+LIGHTS_WARMUP = 3.0 # for the bulb to come up to temp after switching on
+CONFIG_TIME = 1.0 # aperture/ISO write and verification read
+RELEASE_TIME = 1.0 # shutter press and release, and the camera reporting the file
+DOWNLOAD_TIME = DEFAULT_FILE_SIZE / DOWNLOAD_MIN_RATE # worst case for one frame
+CYCLE_MARGIN = 2.0 # kept free before the next cycle by phases at 'end'
+
+def frameTag(exposure_time):
+    '''The light/dark tag singleCapture gives a frame of this exposure.'''
+    return 'dark' if float(exposure_time) >= DARK_MIN_EXPOSURE else 'light'
+
+def phaseConfKeys(conf):
+    '''Return the config keys the phases listed in conf require.'''
+    keys = []
+    for name in phaseNames(conf):
+        keys += [name + '_' + key for key in PHASE_KEYS]
+    return keys
+
+def optionalPhaseConfKeys(conf):
+    '''Return the optional config keys of the phases listed in conf.'''
+    keys = []
+    for name in phaseNames(conf):
+        keys += [name + '_' + key for key in OPTIONAL_PHASE_KEYS]
+    return keys
+
+def phaseNames(conf):
+    '''Return the phase names listed in conf, in cycle order.'''
+    return [name.strip() for name in conf.get('phases', '').split(',') if not name.strip() == '']
+
+def parsePhases(conf):
+    '''Return the phases of a 'cycle' profile config as a list of dicts with
+    keys name, lights, shutterspeed, aperture, iso, settle and at, in cycle
+    order. Raise ValueError if a phase is malformed.'''
+    names = phaseNames(conf)
+    if len(names) == 0:
+        raise ValueError('a cycle needs at least one phase, e.g. "phases = dark, light"')
+    if not len(set(names)) == len(names):
+        raise ValueError('phase names must be unique: ' + ', '.join(names))
+    phases = []
+    for name in names:
+        missing = [name + '_' + key for key in PHASE_KEYS if not name + '_' + key in conf]
+        if len(missing) > 0:
+            raise ValueError('phase "' + name + '" is missing ' + ', '.join(missing))
+        phase = dict((key, conf[name + '_' + key]) for key in PHASE_KEYS)
+        phase['name'] = name
+        if not phase['lights'] in ['on', 'off']:
+            raise ValueError('phase "' + name + '": lights must be on or off, not "' + phase['lights'] + '"')
+        if not float(phase['shutterspeed']) > 0:
+            raise ValueError('phase "' + name + '": shutterspeed must be positive')
+        phase['settle'] = float(conf.get(name + '_settle', LIGHTS_WARMUP if phase['lights'] == 'on' else 0))
+        at = conf.get(name + '_at')
+        phase['at'] = at if at in [None, 'end'] else float(at)
+        phases.append(phase)
+    return phases
+
+def validatePhases(phases, accepted_values=None):
+    '''Check that no two phases would write the same file name and, given the
+    camera's accepted values (CameraSettings.accepted_values), that every
+    aperture and ISO is one the camera takes. Raise ValueError otherwise.'''
+    seen = {}
+    for phase in phases:
+        key = (frameTag(phase['shutterspeed']), float(phase['shutterspeed']), phase['aperture'], phase['iso'])
+        if key in seen:
+            raise ValueError('phases "' + seen[key] + '" and "' + phase['name'] + '" would write the same file; change an exposure setting')
+        seen[key] = phase['name']
+        if accepted_values is None:
+            continue
+        for setting in ['aperture', 'iso']:
+            if setting in accepted_values and not phase[setting] in accepted_values[setting]:
+                raise ValueError('phase "' + phase['name'] + '": ' + setting + ' ' + phase[setting] + ' is not accepted by the camera')
+
+def _timeline(phases, interval, download_time, wrap_close):
+    timeline = []
+    free = 0.0 # when the camera can take the next command
+    previous = phases[-1]
+    previous_close = wrap_close
+    for phase in phases:
+        download = download_time
+        exposure = float(phase['shutterspeed'])
+        configure = 0.0 if (phase['aperture'], phase['iso']) == (previous['aperture'], previous['iso']) else CONFIG_TIME
+        ready = free + configure
+        switch = None
+        if not phase['lights'] == previous['lights']:
+            switch = previous_close
+            ready = max(ready, switch + phase['settle'])
+        if phase['at'] == 'end':
+            start = interval - CYCLE_MARGIN - download - RELEASE_TIME - exposure
+        elif phase['at'] is not None:
+            start = phase['at']
+        else:
+            start = ready
+        if start < ready - 1e-6:
+            raise ValueError('phase "' + phase['name'] + '" is set to start ' + str(round(start, 1)) + 's into the cycle, but can start ' +
+                             str(round(ready, 1)) + 's in at the earliest')
+        close = start + exposure + RELEASE_TIME
+        timeline.append({'phase': phase, 'switch': switch, 'configure': configure, 'start': start, 'close': close, 'done': close + download})
+        free = close + download
+        previous = phase
+        previous_close = close
+    return timeline
+
+def compilePlan(phases, interval, download_time=DOWNLOAD_TIME, accepted_values=None):
+    '''Lay out one cycle of phases on a timeline, in seconds from the cycle
+    start. Return a list of dicts, one per phase in order, with the phase and
+    the planned times at which the relay is switched for it (None if it stays
+    as it is), its exposure starts and closes, and its frame is done (i.e.
+    downloaded). configure is the planned aperture/ISO write time.
+
+    Downloads are planned in line even for pipelined capture. A pipelined
+    download only runs in the gaps the capture loop leaves on the camera
+    connection (see capture_pipeline), so in line is the worst case.
+
+    Raise ValueError if the phases are invalid (see validatePhases) or don't
+    fit in interval seconds.'''
+    validatePhases(phases, accepted_values)
+    interval = float(interval)
+    # the relay switches for the first phase when the last phase of the
+    # previous cycle closes; settle until that no longer moves the timeline
+    wrap_close = float('-inf')
+    for _ in range(len(phases) + 1):
+        timeline = _timeline(phases, interval, download_time, wrap_close)
+        if timeline[-1]['close'] - interval == wrap_close:
+            break
+        wrap_close = timeline[-1]['close'] - interval
+    needed = max(entry['done'] for entry in timeline)
+    if needed > interval:
+        raise ValueError('the cycle needs ' + str(round(needed, 1)) + 's but the interval is only ' + str(round(interval, 1)) + 's')
+    return timeline
+
+def describePlan(timeline):
+    '''The timeline as text lines, for the log.'''
+    def seconds(value):
+        return '-' if value is None else '%.1fs' % value
+    lines = ['%-12s %-6s %8s %8s %8s %8s' % ('phase', 'lights', 'switch', 'start', 'close', 'done')]
+    for entry in timeline:
+        lines.append('%-12s %-6s %8s %8s %8s %8s' % (entry['phase']['name'], entry['phase']['lights'], seconds(entry['switch']),
+                                                     seconds(entry['start']), seconds(entry['close']), seconds(entry['done'])))
+    return lines
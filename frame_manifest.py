@@ -0,0 +1,121 @@
+'''
+Content-hashed manifest for incremental reprocessing of an image series.
+
+The manifest (manifest.json in the processed output folder) records what every
+output was built from:
+
+  frames -- for each processed frame: the hash of its raw input file, of the
+            filter parameters and of the overlay (ROI layout) it was drawn with
+  segments -- for each fixed-size video segment: a hash over the entries of
+            the frames it contains plus the video settings (fps, timestamp
+            overlay)
+
+On a rerun only frames whose recorded hashes no longer match are rebuilt, and
+only the video segments containing a rebuilt, added or removed frame are
+re-encoded; the rest are reused as they are. Input hashes are cached by file
+size and modification time, so unchanged raw images aren't read again.
+
+'''
+
+import hashlib
+import json
+import os
+
+MANIFEST_FILENAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# frames per video segment; a new frame only re-encodes its own segment
+SEGMENT_FRAMES = 48
+
+def fileHash(path, chunk_size=1 << 20):
+    '''SHA-1 of a file's contents.'''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def valueHash(value):
+    '''SHA-1 of any JSON-serializable value (dict key order doesn't matter).'''
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+class FrameManifest(object):
+    '''Load, query and update the manifest of one output folder.'''
+
+    def __init__(self, output_dir, filename=MANIFEST_FILENAME):
+        self.path = os.path.join(output_dir, filename)
+        self.data = {'version': MANIFEST_VERSION, 'inputs': {}, 'frames': {}, 'segments': {}}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                self.data = data
+
+    def save(self):
+        '''Write the manifest atomically, so an interrupted run can't leave a
+        half-written one behind.'''
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    def inputHash(self, path):
+        '''Content hash of a raw input, reusing the cached hash while the file's
+        size and modification time are unchanged.'''
+        stat = os.stat(path)
+        name = os.path.basename(path)
+        cached = self.data['inputs'].get(name)
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['hash']
+        digest = fileHash(path)
+        self.data['inputs'][name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest}
+        return digest
+
+    def frameEntry(self, input_path, params_hash, overlay_hash):
+        return {'input': os.path.basename(input_path),
+                'input_hash': self.inputHash(input_path),
+                'params_hash': params_hash,
+                'overlay_hash': overlay_hash}
+
+    def staleFrames(self, input_dir, file_names, output_names, params_hash, overlay_hash):
+        '''Return the input file names whose output (in the manifest's folder,
+        named by output_names) is missing or was built from a different input,
+        filter parameters or overlay. overlay_hash may also be a {file name:
+        hash} dict, for overlays that differ per frame (e.g. registered).'''
+        output_dir = os.path.dirname(self.path)
+        stale = []
+        for x, output_name in zip(file_names, output_names):
+            entry = self.frameEntry(os.path.join(input_dir, x), params_hash, _frameHash(overlay_hash, x))
+            if not self.data['frames'].get(output_name) == entry or not os.path.exists(os.path.join(output_dir, output_name)):
+                stale.append(x)
+        return stale
+
+    def recordFrames(self, input_dir, file_names, output_names, params_hash, overlay_hash):
+        '''Record the given outputs as built from the current inputs.'''
+        for x, output_name in zip(file_names, output_names):
+            self.data['frames'][output_name] = self.frameEntry(os.path.join(input_dir, x), params_hash, _frameHash(overlay_hash, x))
+
+    def forgetFrames(self, keep_output_names):
+        '''Drop frame entries for outputs that are no longer part of the series.'''
+        keep = set(keep_output_names)
+        for output_name in [x for x in self.data['frames'] if not x in keep]:
+            del self.data['frames'][output_name]
+
+    def segmentHash(self, output_names, video_settings):
+        '''Hash of everything a video segment depends on.'''
+        return valueHash({'frames': [[x, self.data['frames'].get(x)] for x in output_names],
+                          'video': video_settings})
+
+    def segmentIsCurrent(self, segment_name, segment_hash):
+        output_dir = os.path.dirname(self.path)
+        return self.data['segments'].get(segment_name) == segment_hash and os.path.exists(os.path.join(output_dir, segment_name))
+
+    def recordSegment(self, segment_name, segment_hash):
+        self.data['segments'][segment_name] = segment_hash
+
+def _frameHash(overlay_hash, file_name):
+    return overlay_hash[file_name] if isinstance(overlay_hash, dict) else overlay_hash
+
+def splitSegments(names, segment_frames=SEGMENT_FRAMES):
+    '''Split an ordered frame list into consecutive fixed-size segments.'''
+    return [names[i:i + segment_frames] for i in range(0, len(names), segment_frames)]
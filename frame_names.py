@@ -0,0 +1,87 @@
+'''
+Parsing of the capture file names written by singleCapture, e.g.
+
+    subject_2019-10-06_14:30:00_dark_exp480s__f2.8_isoAuto.jpg
+
+optionally with the 'processed_' prefix added by the processing step, and of
+the previews written next to the frames at capture time.
+
+'''
+
+import datetime
+import os
+import re
+
+FRAME_NAME_EXPRESSION = re.compile(r'^(?:processed_)?(?P<subject>.+)_(?P<date>\d\d\d\d-\d\d-\d\d)_(?P<time>\d\d:\d\d:\d\d)'
+                                   r'_(?P<tag>light|dark)_exp(?P<exposure>[\d.]+)s__f(?P<aperture>[\d.]+)_iso(?P<iso>\w+)\.\w+$')
+
+def parseFrameName(file_name):
+    '''Capture metadata from a singleCapture file name, as a dict with keys
+    subject, datetime (a datetime.datetime), tag ('light' or 'dark'), exposure
+    (seconds, float), aperture and iso (strings). Returns None if the name
+    doesn't follow the convention.'''
+    match = FRAME_NAME_EXPRESSION.match(os.path.basename(file_name))
+    if match is None:
+        return None
+    return {'subject': match.group('subject'),
+            'datetime': datetime.datetime.strptime(match.group('date') + '_' + match.group('time'), '%Y-%m-%d_%H:%M:%S'),
+            'tag': match.group('tag'),
+            'exposure': float(match.group('exposure')),
+            'aperture': match.group('aperture'),
+            'iso': match.group('iso')}
+
+def exposureScale(info):
+    '''Exposure of a frame relative to 1 s at ISO 100, from parseFrameName
+    metadata, for normalizing values to counts per second at ISO 100 across
+    frames taken with different settings. None if the ISO was Auto.'''
+    if not info['iso'].isdigit():
+        return None
+    return info['exposure'] * int(info['iso']) / 100.0
+
+def _settingsText(info):
+    return 'exp' + ('%g' % info['exposure']) + 's f' + info['aperture'] + ' iso' + info['iso']
+
+def pairFrames(file_names, light_aperture=None, light_exposure=None):
+    '''Pair the light and dark frames of each cycle, which dualSeriesCapture
+    and cycleCapture name with the same subject and timestamp. Returns (light
+    name, dark name) tuples in capture order; frames without a partner are
+    left out.
+
+    A cycle may take several light frames (e.g. the light and light_closed
+    phases of a cycle profile). light_aperture (e.g. '7.1') and light_exposure
+    (seconds) select which one to pair; frames not matching them are ignored.
+    Raise ValueError if a cycle still has more than one light or dark frame.'''
+    cycles = {}
+    for x in file_names:
+        info = parseFrameName(x)
+        if info is None:
+            continue
+        if info['tag'] == 'light':
+            if light_aperture is not None and not float(info['aperture']) == float(light_aperture):
+                continue
+            if light_exposure is not None and not info['exposure'] == float(light_exposure):
+                continue
+        cycles.setdefault((info['datetime'], info['subject']), {}).setdefault(info['tag'], []).append((x, info))
+    pairs = []
+    for (timestamp, subject), frames in sorted(cycles.items()):
+        for tag, candidates in frames.items():
+            if len(candidates) > 1:
+                hint = ' (select one with light_aperture or light_exposure)' if tag == 'light' else ''
+                raise ValueError('the cycle of ' + subject + ' at ' + str(timestamp) + ' has ' + str(len(candidates)) + ' ' + tag +
+                                 ' frames: ' + ', '.join(_settingsText(info) for x, info in candidates) + hint)
+        if 'light' in frames and 'dark' in frames:
+            pairs.append((frames['light'][0][0], frames['dark'][0][0]))
+    return pairs
+
+# reduced-resolution copies written next to each frame (see preview_pyramid),
+# e.g. 'subject_..._isoAuto.thumb.jpg'
+PREVIEW_SUFFIXES = ('.thumb.jpg', '.preview.jpg')
+
+def previewName(file_name, level):
+    '''Name of a frame's preview at the given pyramid level ('thumb' or
+    'preview'), next to the frame itself.'''
+    return os.path.splitext(file_name)[0] + '.' + level + '.jpg'
+
+def isPreviewName(file_name):
+    '''True iff file_name is a preview rather than a captured frame.'''
+    return file_name.endswith(PREVIEW_SUFFIXES)
@@ -0,0 +1,265 @@
+'''
+NumPy implementation of the sv1/sv2 ImageJ macros in batch_macros.ijm.
+
+The macros open, filter, annotate and save each frame one at a time in a single
+JVM thread. Here the same operations are vectorized NumPy filters, and frames
+are processed in parallel across a process pool:
+
+    setMinAndMax(0, 25)                               -> applyMinAndMax
+    run("Remove Outliers...", "radius=1 threshold=50 which=Bright")
+                                                      -> removeOutliers
+    run("Despeckle")                                  -> despeckle
+    makeRectangle/run("Draw")/drawString              -> drawLayout, from
+                                                         the layouts in roi_layouts
+
+Like ImageJ on RGB images, every filter is applied to each channel separately,
+and pixels beyond the image edge are taken to equal the nearest edge pixel.
+medianReference is the brute-force 3x3 median that median3x3 is checked
+against, and compareWithImageJ checks a folder of output against the macro's
+output; both checks can be run from the command line (see the end of this
+file).
+
+Unlike the macros, the layout can follow a frame registration (see
+frame_registration), so the boxes stay on the subjects as they move.
+
+'''
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+import calibration
+from frame_names import isPreviewName
+from frame_registration import alignLayout
+from roi_layouts import getLayout
+
+# ImageJ saves JPEGs at quality 85 unless told otherwise
+JPEG_QUALITY = 85
+
+# rows per strip for the 3x3 rank filters; bounds the temporaries of the
+# median network to a few tens of MB on a 6000 px wide frame
+STRIP_ROWS = 256
+
+# filter chain shared by the sv1 and sv2 macros
+FILTER_CHAIN = {'min': 0, 'max': 25, 'outlier_threshold': 50}
+
+def applyMinAndMax(image, min_value, max_value):
+    '''Linear display-range stretch, as ImageJ's setMinAndMax applies it to the
+    pixel data of an RGB image: min maps to 0, max to 255, values outside are
+    clipped. Returns a new uint8 array.'''
+    values = np.arange(256, dtype=np.float64) - min_value
+    lut = np.clip((256.0 * values / (max_value - min_value + 1)).astype(np.int64), 0, 255).astype(np.uint8)
+    return lut[image]
+
+# compare-exchange network picking the median of 9 values in 19 steps (Paeth);
+# each step is one elementwise np.minimum/np.maximum over a whole strip, which
+# is far cheaper than sorting the stacked neighbourhoods
+MEDIAN9_NETWORK = [(1, 2), (4, 5), (7, 8), (0, 1), (3, 4), (6, 7), (1, 2), (4, 5), (7, 8), (0, 3),
+                   (5, 8), (4, 7), (3, 6), (1, 4), (2, 5), (4, 7), (4, 2), (6, 4), (4, 2)]
+
+def median3x3(image, strip_rows=STRIP_ROWS):
+    '''3x3 median filter per channel (ImageJ rank filter with radius 1, whose
+    circular kernel covers the full 3x3 square). Returns a new array.'''
+    height, width = image.shape[0], image.shape[1]
+    pad = ((1, 1), (1, 1)) + ((0, 0),) * (image.ndim - 2)
+    padded = np.pad(image, pad, mode='edge')
+    result = np.empty_like(image)
+    for row_start in range(0, height, strip_rows):
+        row_end = min(height, row_start + strip_rows)
+        p = [padded[row_start + dy:row_end + dy, dx:dx + width] for dy in range(3) for dx in range(3)]
+        for a, b in MEDIAN9_NETWORK:
+            p[a], p[b] = np.minimum(p[a], p[b]), np.maximum(p[a], p[b])
+        result[row_start:row_end] = p[4]
+    return result
+
+def medianReference(image):
+    '''Brute-force 3x3 median per channel, edges replicated: np.median over the
+    nine shifted copies of the frame. Slow and memory hungry; only for checking
+    median3x3.'''
+    height, width = image.shape[0], image.shape[1]
+    pad = ((1, 1), (1, 1)) + ((0, 0),) * (image.ndim - 2)
+    padded = np.pad(image, pad, mode='edge')
+    stack = np.stack([padded[dy:dy + height, dx:dx + width] for dy in range(3) for dx in range(3)])
+    return np.median(stack, axis=0).astype(image.dtype)
+
+def checkMedian(shape=(517, 389, 3), strip_rows=64, seed=0):
+    '''Compare median3x3 with medianReference on random frames: uniform noise,
+    and sparse bright specks on a dark background like a dark frame. The
+    default shape isn't a multiple of strip_rows, so strip edges and the last
+    partial strip are covered. Returns True iff every pixel matches.'''
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(0, 256, size=shape, dtype=np.uint8)
+    specks = np.where(rng.random(shape) < 0.02, 255, rng.integers(0, 8, size=shape)).astype(np.uint8)
+    return all(np.array_equal(median3x3(x, strip_rows), medianReference(x)) for x in [noise, specks])
+
+def removeOutliers(image, threshold=50, which='Bright', strip_rows=STRIP_ROWS):
+    '''ImageJ "Remove Outliers" with radius 1: replace a pixel by the median of
+    its 3x3 neighbourhood if it deviates from it by more than threshold, above
+    the median for which='Bright', below it for which='Dark'.'''
+    median = median3x3(image, strip_rows)
+    signed = image.astype(np.int16) - median.astype(np.int16)
+    if which == 'Bright':
+        outliers = signed > threshold
+    elif which == 'Dark':
+        outliers = signed < -threshold
+    else:
+        raise ValueError('which must be "Bright" or "Dark", not "' + str(which) + '"')
+    return np.where(outliers, median, image)
+
+def despeckle(image, strip_rows=STRIP_ROWS):
+    '''ImageJ "Despeckle", i.e. a radius 1 median filter.'''
+    return median3x3(image, strip_rows)
+
+def filterFrame(image, chain=FILTER_CHAIN):
+    '''Run the macro filter chain on an RGB uint8 array.'''
+    image = applyMinAndMax(image, chain['min'], chain['max'])
+    image = removeOutliers(image, chain['outlier_threshold'], 'Bright')
+    return despeckle(image)
+
+def loadFont(size):
+    '''Closest available match to ImageJ's SansSerif at the given size.'''
+    for name in ['DejaVuSans.ttf', 'LiberationSans-Regular.ttf', 'Arial.ttf']:
+        try:
+            return ImageFont.truetype(name, size)
+        except (IOError, OSError):
+            pass
+    return ImageFont.load_default(size)
+
+def drawLayout(image, layout, color=(255, 255, 255), offset=(0, 0)):
+    '''Draw a layout's ROI rectangles and labels onto a PIL image in place.
+
+    offset shifts everything by (dx, dy) pixels, e.g. to follow a frame
+    registration. As with run("Draw"), rectangle outlines are centred on the
+    ROI border; as with drawString, each label is placed by the left end of its
+    baseline, and further lines follow below it.
+    '''
+    draw = ImageDraw.Draw(image)
+    dx, dy = offset
+    line_width = layout.get('line_width', 1)
+    half = line_width // 2
+    for roi in layout['rois']:
+        x, y, w, h = roi['rect']
+        draw.rectangle([x + dx - half, y + dy - half, x + dx + w + half, y + dy + h + half], outline=color, width=line_width)
+    font = loadFont(layout['font_size'])
+    line_height = int(round(layout['font_size'] * 1.15))
+    for label in layout['labels']:
+        for i, line in enumerate(label['text'].split('\n')):
+            draw.text((label['x'] + dx, label['y'] + dy + i * line_height), line, fill=color, font=font, anchor='ls')
+    return image
+
+def drawTimestamp(image, text, font_size=140, color=(255, 255, 255)):
+    '''Draw a timestamp in the top right corner of a PIL image in place, where
+    image_processing_wrapper's ffmpeg drawtext overlay puts it.'''
+    draw = ImageDraw.Draw(image)
+    font = loadFont(font_size)
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    tw, th = right - left, bottom - top
+    draw.text((image.width - tw - tw / 8.0, th + th / 8.0), text, fill=color, font=font, anchor='lt')
+    return image
+
+def renderFrame(input_path, macro_name, timestamp=None, size=None, calibration_dir=None, transform=None):
+    '''Decode, filter and annotate one frame entirely in memory, for streaming
+    into a video encoder. size optionally rescales the result to (width,
+    height). transform aligns the layout as in processFile. Returns (width,
+    height, rgb24 bytes).'''
+    with Image.open(input_path) as source:
+        image = np.asarray(source.convert('RGB'))
+    image = calibration.calibrateFrame(image, calibration_dir, input_path)
+    image = Image.fromarray(filterFrame(image))
+    drawLayout(image, alignLayout(getLayout(macro_name), transform))
+    if size is not None and not image.size == tuple(size):
+        image = image.resize(tuple(size), Image.BILINEAR)
+    if timestamp:
+        drawTimestamp(image, timestamp)
+    return image.width, image.height, image.tobytes()
+
+def processFile(input_path, output_path, macro_name, calibration_dir=None, transform=None):
+    '''Filter and annotate one frame, as the macro of the same name does,
+    after subtracting its master dark if calibration_dir has a matching one
+    (see calibration). With a registration transform for the frame, the layout
+    is drawn where the subjects are in it. Returns output_path.'''
+    layout = getLayout(macro_name)
+    with Image.open(input_path) as source:
+        image = np.asarray(source.convert('RGB'))
+    image = calibration.calibrateFrame(image, calibration_dir, input_path)
+    image = Image.fromarray(filterFrame(image))
+    drawLayout(image, alignLayout(layout, transform))
+    image.save(output_path, 'JPEG', quality=JPEG_QUALITY)
+    return output_path
+
+def processFolder(input_dir, output_dir, macro_name, file_names=None, workers=None, calibration_dir=None, registration=None):
+    '''Batch equivalent of processFolder() in batch_macros.ijm: process every
+    file in input_dir (or just file_names) into output_dir as
+    'processed_<name>', in parallel over workers processes (default: one per
+    core). registration optionally maps file names to their transforms (see
+    frame_registration.registerSeries). Returns the output paths in input
+    order.'''
+    getLayout(macro_name) # fail early on an unknown layout
+    if file_names is None:
+        file_names = sorted(x for x in os.listdir(input_dir)
+                            if not os.path.isdir(os.path.join(input_dir, x)) and not isPreviewName(x))
+    inputs = [os.path.join(input_dir, x) for x in file_names]
+    outputs = [os.path.join(output_dir, 'processed_' + x) for x in file_names]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        transforms = [registration.get(x) if registration is not None else None for x in file_names]
+        return list(pool.map(processFile, inputs, outputs, [macro_name] * len(inputs), [calibration_dir] * len(inputs), transforms))
+
+def compareWithImageJ(numpy_dir, imagej_dir, tolerance=8):
+    '''Compare frames processed here against the ImageJ macro output for the
+    same inputs (matching file names). JPEG re-encoding means the two can't
+    match bit for bit, so report per file the max and mean absolute difference
+    and the fraction of pixel values differing by more than tolerance.
+
+    Returns {file name: (max_diff, mean_diff, fraction_over_tolerance)}.
+    '''
+    results = {}
+    for name in sorted(os.listdir(imagej_dir)):
+        ours_path = os.path.join(numpy_dir, name)
+        if not os.path.exists(ours_path):
+            continue
+        with Image.open(ours_path) as ours, Image.open(os.path.join(imagej_dir, name)) as theirs:
+            a = np.asarray(ours.convert('RGB')).astype(np.int16)
+            b = np.asarray(theirs.convert('RGB')).astype(np.int16)
+        if not a.shape == b.shape:
+            results[name] = (None, None, None)
+            continue
+        diff = np.abs(a - b)
+        results[name] = (int(diff.max()), float(diff.mean()), float((diff > tolerance).mean()))
+    return results
+
+def checkImageJParity(numpy_dir, imagej_dir, tolerance=8, max_fraction=0.01):
+    '''Check the output here against the ImageJ macro's (see
+    compareWithImageJ). A file passes if at most max_fraction of its pixel
+    values differ by more than tolerance. Returns (results, failed file
+    names); a file of a different size fails.'''
+    results = compareWithImageJ(numpy_dir, imagej_dir, tolerance)
+    failed = [name for name, (_, _, fraction) in sorted(results.items()) if fraction is None or fraction > max_fraction]
+    return results, failed
+
+if __name__ == "__main__":
+
+    # usage: python frame_processing.py check-median
+    #        python frame_processing.py check-imagej <numpy output dir> <imagej output dir> [tolerance] [max fraction]
+    # exits with status 1 if the check fails
+    if sys.argv[1] == 'check-median':
+        passed = checkMedian()
+        print('median3x3 ' + ('matches' if passed else 'DOES NOT match') + ' the brute-force reference')
+    elif sys.argv[1] == 'check-imagej':
+        tolerance = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+        max_fraction = float(sys.argv[5]) if len(sys.argv) > 5 else 0.01
+        results, failed = checkImageJParity(sys.argv[2], sys.argv[3], tolerance, max_fraction)
+        for name, (max_diff, mean_diff, fraction) in sorted(results.items()):
+            if fraction is None:
+                print(name + '\tsize differs' + '\tFAIL')
+            else:
+                print(name + '\tmax ' + str(max_diff) + '\tmean ' + '%.3f' % mean_diff + '\tover ' + str(tolerance) + ': ' +
+                      '%.4f' % fraction + ('\tFAIL' if name in failed else ''))
+        print(str(len(results)) + ' files compared, ' + str(len(failed)) + ' over ' + str(max_fraction) + ' of values off by more than ' +
+              str(tolerance))
+        passed = len(results) > 0 and len(failed) == 0
+    else:
+        raise ValueError('unknown check "' + sys.argv[1] + '"; use check-median or check-imagej')
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,262 @@
+'''
+Frame registration for long image series.
+
+The ROIs and labels of a layout (see roi_layouts) are fixed pixel positions,
+but over a multi-day run plants grow, plates get bumped and the camera creeps,
+so the subjects drift out of their boxes. This module estimates, for every
+frame of a series, how the scene moved relative to a reference light frame, so
+ROIs and overlays can follow it.
+
+Translation is found by phase correlation: the normalized cross-power spectrum
+of two images transforms back to a sharp peak at their relative shift. With
+rotation=True, a small rotation is found first, by phase correlation of the
+log-polar resampled magnitude spectra (which a translation leaves unchanged
+and a rotation shifts along the angle axis), and undone before the
+translation is measured.
+
+Frames are registered at 1/REGISTRATION_SCALE resolution, decoded that small
+straight from the JPEG (PIL draft mode), with sub-pixel peak interpolation, so
+a 24 MP frame takes a few tens of milliseconds and is placed to within a pixel
+or two at full resolution. Light frames are registered against the reference;
+each dark frame, whose luminescence alone is too sparse to register, takes the
+transform of its light frame (the one with the same timestamp, or else the
+latest one before it). Transforms can be cached per series in
+REGISTRATION_FILENAME, next to the processed output, so the raw image folder is
+never written to.
+
+A transform is a dict with dx, dy (pixels), angle (degrees, clockwise as
+displayed) and center; a point (x, y) of the reference appears in the frame at
+transformPoint(transform, x, y). response is the height of the correlation
+peak (1 for a perfect match), a confidence measure.
+
+'''
+
+import json
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from frame_names import parseFrameName
+
+REGISTRATION_SCALE = 8
+REGISTRATION_FILENAME = 'registration.json'
+LOG_POLAR_ANGLES = 720 # rows over 180 degrees, i.e. 0.25 degree steps before interpolation
+
+def loadReduced(path, scale=REGISTRATION_SCALE):
+    '''Grayscale frame at 1/scale resolution, as float32. Returns (image,
+    full-resolution (width, height)).'''
+    with Image.open(path) as source:
+        full_size = source.size
+        size = (max(1, full_size[0] // scale), max(1, full_size[1] // scale))
+        source.draft('L', size)
+        image = source.convert('L')
+    if not image.size == size:
+        image = image.resize(size, Image.BILINEAR)
+    return np.asarray(image, dtype=np.float32), full_size
+
+def _window(shape):
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+
+def _peak(correlation):
+    '''Sub-pixel (row, column) of the maximum of a cyclic correlation surface,
+    wrapped to [-n/2, n/2), and its height.'''
+    rows, columns = correlation.shape
+    row, column = np.unravel_index(np.argmax(correlation), correlation.shape)
+    offsets = []
+    for position, size, neighbours in [(row, rows, (correlation[(row - 1) % rows, column], correlation[(row + 1) % rows, column])),
+                                       (column, columns, (correlation[row, (column - 1) % columns], correlation[row, (column + 1) % columns]))]:
+        before, after = neighbours
+        curvature = before - 2 * correlation[row, column] + after
+        fraction = 0.5 * (before - after) / curvature if curvature < 0 else 0.0
+        offset = position + fraction
+        if offset >= size / 2.0:
+            offset -= size
+        offsets.append(offset)
+    return offsets[0], offsets[1], float(correlation[row, column])
+
+def phaseCorrelation(reference, moving, window=True):
+    '''Shift (dy, dx) of moving relative to reference, i.e. moving(p) ~
+    reference(p - shift), and the correlation peak height.'''
+    if window:
+        weights = _window(reference.shape)
+        reference = (reference - reference.mean()) * weights
+        moving = (moving - moving.mean()) * weights
+    cross_power = np.fft.fft2(moving) * np.conj(np.fft.fft2(reference))
+    cross_power /= np.abs(cross_power) + 1e-12
+    return _peak(np.fft.ifft2(cross_power).real)
+
+def _logPolarSpectrum(image):
+    '''High-pass filtered log magnitude spectrum of a square image, resampled
+    to log-polar coordinates: LOG_POLAR_ANGLES rows over 180 degrees, by
+    log radius.'''
+    size = image.shape[0]
+    magnitude = np.fft.fftshift(np.abs(np.fft.fft2((image - image.mean()) * _window(image.shape))))
+    frequencies = np.fft.fftshift(np.fft.fftfreq(size))
+    x = np.cos(np.pi * frequencies)
+    emphasis = 1 - np.outer(x, x)
+    magnitude = np.log1p(magnitude) * emphasis * (2 - emphasis)
+    center = size // 2
+    radii = np.exp(np.linspace(0, np.log(center - 1), size // 2))
+    angles = np.linspace(0, np.pi, LOG_POLAR_ANGLES, endpoint=False)
+    ys = center + np.sin(angles)[:, None] * radii[None, :]
+    xs = center + np.cos(angles)[:, None] * radii[None, :]
+    # bilinear sampling
+    y0 = np.clip(np.floor(ys).astype(np.int64), 0, size - 2)
+    x0 = np.clip(np.floor(xs).astype(np.int64), 0, size - 2)
+    fy, fx = ys - y0, xs - x0
+    return (magnitude[y0, x0] * (1 - fy) * (1 - fx) + magnitude[y0 + 1, x0] * fy * (1 - fx) +
+            magnitude[y0, x0 + 1] * (1 - fy) * fx + magnitude[y0 + 1, x0 + 1] * fy * fx)
+
+def _centerSquare(image):
+    side = min(image.shape)
+    top, left = (image.shape[0] - side) // 2, (image.shape[1] - side) // 2
+    return image[top:top + side, left:left + side]
+
+def estimateRotation(reference, moving):
+    '''Rotation of moving relative to reference, in degrees clockwise as
+    displayed, within +-90. Translation doesn't affect it.'''
+    shift, _, response = phaseCorrelation(_logPolarSpectrum(_centerSquare(reference)), _logPolarSpectrum(_centerSquare(moving)), window=False)
+    return shift * 180.0 / LOG_POLAR_ANGLES, response
+
+def registerImages(reference, moving, rotation=False):
+    '''Transform (at the resolution of the arrays) taking reference to moving:
+    dict with dx, dy, angle and response; see transformPoint.'''
+    angle = 0.0
+    if rotation:
+        angle, _ = estimateRotation(reference, moving)
+        # turn moving back by angle; PIL angles are counterclockwise as displayed
+        moving = np.asarray(Image.fromarray(moving).rotate(angle, resample=Image.BILINEAR), dtype=np.float32)
+    ty, tx, response = phaseCorrelation(reference, moving)
+    # the shift was measured in the derotated frame; rotate it into the frame
+    a = math.radians(angle)
+    dx = math.cos(a) * tx - math.sin(a) * ty
+    dy = math.sin(a) * tx + math.cos(a) * ty
+    return {'dx': dx, 'dy': dy, 'angle': angle, 'response': response}
+
+def transformPoint(transform, x, y):
+    '''Where the reference point (x, y) appears in the registered frame.'''
+    cx, cy = transform['center']
+    a = math.radians(transform['angle'])
+    x0, y0 = x - cx, y - cy
+    return (cx + math.cos(a) * x0 - math.sin(a) * y0 + transform['dx'],
+            cy + math.sin(a) * x0 + math.cos(a) * y0 + transform['dy'])
+
+def alignRect(rect, transform):
+    '''Move an (x, y, width, height) rectangle along with the frame. The
+    rectangle follows its center and stays axis aligned, which for the small
+    rotations of a bumped plate costs at most a few pixels at its corners.'''
+    x, y, w, h = rect
+    cx, cy = transformPoint(transform, x + w / 2.0, y + h / 2.0)
+    return (int(round(cx - w / 2.0)), int(round(cy - h / 2.0)), w, h)
+
+def alignRois(rois, transform):
+    '''Copies of the ROI dicts with their rects aligned to a frame; the ROIs
+    themselves if transform is None.'''
+    if transform is None:
+        return rois
+    return [dict(roi, rect=alignRect(roi['rect'], transform)) for roi in rois]
+
+def alignLayout(layout, transform):
+    '''Copy of a layout (see roi_layouts) with ROIs and labels aligned to a
+    frame, for drawLayout; the layout itself if transform is None.'''
+    if transform is None:
+        return layout
+    labels = []
+    for label in layout['labels']:
+        x, y = transformPoint(transform, label['x'], label['y'])
+        labels.append(dict(label, x=int(round(x)), y=int(round(y))))
+    return dict(layout, rois=alignRois(layout['rois'], transform), labels=labels)
+
+def registerFrame(path, reference, full_size, scale=REGISTRATION_SCALE, rotation=False):
+    '''Transform of one frame against a reduced reference (see loadReduced),
+    in full-resolution pixels.'''
+    moving, size = loadReduced(path, scale)
+    if not moving.shape == reference.shape:
+        raise ValueError(os.path.basename(path) + ' is ' + str(size) + ', the reference frame is ' + str(full_size))
+    transform = registerImages(reference, moving, rotation)
+    factor_x, factor_y = float(size[0]) / moving.shape[1], float(size[1]) / moving.shape[0]
+    transform['dx'] *= factor_x
+    transform['dy'] *= factor_y
+    transform['center'] = [size[0] / 2.0, size[1] / 2.0]
+    return transform
+
+def _identity(full_size):
+    return {'dx': 0.0, 'dy': 0.0, 'angle': 0.0, 'response': 1.0, 'center': [full_size[0] / 2.0, full_size[1] / 2.0]}
+
+def _loadCache(path, settings):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        cache = json.load(f)
+    if not cache.get('settings') == settings:
+        return {}
+    return cache['frames']
+
+def _saveCache(path, settings, frames):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'settings': settings, 'frames': frames}, f, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+def registerSeries(input_dir, file_names=None, reference=None, rotation=False, scale=REGISTRATION_SCALE, workers=None,
+                   cache_dir=None):
+    '''Register every frame of a series. Returns {file name: transform}.
+
+    file_names defaults to every frame in input_dir that follows the capture
+    naming convention. Light frames are registered against reference (default:
+    the first light frame); dark frames take the transform of their light frame.
+    If the series has no light frames, all frames are registered directly.
+    With cache_dir (e.g. the processed output folder of the series), light
+    frame transforms are cached there and only new frames are registered on
+    later calls, unless the reference or settings change.
+    '''
+    if file_names is None:
+        file_names = [x for x in sorted(os.listdir(input_dir)) if parseFrameName(x) is not None]
+    infos = dict((x, parseFrameName(x) or {}) for x in file_names)
+    registered = [x for x in file_names if infos[x].get('tag') == 'light'] or list(file_names)
+    if len(registered) == 0:
+        return {}
+    if reference is None:
+        reference = registered[0]
+    settings = {'reference': reference, 'scale': scale, 'rotation': rotation}
+    cache_path = os.path.join(cache_dir, REGISTRATION_FILENAME) if cache_dir is not None else None
+    frames = _loadCache(cache_path, settings) if cache_path is not None else {}
+    todo = [x for x in registered if not x in frames]
+    if len(todo) > 0:
+        reference_image, full_size = loadReduced(os.path.join(input_dir, reference), scale)
+        paths = [os.path.join(input_dir, x) for x in todo]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for name, transform in zip(todo, pool.map(registerFrame, paths, [reference_image] * len(paths), [full_size] * len(paths),
+                                                       [scale] * len(paths), [rotation] * len(paths), chunksize=4)):
+                frames[name] = transform
+        frames[reference] = _identity(full_size)
+        if cache_path is not None:
+            _saveCache(cache_path, settings, frames)
+
+    transforms = dict((x, frames[x]) for x in registered)
+    # dark frames follow the light frame of the same cycle, or the latest before
+    lights = sorted((infos[x]['datetime'], x) for x in registered if 'datetime' in infos[x])
+    for x in file_names:
+        if x in transforms:
+            continue
+        when = infos[x].get('datetime')
+        earlier = [name for taken, name in lights if when is not None and taken <= when]
+        if len(earlier) > 0:
+            transforms[x] = dict(frames[earlier[-1]], source=earlier[-1])
+        elif len(lights) > 0:
+            transforms[x] = dict(frames[lights[0][1]], source=lights[0][1])
+    return transforms
+
+if __name__ == "__main__":
+
+    # usage: python frame_registration.py <image dir> [cache dir] [--rotation]
+    args = [x for x in sys.argv[1:] if not x == '--rotation']
+    input_dir = args[0]
+    cache_dir = args[1] if len(args) > 1 else None
+    transforms = registerSeries(input_dir, rotation='--rotation' in sys.argv[2:], cache_dir=cache_dir)
+    for name, transform in sorted(transforms.items()):
+        print('%s dx=%.1f dy=%.1f angle=%.2f response=%.2f' % (name, transform['dx'], transform['dy'], transform['angle'], transform['response']))
@@ -0,0 +1,183 @@
+'''
+Chunked, memory-mapped array store for timelapse series.
+
+Ingesting a batch directory (images/<subject>_<timestamp>, as created by
+gphoto_capture_control) decodes every JPEG once into uncompressed uint8 arrays,
+so later stages can read any time window and ROI without decoding whole frames
+again. Light and dark frames go into separate stores, since they are analysed
+separately:
+
+    <store_dir>/light/index.json
+    <store_dir>/light/chunk-0000.npy    (chunk_frames, height, width, channels)
+    <store_dir>/dark/...
+
+Frames are grouped along time into chunk files of chunk_frames frames each.
+Within a chunk, frames are stored row-major, so a (time range, ROI) read from
+one chunk is a strided view onto the memory map: no copy, and only the pages
+holding the ROI's rows are touched. Reads that span several chunks come back
+per chunk (FrameStore.slices), or concatenated into one array (FrameStore.read).
+
+The index holds each frame's capture metadata, parsed from its file name (see
+frame_names), in time order.
+
+Stored uncompressed, a 6000x4000 RGB frame takes 72 MB, several times its JPEG.
+
+'''
+
+import bisect
+import datetime
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from frame_names import parseFrameName
+
+INDEX_FILENAME = 'index.json'
+
+# frames per chunk file; a time window reads at most two partial chunks
+CHUNK_FRAMES = 32
+
+class FrameStore(object):
+    '''One store of same-sized frames, in capture time order.'''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_FILENAME)) as f:
+            self.index = json.load(f)
+        self.shape = tuple(self.index['shape'])
+        self.chunk_frames = self.index['chunk_frames']
+        self.times = [datetime.datetime.strptime(x['datetime'], '%Y-%m-%d_%H:%M:%S') for x in self.index['frames']]
+        self.chunks = {}
+
+    @classmethod
+    def create(cls, store_dir, shape, chunk_frames=CHUNK_FRAMES):
+        '''Create an empty store for frames of the given (height, width,
+        channels) shape.'''
+        os.makedirs(store_dir, exist_ok=True)
+        index = {'shape': list(shape), 'dtype': 'uint8', 'chunk_frames': chunk_frames, 'frames': []}
+        with open(os.path.join(store_dir, INDEX_FILENAME), 'w') as f:
+            json.dump(index, f)
+        return cls(store_dir)
+
+    def __len__(self):
+        return len(self.index['frames'])
+
+    def frames(self):
+        '''Metadata of every frame, in time order.'''
+        return self.index['frames']
+
+    def _chunk(self, chunk, mode='r'):
+        path = os.path.join(self.store_dir, 'chunk-%04d.npy' % chunk)
+        if mode == 'w+':
+            self.chunks[chunk] = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(self.chunk_frames,) + self.shape)
+        elif not chunk in self.chunks:
+            self.chunks[chunk] = np.load(path, mmap_mode=mode)
+        return self.chunks[chunk]
+
+    def append(self, image, info, file_name):
+        '''Add a frame after the last one; frames must be appended in time
+        order. Call save() to commit the index.'''
+        if not image.shape == self.shape:
+            raise ValueError(file_name + ' is ' + str(image.shape) + ', store holds ' + str(self.shape))
+        if len(self.times) > 0 and info['datetime'] < self.times[-1]:
+            raise ValueError(file_name + ' is older than the last frame in the store')
+        chunk, offset = divmod(len(self), self.chunk_frames)
+        if offset == 0:
+            data = self._chunk(chunk, 'w+')
+        else:
+            if chunk in self.chunks and not self.chunks[chunk].flags.writeable:
+                del self.chunks[chunk]
+            data = self._chunk(chunk, 'r+')
+        data[offset] = image
+        entry = dict(info, datetime=info['datetime'].strftime('%Y-%m-%d_%H:%M:%S'), file=file_name)
+        self.index['frames'].append(entry)
+        self.times.append(info['datetime'])
+
+    def save(self):
+        for data in self.chunks.values():
+            if data.flags.writeable:
+                data.flush()
+        temp_path = os.path.join(self.store_dir, INDEX_FILENAME + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temp_path, os.path.join(self.store_dir, INDEX_FILENAME))
+
+    def frameRange(self, start=None, end=None):
+        '''(first, last + 1) frame indices captured in [start, end); either
+        bound may be None for open-ended.'''
+        first = 0 if start is None else bisect.bisect_left(self.times, start)
+        stop = len(self) if end is None else bisect.bisect_left(self.times, end)
+        return first, max(first, stop)
+
+    def slices(self, start=None, end=None, roi=None):
+        '''Yield (frame metadata list, array) per chunk for the frames captured
+        in [start, end), each array a zero-copy view of shape (frames, height,
+        width, channels), cropped to roi = (x, y, width, height) if given.'''
+        first, stop = self.frameRange(start, end)
+        if roi is None:
+            rows, columns = slice(None), slice(None)
+        else:
+            x, y, w, h = roi
+            rows, columns = slice(y, y + h), slice(x, x + w)
+        while first < stop:
+            chunk, offset = divmod(first, self.chunk_frames)
+            count = min(stop - first, self.chunk_frames - offset)
+            yield self.index['frames'][first:first + count], self._chunk(chunk)[offset:offset + count, rows, columns]
+            first += count
+
+    def read(self, start=None, end=None, roi=None):
+        '''(frame metadata list, array) for the frames in [start, end), cropped
+        to roi. The array is a view when the frames lie in one chunk, and a
+        concatenated copy otherwise.'''
+        parts = list(self.slices(start, end, roi))
+        if len(parts) == 0:
+            return [], np.empty((0,) + self.shape, dtype=np.uint8)
+        if len(parts) == 1:
+            return parts[0]
+        return [x for frames, _ in parts for x in frames], np.concatenate([data for _, data in parts])
+
+def _decode(path):
+    with Image.open(path) as source:
+        return np.asarray(source.convert('RGB'))
+
+def ingestSeries(batch_dir, store_dir, chunk_frames=CHUNK_FRAMES, workers=4):
+    '''Ingest the frames of a batch directory into <store_dir>/light and
+    <store_dir>/dark, skipping frames already ingested, so it can be rerun as a
+    series grows. Returns {tag: FrameStore}.'''
+    by_tag = {}
+    for x in sorted(os.listdir(batch_dir)):
+        info = parseFrameName(x)
+        if info is not None:
+            by_tag.setdefault(info['tag'], []).append((info['datetime'], x, info))
+
+    stores = {}
+    for tag, entries in sorted(by_tag.items()):
+        entries.sort()
+        tag_dir = os.path.join(store_dir, tag)
+        store = FrameStore(tag_dir) if os.path.exists(os.path.join(tag_dir, INDEX_FILENAME)) else None
+        done = set() if store is None else set(x['file'] for x in store.frames())
+        entries = [entry for entry in entries if not entry[1] in done]
+        print(tag + ': ingesting ' + str(len(entries)) + ' new frame(s)')
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # decode a few frames ahead while the previous ones are written
+            for batch_start in range(0, len(entries), workers):
+                batch = entries[batch_start:batch_start + workers]
+                images = pool.map(_decode, [os.path.join(batch_dir, x) for _, x, _ in batch])
+                for (_, x, info), image in zip(batch, images):
+                    if store is None:
+                        store = FrameStore.create(tag_dir, image.shape, chunk_frames)
+                    store.append(image, info, x)
+        if store is not None:
+            store.save()
+            stores[tag] = store
+    return stores
+
+if __name__ == "__main__":
+
+    # usage: python frame_store.py <batch dir> <store dir>
+    for tag, store in ingestSeries(sys.argv[1], sys.argv[2]).items():
+        print(tag + ': ' + str(len(store)) + ' frame(s) in ' + store.store_dir)
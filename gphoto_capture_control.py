@@ -9,53 +9,45 @@ Version: 1.0 (October 6, 2019)
 '''
 
 import logging
-import RPi.GPIO as GPIO
-import os, subprocess, sys, time
+import contextlib, os, subprocess, sys, threading, time
 
-def verifyCameraConnect(logger):
-    '''Return boolean readout for whether camera is attached.
-    
-    Implementation is based on a string search for the camera name using the
-    gphoto2 --auto-detect command. If using a different camera, this hardcoded
-    search value must be modified. 
-    
-    NOTE: this may not be the best way to verify camera connection, since I
-    have observed that sometimes the camera still remains visible to the auto-
-    detect call, even after being powered off. A better implementation might
-    therefore be to perform some trivial ping that requires camera response...
-    
-    Furthermore it seems that powering off the camera doesn't remove it from the
-    auto-detect list, but unplugging the USB cable after powering it off does.
-    When I plug the USB back in, it does not become visible, until/unless I
-    power the camera on again...
-    '''
-    
-    verified = False
-    
-    logger.debug('Verifying gPhoto2 and camera interface')
-    verify_camera_connect_cmdstr = 'gphoto2 --auto-detect'
-    logger.debug('    Autodetecting camera...')
-    output = subprocess.run(verify_camera_connect_cmdstr, shell=True, stdout=subprocess.PIPE).stdout.decode('utf-8')
-    for row in output.split('\n'):
-        if 'Canon EOS 80D' in row:
-            verified = True
-    if not verified:
-        logger.debug('    WARNING: camera NOT found!')
-    else:
-        logger.debug('    Found: Canon EOS 80D')
-        
-    return verified
+from camera_session import CameraError, CameraSession, CameraSettings
+from capture_backends import GPIORelayBackend
+from capture_metrics import CaptureMetrics, getMetrics, setMetrics
+from capture_pipeline import CapturePipeline
+from capture_scheduler import CycleScheduler
+from cycle_planner import CYCLE_MARGIN, LIGHTS_WARMUP, compilePlan, describePlan, frameTag, optionalPhaseConfKeys, parsePhases, phaseConfKeys
+from startup_probe import probeStartup, verifyCameraModel
 
-def verifyBulbMode(logger):
+# these text files should be placed in the same directory as the script
+APERTURE_DICT_FILENAME = '/home/pi/pipeline/80D_aperture_dict'
+ISO_DICT_FILENAME = '/home/pi/pipeline/80D_iso_dict'
+
+def verifyBulbMode(logger, session=None, snapshot=None):
     '''Return boolean readout for whether camera is set to bulb mode.
     
     Implementation is based on the fact that the only shutterspeed option
     available under bulb mode is 'bulb', and this is visible as the current
     setting.
+    
+    If an open CameraSession is given, the setting is read over it (the CLI
+    can't reach a camera that a session has claimed). If a config snapshot
+    (CameraSession.getConfigSnapshot) is given, no camera access is needed.
     '''
     
     verified = False
     
+    if snapshot is not None or session is not None:
+        if snapshot is not None:
+            current = snapshot.get('shutterspeed')
+        else:
+            current = session.getConfig('shutterspeed')
+        if current == 'bulb':
+            logger.debug('Bulb mode verified')
+            return True
+        logger.debug('Camera is NOT in bulb mode! Please fix before using program')
+        return False
+    
     check_shutterspeed_set_cmdstr = 'gphoto2 --get-config shutterspeed'
     output = subprocess.run(check_shutterspeed_set_cmdstr, shell=True, stdout=subprocess.PIPE).stdout.decode('utf-8')
     for row in list(map(lambda x: x.strip(), output.split('\n'))):
@@ -68,78 +60,138 @@ def verifyBulbMode(logger):
                     logger.debug('Camera is NOT in bulb mode! Please fix before using program')
     return verified
 
-def killMonitorProcess(logger):
-    '''Kill troublesome gphoto2 processes to enable camera control.
-    
-    There is/are some background process(es) spawned by gphoto2 that block most
-    camera control commands from being executed. I've tried a few different ways
-    to circumvent this issue, but the most thorough way is to do a kill for all
-    processes with 'gvfs' in the name.
-    
-    The process will be running by default even if a camera is not connected.
-    
-    Note: consider a routine to verify obstruction prior to killing processes,
-    because it's not always necessary (e.g. if this has already been called).
-    The same routine would be a good verification for access release once this
-    function is called.
-    '''
-    
-    logger.debug('    Killing monitor process to permit camera control access...')
-    
-    # Strategy 1: identify obstructing process by PID matching for
-    # 'gvfs-gphoto2-volume-monitor process'. Turns out this doesn't always work,
-    # possibly because child processes are spawned by this parent...
-    
-#     find_monitor_proc_ids_cmdstr = "ps aux | grep 'gvfs-gphoto2-volume-monitor' | awk '{print $2}'"
-#     output = subprocess.run(find_monitor_proc_ids_cmdstr, shell=True, stdout=subprocess.PIPE).stdout.decode('utf-8')
-#     pid = -1
-#     for row in list(map(lambda x: x.strip(), output.split('\n'))):
-#         if not len(row) == 0:
-#             #print('$' + row)
-#             proc_lookup = subprocess.run(['ps','-p',row], stdout=subprocess.PIPE).stdout.decode('utf-8')
-#             for line in list(map(lambda x: x.strip(), proc_lookup.split('\n'))):
-#                 #print('#' + line)
-#                 if not len(line) == 0 and not "PID" in line:
-#                     pid = line[:line.find(' ')]
-#                     subprocess.run(['kill',pid], stdout=subprocess.PIPE).stdout.decode('utf-8')
-#                     logger.debug('    Killed monitor parent process (PID = ' + pid + ')')
-#     if pid == -1:
-#         logger.debug('    No monitor process found.')
-    
-    # Strategy 2: child processes have rapidly varying PIDs, such that a serial
-    # procedure to first search for PIDs then kill them fails to get them all.
-    # This is the brute force method, killing all procs with a 'gvfs' string
-    # match in a single bash call.
-    find_monitor_proc_ids_cmdstr = "ps aux | grep 'gvfs' | awk '{print $2}'"
-    output = subprocess.run(find_monitor_proc_ids_cmdstr, shell=True, stdout=subprocess.PIPE).stdout.decode('utf-8')
-    pid = -1
-    for row in list(map(lambda x: x.strip(), output.split('\n'))):
-        if not len(row) == 0:
-            #print('$' + row)
-            proc_lookup = subprocess.run(['ps','-p',row], stdout=subprocess.PIPE).stdout.decode('utf-8')
-            for line in list(map(lambda x: x.strip(), proc_lookup.split('\n'))):
-                #print('#' + line)
-                if not len(line) == 0 and not "PID" in line:
-                    pid = line[:line.find(' ')]
-                    subprocess.run(['kill',pid], stdout=subprocess.PIPE).stdout.decode('utf-8')
-                    logger.debug('    Killed monitor parent process (PID = ' + pid + ')')
-    if pid == -1:
-        logger.debug('    No monitor process found.')
-    return
-
-def initRelayControl(logger):
+def initRelayControl(logger, pins=(2,)):
     '''Setup code for the power relay(s), default OFF.
+    
+    pins -- BCM numbers of the relay channels in use
     '''
     logger.debug('Initializing GPIO relay control...')
-    GPIO.setwarnings(False) #turn off warnings
-    GPIO.cleanup() # reset any previous settings that may have been run
-    GPIO.setmode(GPIO.BCM) # control pins by BCM number, NOT native Pi number
-    GPIO.setup(2, GPIO.OUT, initial=GPIO.LOW) # setup channel for BCM pin #2 with relay initially off
+    getRelayBackend().setup(pins)
+    for pin in pins:
+        getRelay(pin).state = False
     time.sleep(2) # buffer time for switch to actuate
     logger.debug('...done')
     
     return True
 
+class RelayControl(object):
+    '''One relay channel (lights), shared by every capture loop that drives
+    the same BCM pin.
+    
+    Exposures take a hold() on the state they need for their duration. Holds
+    on the same state can overlap, but a hold on the opposite state waits until
+    they are all released, so a light frame on one camera can never overlap a
+    dark frame on another camera behind the same relay. set() only changes the
+    state the relay rests in while nobody holds it (e.g. lights on to warm up
+    between frames); it takes effect once conflicting holds are released.
+    '''
+    
+    def __init__(self, pin):
+        self.pin = pin # BCM number
+        self.state = None # unknown until first written
+        self.idle_state = False
+        self.switched_at = time.monotonic()
+        self.holders = {True: 0, False: 0}
+        self.changed = threading.Condition()
+    
+    def _write(self, state):
+        if state != self.state:
+            with getMetrics().span('relay_switch', pin=self.pin, state=state):
+                getRelayBackend().output(self.pin, state)
+            self.state = state
+            self.switched_at = time.monotonic()
+    
+    def set(self, state):
+        '''Set the resting state of the relay (True = on).'''
+        with self.changed:
+            self.idle_state = state
+            if self.holders[not state] == 0:
+                self._write(state)
+    
+    @contextlib.contextmanager
+    def hold(self, state, warmup=0):
+        '''Keep the relay in state for the duration of the with block, waiting
+        first for conflicting holds to end. If the relay had to be switched,
+        wait until it has been in state for warmup seconds.'''
+        with self.changed:
+            while self.holders[not state] > 0:
+                self.changed.wait()
+            self._write(state)
+            self.holders[state] += 1
+            ready_at = self.switched_at + warmup
+        try:
+            remaining = ready_at - time.monotonic()
+            if remaining > 0:
+                with getMetrics().span('lights_warmup', pin=self.pin):
+                    time.sleep(remaining) # time for bulb to come up to temp
+            yield
+        finally:
+            with self.changed:
+                self.holders[state] -= 1
+                if self.holders[state] == 0:
+                    self._write(self.idle_state)
+                    self.changed.notify_all()
+
+_relays = {}
+_relays_lock = threading.Lock()
+_relay_backend = None
+
+def setRelayBackend(backend):
+    '''Select the hardware behind every RelayControl, e.g. a
+    capture_backends.SimulatedRelayBackend to run off the Pi.'''
+    global _relay_backend
+    _relay_backend = backend
+
+def getRelayBackend():
+    '''Return the relay backend in use (GPIO unless set otherwise).'''
+    global _relay_backend
+    if _relay_backend is None:
+        _relay_backend = GPIORelayBackend()
+    return _relay_backend
+
+def getRelay(pin=2):
+    '''Return the RelayControl for a BCM pin; the same object is shared by
+    every caller using that pin.'''
+    with _relays_lock:
+        if not pin in _relays:
+            _relays[pin] = RelayControl(pin)
+        return _relays[pin]
+
+def parseConfFile(filename):
+    '''Return the key-value pairs of a config file as a dict, in file order.
+    See readConfFile for the format.'''
+    with open(filename) as f:
+        lines = list(map(lambda x: x.strip(), f.readlines()))
+    conf = {}
+    for line in lines:
+        if '#' in line:
+            line = line[:line.find('#')]
+        if line.strip() == '':
+            continue
+        key, value = list(map(lambda x: x.strip(), line.split('=')))
+        conf[key] = value
+    return conf
+
+# config keys any profile may set, on top of its required ones:
+#   live_rois -- roi_layouts layout to quantify live during series (see live_quantification)
+#   live_file -- file name for the live results in the batch directory
+#   adaptive_exposures -- comma-separated dark exposure times (s) to choose from
+#                         each cycle instead of the fixed one (see adaptive_exposure)
+#   adaptive_target -- 8-bit signal level to aim dark frames at (default 180)
+#   adaptive_max_iso -- highest ISO adaptive exposure may use (default 1600)
+OPTIONAL_CONF_KEYS = ['live_rois', 'live_file', 'adaptive_exposures', 'adaptive_target', 'adaptive_max_iso']
+
+# config keys each capture profile requires; a 'cycle' profile also requires
+# the keys of each of its phases (see cycle_planner)
+REQUIRED_CONF_KEYS = {
+    'single': ['subject', 'aperture', 'iso', 'lights', 'shutterspeed'],
+    'series': ['subject', 'interval', 'duration', 'aperture', 'iso', 'lights', 'shutterspeed'],
+    'dual_series': ['subject', 'interval', 'duration', 'aperture_light', 'aperture_dark', 'iso_light', 'iso_dark',
+                    'shutterspeed_light', 'shutterspeed_dark'],
+    'cycle': ['subject', 'interval', 'duration', 'phases'],
+}
+CAPTURE_PROFILES = ['single', 'series', 'dual_series', 'cycle']
+
 def readConfFile(filename, capture_profile='single'):
     '''Parse capture options from configuration file.
     
@@ -153,37 +205,29 @@ def readConfFile(filename, capture_profile='single'):
     only the required parameters; argument validity is to be handled downstream.
     
     filename -- full path to config file
-    capture_profile -- ['single', 'series', 'dual_series'] are currently permissable options
+    capture_profile -- one of CAPTURE_PROFILES
     lights -- ['on', 'off'] are permissable options
+    
+    The keys each profile requires are listed in REQUIRED_CONF_KEYS; keys in
+    OPTIONAL_CONF_KEYS may be added to any profile. The 'cycle' profile takes
+    an ordered list of phases instead of fixed keys (see cycle_planner).
     '''
     
-    with open(filename) as f:
-        lines = list(map(lambda x: x.strip(), f.readlines()))
-    conf = {}
-    for line in lines:
-        if line.strip() == '':
-            continue
-        if '#' in line:
-            line = line[:line.find('#')]
-        key, value = list(map(lambda x: x.strip(), line.split('=')))
-        conf[key] = value
-    if capture_profile == 'single':
-        if not len(conf) == 5:
-            print('Mismatch between number of required and specified configurable parameters!')
-        if not sorted(conf.keys()) == ['aperture', 'iso', 'lights', 'shutterspeed', 'subject']:
-            print('Missing a required configurable parameter!')
-    elif capture_profile == 'series':
-        if not len(conf) == 7:
-            print('Mismatch between number of required and specified configurable parameters!')
-        if not sorted(conf.keys()) == ['aperture', 'duration', 'interval', 'iso', 'shutterspeed', 'subject', 'lights']:
-            print('Missing a required configurable parameter!')
-    elif capture_profile == 'dual_series':
-        if not len(conf) == 9:
-            print('Mismatch between number of required and specified configurable parameters!')
-        if not sorted(conf.keys()) == ['aperture_dark', 'aperture_light', 'duration', 'interval', 'iso_dark', 'iso_light', 'shutterspeed_dark', 'shutterspeed_light', 'subject']:
-            print('Missing a required configurable parameter!')
-    else:
-        print('Unreachable code!')
+    conf = parseConfFile(filename)
+    if not capture_profile in REQUIRED_CONF_KEYS:
+        print('Unknown capture profile "' + str(capture_profile) + '"!')
+        return conf
+    required = REQUIRED_CONF_KEYS[capture_profile]
+    allowed = required + OPTIONAL_CONF_KEYS
+    if capture_profile == 'cycle':
+        required = required + phaseConfKeys(conf)
+        allowed = required + OPTIONAL_CONF_KEYS + optionalPhaseConfKeys(conf)
+    missing = [key for key in required if not key in conf]
+    unknown = [key for key in conf if not key in allowed]
+    if len(missing) > 0:
+        print('Missing a required configurable parameter: ' + ', '.join(missing))
+    if len(unknown) > 0:
+        print('Unknown configurable parameter for the ' + capture_profile + ' profile: ' + ', '.join(unknown))
     return conf
 
 def loadconfigurableParameterDicts(aperture_dict_filename, iso_dict_filename):
@@ -212,7 +256,19 @@ def loadconfigurableParameterDicts(aperture_dict_filename, iso_dict_filename):
                 iso_dict[line.split('\t')[0]] = line.split('\t')[1].strip()
     return aperture_dict, iso_dict
 
-def setParameterByValue(logger, setting, value):
+def openCameraSettings(logger, session, aperture_dict_filename=APERTURE_DICT_FILENAME, iso_dict_filename=ISO_DICT_FILENAME, snapshot=None):
+    '''Load the parameter value tables once and return a CameraSettings cache
+    bound to the given session. Keep the returned object for the whole run so
+    that unchanged settings are not rewritten every cycle. A config snapshot
+    taken at startup seeds the cache with the camera's current state.
+    '''
+    aperture_dict, iso_dict = loadconfigurableParameterDicts(aperture_dict_filename, iso_dict_filename)
+    settings = CameraSettings(logger, session, {'aperture': aperture_dict.values(), 'iso': iso_dict.values()})
+    if snapshot is not None:
+        settings.seed(snapshot)
+    return settings
+
+def setParameterByValue(logger, setting, value, settings):
     '''Change a configurable camera setting to a specified value by value, and
     verify that setting was accepted. Return True iff parameter is successfully
     verified.
@@ -222,150 +278,180 @@ def setParameterByValue(logger, setting, value):
     For accepted values for each setting, see the dictionary file for each
     parameter or run the --get-config command.
     
+    settings is the CameraSettings cache from openCameraSettings(); the write is
+    skipped if the camera is already known to hold the value. To change several
+    settings at once, call settings.apply() directly so they share a single
+    write and verification read.
+    
     NOTE: consider implementing more of these, i.e. shutterspeed, raw format,
     etc. depending on camera mode.
     '''
     
-    # check that setting and parameter arguments are valid
-    if not setting in ['aperture', 'iso']:
-        logger.debug('WARNING: "' + setting + '" is not a configurable parameter')
+    with getMetrics().span('config_apply', setting=setting):
+        applied = settings.apply({setting: value})
+    if not applied:
         logger.debug('Exit setParameterByValue()')
         return False
-    aperture_dict_filename = '/home/pi/pipeline/80D_aperture_dict' # these text files should be placed in the same directory as the script
-    iso_dict_filename = '/home/pi/pipeline/80D_iso_dict'
-    aperture_dict, iso_dict = loadconfigurableParameterDicts(aperture_dict_filename, iso_dict_filename)    
-    if setting == 'aperture':
-        dictionary = aperture_dict
-    elif setting == 'iso':
-        dictionary = iso_dict
-    else:
-        print("unreachable")
-    if not value in dictionary.values():
-        logger.debug('WARNING: "' + value + '" is not an accepted value for the "' + setting + '" parameter')
-        logger.debug('Exit setParameterByValue()')
-        return False
-    
-    logger.debug('\tSetting ' + setting + ' parameter to ' + str(value) + '...')
-    
-    # check current value to assess change need
-    get_setting_cmd = ['gphoto2', '--get-config', setting]
-    output = subprocess.run(get_setting_cmd, stdout=subprocess.PIPE).stdout.decode('utf-8')
-    for row in list(map(lambda x: x.strip(), output.split('\n'))):
-        if "Current:" in row:
-            current = row[row.find(':')+1:].strip()
-            if current == value:
-                logger.debug('\tsetParameterByValue() notice: ' + setting + ' is already set to ' + str(current))
-                return True
-    
-    # pass command to change setting to new change value
-    set_setting_cmd = ['gphoto2', '--set-config-value', setting + '=' + str(value)]
-    output = subprocess.run(set_setting_cmd, stdout=subprocess.PIPE).stdout.decode('utf-8')
-    output_lines = list(map(lambda x: x.strip(), output.split('\n')))
-    if len(output_lines) == 1:
-        #logger.debug('No error output from aperture set command.')
-        # assume command was successful if no output; verify in subsequent step
-        pass
-    else:
-        logger.debug('Failed to set new parameter value: see output from gphoto2 command below')
-        for line in output_lines:
-            logger.debug(line)
-        return False
-    
-    # run syscommand to check value and verify change; return
-    output = subprocess.run(get_setting_cmd, stdout=subprocess.PIPE).stdout.decode('utf-8')
-    for row in list(map(lambda x: x.strip(), output.split('\n'))):
-        if "Current:" in row:
-            current = row[row.find(':')+1:].strip()
-            if current == value:
-                logger.debug('\t' + setting + ' parameter successfully set to ' + str(value))
-                return True
-            else:
-                logger.debug('WARNING: Failed to change value to' + str(value) + ', reason unknown')
-                return False
-    
-    # should be unreachable
-    return False
+    return True
+
+def startPipeline(logger, session, pipelined, max_in_flight, consumers=None):
+    '''Return a running CapturePipeline for a series loop, or None for serial
+    capture. Pipelining needs an open session shared by the whole series.'''
+    if not pipelined:
+        return None
+    if session is None:
+        logger.debug('WARNING: pipelined capture needs an open camera session; falling back to serial capture')
+        return None
+    logger.debug('Pipelined capture enabled (' + str(max_in_flight) + ' frames in flight)')
+    return CapturePipeline(logger, session, max_in_flight, consumers)
+
+def stopPipeline(logger, pipeline):
+    '''Wait for outstanding pipelined downloads and report any failed frames.'''
+    if pipeline is None:
+        return
+    pipeline.close()
+    failures = pipeline.failures()
+    logger.debug('Pipelined downloads: ' + str(len(pipeline.results) - len(failures)) + ' ok, ' + str(len(failures)) + ' failed')
+    for result in failures:
+        logger.debug('    FAILED: ' + result.filename + ' (' + str(result.error) + ')')
 
-def singleCapture(logger, wait_time, exposure_time, aperture='2.8', iso='Auto', subject_name='AnonymousSubject', timestamp=None, lights='off'):
+def singleCapture(logger, wait_time, exposure_time, aperture='2.8', iso='Auto', subject_name='AnonymousSubject', timestamp=None, lights='off', session=None, settings=None, pipeline=None, 
+                  output_dir=None, relay=None, consumers=None, warmup=LIGHTS_WARMUP, lights_after=None):
     '''Capture a single image. Return true iff successful.
     
     Both the exposure_time and wait_time values are interpreted as being in
-    seconds. However, because gphoto2 does not appear to correctly intepret
-    decimal values for seconds, I specify all times in milliseconds (which
-    requires only specifying the unit along with the argument).
+    seconds. wait_time is only an upper bound on how long to wait for the
+    camera to report and transfer the file once the shutter closes; the capture
+    returns as soon as the download completes. Pass None to have the bound
+    derived from the size of previous frames of the same kind.
     
     Name of the output image file is populated with metadata from the capture
     configuration. An assigned 'light' or 'dark' tag, based on an exposure_time
     cutoff of less <=5 seconds is also included.
+    
+    session is an open CameraSession; if none is supplied, one is opened for
+    the duration of this capture only. settings is the CameraSettings cache for
+    that session (see openCameraSettings); pass the same one in every call of a
+    series so unchanged settings are not rewritten.
+    
+    If a CapturePipeline is given, the download is handed to its worker as soon
+    as the camera reports the file, and the return value only says whether the
+    exposure succeeded; download failures are reported by the pipeline.
+    
+    The image is written to output_dir (default: the working directory). relay
+    is the RelayControl for the lights (default: BCM pin 2); the exposure holds
+    it in the state given by lights, so other cameras sharing the relay can't
+    switch it mid-exposure. Each of consumers (objects with a non-blocking
+    submit(image_path), e.g. a PreviewWorker or LiveQuantifier) is handed the
+    verified image for background work; with a pipeline, the pipeline passes
+    frames on to them.
+    
+    If the relay has to be switched on for the exposure, the lights get warmup
+    seconds (counted from the switch) to come up to temp first. lights_after
+    ('on' or 'off') is the state for the relay to rest in as soon as the
+    shutter closes, so the next frame's warm-up overlaps this download.
     '''
     
-    # if using the lights, turn these on and wait a few seconds for bulb to come up to temp
-    if lights == 'on':
-        GPIO.output(2, GPIO.HIGH)
-        time.sleep(3) # time for bulb to come up to tent
+    if session is None:
+        with CameraSession(logger) as session:
+            return singleCapture(logger, wait_time, exposure_time, aperture, iso, subject_name, timestamp, lights, session, 
+                                 output_dir=output_dir, relay=relay, consumers=consumers, warmup=warmup, lights_after=lights_after)
+    if settings is None:
+        settings = openCameraSettings(logger, session)
+    if relay is None:
+        relay = getRelay()
     
     # name the target image
     if timestamp == None:
         ts = time.time()
         timestamp = time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime(ts))
-    if float(exposure_time) >= 5:
-        tag = '_dark'
-    else:
-        tag = '_light'
+    tag = '_' + frameTag(exposure_time)
     image_name = subject_name + '_' + timestamp + tag + '_exp' + str(exposure_time) + 's_' + '_f' + aperture + '_iso' + iso
+    image_path = image_name + '.jpg'
+    if output_dir is not None:
+        image_path = os.path.join(output_dir, image_path)
     
     logger.debug('\tStarting capture routine for ' + image_name + '...')
     
     # program selected capture settings
     logger.debug('\tProgramming capture settings...')
-    if not(setParameterByValue(logger, 'aperture', aperture)):
-        logger.debug('Failed to set selected aperture! Premature exit of singleCapture() function.')
-        return False
-    if not (setParameterByValue(logger, 'iso', iso)):
-        logger.debug('Failed to set selected iso! Premature exit of singleCapture() function.')
+    with getMetrics().span('config_apply', setting='aperture,iso'):
+        applied = settings.apply({'aperture': aperture, 'iso': iso})
+    if not applied:
+        logger.debug('Failed to set selected aperture/iso! Premature exit of singleCapture() function.')
         return False
     logger.debug('\t...done.')
     
-    # generate capture command for gphoto2 and pass to system
-    wait_time = int(float(wait_time) * 1000) # convert to milliseconds
-    exposure_time = int(float(exposure_time) * 1000) # convert to milliseconds
-    capture_cmd = ['gphoto2',
-                        '--filename', image_name + '.jpg',
-                        '--set-config-index', 'eosremoterelease=5',
-                        '--wait-event=' + str(exposure_time) + 'ms',
-                        '--set-config-index','eosremoterelease=4',
-                        '--wait-event-and-download=' + str(wait_time) + 'ms']
+    # open the shutter, hold for the exposure, release and download over the
+    # session connection. If using the lights, turn these on and wait a few
+    # seconds for bulb to come up to temp
     logger.debug('\tpassing capture command...')
-    output = subprocess.run(capture_cmd, stdout=subprocess.PIPE).stdout.decode('utf-8')
+    if pipeline is not None:
+        with relay.hold(lights == 'on', warmup=warmup if lights == 'on' else 0):
+            camera_path = session.bulbExpose(exposure_time, wait_time, size_key=tag)
+        if lights_after is not None:
+            relay.set(lights_after == 'on')
+        if camera_path is None:
+            logger.debug('WARNING: image capture failed, camera reported no image. Troubleshoot me!')
+            return False
+        pipeline.submit(camera_path, image_path, size_key=tag)
+        logger.debug('\t...exposed, download queued.')
+        return True
+    with relay.hold(lights == 'on', warmup=warmup if lights == 'on' else 0):
+        camera_path = session.bulbExpose(exposure_time, wait_time, size_key=tag)
+    if lights_after is not None:
+        relay.set(lights_after == 'on')
+    # fetchFile checks the file on disk against the size the camera reports
+    # and deletes it if it is incomplete
+    captured = camera_path is not None and session.fetchFile(camera_path, image_path, size_key=tag)
     logger.debug('\t...done.')
     
-    # verify image capture
-    '''The gphoto2 output for any bulb exposure is quite verbose... would be
-    nice to code a parse check for suppression unless an error is apparent. For
-    now, checking for the image file after capture command is complete will
-    suffice for QC.
-    ''' 
-    #for row in list(map(lambda x: x.strip(), output.split('\n'))):
-    #    logger.debug(row)
-    
-    if image_name + '.jpg' in os.listdir():
+    if captured:
         logger.debug('\tImage captured!')
+        for consumer in consumers or ():
+            consumer.submit(image_path)
         return True
     else:
-        logger.debug('WARNING: image capture failed, no image found. Troubleshoot me!')
+        logger.debug('WARNING: image capture failed, no complete image downloaded. Troubleshoot me!')
         return False
     
     # should be unreachable
     return False
 
-def seriesCapture(logger, interval, duration, cycles, wait_time, exposure_time, aperture='2.8', iso='Auto', subject_name='AnonymousSubject', lights='off'):
+def seriesCapture(logger, interval, duration, cycles, wait_time, exposure_time, aperture='2.8', iso='Auto', subject_name='AnonymousSubject', lights='off', session=None, settings=None, pipelined=False, max_in_flight=2, overrun_policy='skip', 
+                  output_dir=None, relay=None, consumers=None, idle=None, adaptive=None):
     '''Run loop for timelapse capture of still images
     
+    Cycles start on absolute deadlines counted from the start of the batch (see
+    capture_scheduler); overrun_policy decides what happens when a capture
+    runs past the start of the next cycle. Returns the CycleScheduler, whose
+    records hold the per-cycle timing.
+    
+    With pipelined=True, each frame is downloaded in the background (see
+    capture_pipeline); at most max_in_flight frames are in flight at any time,
+    counting the one downloading. The download is read in chunks between the
+    loop's camera commands, so it overlaps the next frame's exposure and write
+    and the wait for the next deadline.
+    
+    consumers are handed every verified frame (see singleCapture); idle is an
+    Event the scheduler sets while the loop sleeps between captures (see
+    capture_scheduler), e.g. LiveQuantifier.idle.
+    
+    With an AdaptiveExposure as adaptive, each frame's exposure_time and iso
+    are instead chosen from the previous frame (see adaptive_exposure).
+    
     NOTE: consider implementing argument checking for permissible values of
     exposure times and interval lengths.
     '''
     
-    for i in range(0, cycles):
+    if relay is None:
+        relay = getRelay()
+    relay.set(lights == 'on') # fixed lighting: rest in the same state between frames
+    if adaptive is not None:
+        consumers = list(consumers or []) + [adaptive]
+    pipeline = startPipeline(logger, session, pipelined, max_in_flight, consumers)
+    scheduler = CycleScheduler(logger, interval, cycles, overrun_policy, idle=idle)
+    for i in scheduler:
              
         logger.debug('Cycle ' + str(i+1) + ' of ' + str(cycles))
               
@@ -374,22 +460,25 @@ def seriesCapture(logger, interval, duration, cycles, wait_time, exposure_time,
         timestamp = time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime(ts))
         
         ''' Call single capture function '''
-        call_time = time.time()
-        logger.debug('\tCapture function call: ' + str(call_time))
-        singleCapture(logger, wait_time, exposure_time,  aperture=aperture, iso=iso, subject_name=subject_name, timestamp=timestamp, lights=lights)
-        return_time = time.time() 
-        logger.debug('\tCapture function return: ' + str(return_time))
+        if adaptive is not None:
+            exposure_time, iso = adaptive.next()
+        call_time = time.monotonic()
+        logger.debug('\tCapture function call: ' + str(ts))
+        singleCapture(logger, wait_time, exposure_time,  aperture=aperture, iso=iso, subject_name=subject_name, timestamp=timestamp, lights=lights, session=session, settings=settings, pipeline=pipeline, 
+                      output_dir=output_dir, relay=relay, consumers=consumers)
+        return_time = time.monotonic()
+        logger.debug('\tCapture function return: ' + str(round(return_time - call_time, 3)) + 's after call')
         logger.debug('\tPicture captured, timestamped ' + timestamp)
         
-        ''' Sleep remainder of interval '''
-        sleep_interval = interval - (return_time - call_time)
-        logger.debug('\tSleeping for ' + str(sleep_interval))
-        time.sleep(sleep_interval)
+        # the scheduler sleeps until the next deadline on the next iteration
     
-    return
+    stopPipeline(logger, pipeline)
+    scheduler.logSummary()
+    return scheduler
 
 def dualSeriesCapture(logger, interval, duration, cycles, wait_time, exposure_time_light, exposure_time_dark, 
-                  aperture_light='7.1', aperture_dark='2.8', iso_light='Auto', iso_dark='Auto', subject_name='AnonymousSubject'):
+                  aperture_light='7.1', aperture_dark='2.8', iso_light='Auto', iso_dark='Auto', subject_name='AnonymousSubject', session=None, settings=None, pipelined=False, max_in_flight=2, 
+                  overrun_policy='skip', light_buffer=2, output_dir=None, relay=None, consumers=None, idle=None, adaptive=None):
     '''Run loop for timelapse capture of still images, taking first an
     unilluminated "dark" image and then a light image at the beginning and end,
     respectively, of each cycle in the timecourse.
@@ -399,100 +488,185 @@ def dualSeriesCapture(logger, interval, duration, cycles, wait_time, exposure_ti
     variable when imaging right after turning on the power, unless one buys a
     more fancy bulb). 
     
+    Dark frames start on the absolute cycle deadlines (see seriesCapture). The
+    light frame is started so that it finishes light_buffer seconds before the
+    next deadline, based on how long the previous light capture took.
+    
+    With pipelined=True, downloads run in the background as in seriesCapture,
+    and consumers, idle and adaptive (for the dark frames) work as they do
+    there.
+    
     NOTE: same implementation for argument safety check would be useful here.
     '''
         
-    for i in range(0, cycles):
+    if relay is None:
+        relay = getRelay()
+    if adaptive is not None:
+        consumers = list(consumers or []) + [adaptive]
+    pipeline = startPipeline(logger, session, pipelined, max_in_flight, consumers)
+    scheduler = CycleScheduler(logger, interval, cycles, overrun_policy, idle=idle)
+    light_duration = float(exposure_time_light) + 10 # first guess, in seconds; measured from then on
+    for i in scheduler:
              
         logger.debug('Cycle ' + str(i+1) + ' of ' + str(cycles))
               
         '''Turn off lights to do the dark exposure first'''
-        GPIO.output(2, GPIO.LOW)
+        relay.set(False)
         #logger.debug('Lights off!')
         
         '''Generate timestamp for naming image'''
-        call_time = time.time() # get timestamp for picture
-        timestamp = time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime(call_time))
-        logger.debug('\tDark capture function call: ' + str(call_time))
-        singleCapture(logger, wait_time, exposure_time_dark, aperture_dark, iso_dark, subject_name, timestamp)
-        return_time = time.time() 
-        logger.debug('\tDark capture function return: ' + str(return_time))
+        ts = time.time() # get timestamp for picture
+        timestamp = time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime(ts))
+        if adaptive is not None:
+            exposure_time_dark, iso_dark = adaptive.next()
+        call_time = time.monotonic()
+        logger.debug('\tDark capture function call: ' + str(ts))
+        # lights on as soon as the shutter closes, warming up during the download
+        singleCapture(logger, wait_time, exposure_time_dark, aperture_dark, iso_dark, subject_name, timestamp, 'off', 
+                      session=session, settings=settings, pipeline=pipeline, output_dir=output_dir, relay=relay, consumers=consumers, 
+                      lights_after='on')
+        return_time = time.monotonic()
+        logger.debug('\tDark capture function return: ' + str(round(return_time - call_time, 3)) + 's after call')
         #logger.debug('\tPicture captured, timestamped ' + timestamp)
         
-        GPIO.output(2, GPIO.HIGH)
-        #logger.debug('Lights on!')
-        
-        sleep_interval = interval - (return_time - call_time)
-        logger.debug('\tSleeping for ' + str(sleep_interval))
-        time.sleep(sleep_interval-2) # wait until almost the very end of the cycle
-    
-        success = singleCapture(logger, wait_time, exposure_time_light, aperture_light, iso_light, subject_name, timestamp)
+        # wait until almost the very end of the cycle
+        light_start = scheduler.nextDeadline() - light_duration - light_buffer
+        logger.debug('\tSleeping for ' + str(round(light_start - time.monotonic(), 3)))
+        scheduler.sleepUntil(light_start)
+    
+        call_time = time.monotonic()
+        success = singleCapture(logger, wait_time, exposure_time_light, aperture_light, iso_light, subject_name, timestamp, 'on', 
+                                session=session, settings=settings, pipeline=pipeline, output_dir=output_dir, relay=relay, consumers=consumers)
+        light_duration = time.monotonic() - call_time
         if not success:
             logger.debug('Capture failed!!! Abort abort!!!')
-            return
+            stopPipeline(logger, pipeline)
+            scheduler.logSummary()
+            return scheduler
         
-        # this is to provide a brief buffer before the "light power off" command
-        # is supplied from the next round of the cycle
-        time.sleep(2)
+        # the light_buffer left before the next deadline separates the light
+        # capture from the "light power off" command of the next cycle
         
-    return
+    stopPipeline(logger, pipeline)
+    scheduler.logSummary()
+    return scheduler
 
-def runCloseoutOps(logger):
-    '''Closeout operations'''
-    logger.debug('Setting pin 2 voltage to low...')
-    GPIO.output(2, GPIO.LOW) # make sure turned off prior to closing
-    #GPIO.cleanup() # reset any previous settings
-    logger.debug('...done.')
-    return
+def cycleCapture(logger, plan, interval, cycles, wait_time, subject_name='AnonymousSubject', session=None, settings=None, pipelined=False, max_in_flight=2, 
+                 overrun_policy='skip', output_dir=None, relay=None, consumers=None, idle=None, adaptive=None):
+    '''Run loop for timelapse capture of an arbitrary sequence of frames per
+    cycle, following a timeline compiled from the phases of a 'cycle' profile
+    (see cycle_planner.compilePlan).
+    
+    Each phase is one singleCapture with the phase's lights and settings. The
+    relay is switched for the next phase as soon as the shutter closes, so its
+    warm-up runs alongside the download and the next configuration write.
+    Phases with a fixed start ('at') wait for it; phases at 'end' start so that
+    they finish CYCLE_MARGIN seconds before the next deadline, based on how
+    long the same phase took in the previous cycle.
+    
+    pipelined, consumers and idle work as in seriesCapture; adaptive, if given,
+    sets exposure and ISO of every lights-off dark phase.
+    '''
+    
+    if relay is None:
+        relay = getRelay()
+    relay.set(plan[0]['phase']['lights'] == 'on')
+    if adaptive is not None:
+        consumers = list(consumers or []) + [adaptive]
+    pipeline = startPipeline(logger, session, pipelined, max_in_flight, consumers)
+    scheduler = CycleScheduler(logger, interval, cycles, overrun_policy, idle=idle)
+    # first guess for how long each phase takes, from the plan; measured from then on
+    durations = [entry['done'] - entry['start'] + entry['configure'] for entry in plan]
+    for i in scheduler:
+        
+        logger.debug('Cycle ' + str(i+1) + ' of ' + str(cycles))
+        cycle_start = scheduler.deadline(i)
+        
+        '''Generate timestamp for naming all images of this cycle'''
+        ts = time.time()
+        timestamp = time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime(ts))
+        
+        for k, entry in enumerate(plan):
+            phase = entry['phase']
+            following = plan[(k + 1) % len(plan)]['phase']
+            if phase['at'] == 'end':
+                scheduler.sleepUntil(scheduler.nextDeadline() - durations[k] - CYCLE_MARGIN)
+            elif phase['at'] is not None:
+                scheduler.sleepUntil(cycle_start + entry['start'] - entry['configure'])
+            exposure_time, iso = phase['shutterspeed'], phase['iso']
+            if adaptive is not None and phase['lights'] == 'off' and frameTag(exposure_time) == 'dark':
+                exposure_time, iso = adaptive.next()
+            call_time = time.monotonic()
+            logger.debug('\t' + phase['name'] + ' capture ' + str(round(call_time - cycle_start, 3)) + 's into the cycle (planned ' + 
+                         str(round(entry['start'] - entry['configure'], 3)) + 's)')
+            success = singleCapture(logger, wait_time, exposure_time, phase['aperture'], iso, subject_name, timestamp, phase['lights'], 
+                                    session=session, settings=settings, pipeline=pipeline, output_dir=output_dir, relay=relay, consumers=consumers, 
+                                    warmup=phase['settle'], lights_after=following['lights'])
+            durations[k] = time.monotonic() - call_time
+            if not success:
+                logger.debug('WARNING: ' + phase['name'] + ' capture failed in cycle ' + str(i+1))
+        
+    stopPipeline(logger, pipeline)
+    scheduler.logSummary()
+    return scheduler
 
-if __name__ == "__main__":
+def startPreviews(logger, previews):
+    '''Return a running PreviewWorker if previews are enabled, else None.'''
+    if not previews:
+        return None
+    from preview_pyramid import PreviewWorker
+    logger.debug('Writing preview pyramids in the background (see preview_pyramid)')
+    return PreviewWorker(logger)
+
+def stopPreviews(logger, previews):
+    '''Finish outstanding previews and report how many were written.'''
+    if previews is None:
+        return
+    previews.close()
+    logger.debug('Previews: ' + str(previews.written) + ' written, ' + str(previews.skipped) + ' skipped, ' + str(previews.failed) + ' failed')
+
+def startAdaptiveExposure(logger, conf, settings):
+    '''Return an AdaptiveExposure for the dark frames if the config sets
+    adaptive_exposures, else None. ISOs come from the camera's accepted
+    values.'''
+    if not 'adaptive_exposures' in conf:
+        return None
+    from adaptive_exposure import AdaptiveExposure
+    exposures = [float(x) for x in conf['adaptive_exposures'].split(',')]
+    max_iso = int(conf.get('adaptive_max_iso', 1600))
+    isos = [x for x in settings.accepted_values['iso'] if x.isdigit() and int(x) <= max_iso]
+    adaptive = AdaptiveExposure(logger, exposures, isos, float(conf.get('adaptive_target', 180)))
+    logger.debug('Adaptive dark exposure over ' + str(exposures) + ' s, ISO ' + str(adaptive.isos[0]) + '-' + str(adaptive.isos[-1]))
+    return adaptive
+
+def runCaptureProfile(logger, capture_profile, conf, session, settings, wait_time=None, pipelined=False, 
+                      overrun_policy='skip', images_dir=None, relay=None, previews=False):
+    '''Run the capture function for a capture profile with the options parsed
+    from its config file. Images go into images_dir; series profiles by default
+    place them in a new, named subdirectory of it. Without images_dir, a single
+    image goes into the working directory and series into the images folder,
+    as they always have. With previews=True, every
+    frame also gets a thumbnail and preview image next to it.
+    
+    A 'cycle' profile's timeline is compiled and checked against the interval
+    and the camera's accepted values before anything is captured; an invalid
+    plan raises ValueError.
+    
+    If the config sets live_rois (a layout in roi_layouts), series profiles
+    also measure those ROIs on every dark frame as it comes in, into live_file
+    (default live_rois.csv) in the batch directory; see live_quantification.'''
     
-    '''Set up logger routing to console and to file'''
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(logging.StreamHandler())
-    logger.addHandler(logging.FileHandler('gphoto_capture_control.log', mode='w'))
-    logger.debug('gPhoto2 wrapper utility launched!')
-   
-    proceed = True # script procedural stop-check value
-     
-    '''Set up relay control via GPIO, with power off'''
-    if proceed:
-        proceed = initRelayControl(logger)
-     
-    '''Kill background process that locks camera control '''
-    if proceed:
-        killMonitorProcess(logger)
-     
-    ''' Verify that camera is visible to gPhoto2 and set to bulb mode '''
-    if proceed:
-        proceed = verifyCameraConnect(logger)
-    if proceed:
-        proceed = verifyBulbMode(logger)
-         
-    ''' Specify the capture profile '''
-    capture_profile = 'dual_series'
-      
-    ''' Read config file for command and parse universal config options'''
-    conf_filename = capture_profile + '.conf'
-    conf = readConfFile(conf_filename, capture_profile)
     subject_name = conf['subject']
-    # Wait time for the camera prior to pulling the image for download. I
-    # originally used 2 seconds per examples I saw online, and this worked fine
-    # until I found a bug whereby for very long exposures (>10m), the camera
-    # call would return with no error but no image would be downloaded. I
-    # hypothesize this is because longer exposure images are larger, and that 2s
-    # was insufficient for the data to transfer from the camera to the Pi (or
-    # from camera RAM to storage, or whatever data transfer occurs therein).
-    wait_time = 10 # in seconds
-      
-    ''' Call appropriate capture function '''
+    preview_worker = startPreviews(logger, previews)
+    consumers = [preview_worker] if preview_worker is not None else []
+    live = None
     if capture_profile == 'single':
 
         '''Run singleCapture function'''
-        singleCapture(logger, wait_time, conf['shutterspeed'], conf['aperture'], conf['iso'], subject_name, None, conf['lights'])
+        singleCapture(logger, wait_time, conf['shutterspeed'], conf['aperture'], conf['iso'], subject_name, None, conf['lights'], session, settings, 
+                      output_dir=images_dir, relay=relay, consumers=consumers)
     
-    elif capture_profile == 'series' or capture_profile == 'dual_series':
+    elif capture_profile in ['series', 'dual_series', 'cycle']:
         
         '''Set configs common for timelapse capture functions, and by default
         place images in a new, named subdirectory.'''
@@ -502,19 +676,41 @@ if __name__ == "__main__":
         duration = duration * 3600 # convert to seconds  
         cycles = int(duration / (interval))        
         
-        os.chdir('images') # move into images folder before create a subdirectory
+        if capture_profile == 'cycle':
+            plan = compilePlan(parsePhases(conf), interval, 
+                               accepted_values=settings.accepted_values if settings is not None else None)
+            logger.debug('Cycle plan (' + str(interval) + 's interval):')
+            for line in describePlan(plan):
+                logger.debug('    ' + line)
+        
         ts = time.time()
         batchname = subject_name + '_' + time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime(ts)) 
         logger.debug('Starting new batch picture cycle: ' + batchname)
-        subprocess.call('mkdir ' + batchname, shell=True)
-        os.chdir(batchname) # move into the new subdirectory  
+        batch_dir = os.path.join(images_dir if images_dir is not None else 'images', batchname)
+        os.makedirs(batch_dir, exist_ok=True)
+        adaptive = startAdaptiveExposure(logger, conf, settings)
+        if 'live_rois' in conf:
+            from live_quantification import LiveQuantifier
+            live = LiveQuantifier(logger, conf['live_rois'], os.path.join(batch_dir, conf.get('live_file', 'live_rois.csv')))
+            consumers.append(live)
         
         if capture_profile == 'series':
             
             '''Run seriesCapture function with fixed lighting'''     
             exposure_time = conf['shutterspeed'] # in seconds; left verbose for convenient unit conversion
             logger.debug('Initiating timelapse loop: ' + str(cycles) + ' cycles with ' + str(interval) + 's intervals')
-            seriesCapture(logger, interval, duration, cycles, wait_time, exposure_time, conf['aperture'],conf['iso'], subject_name, conf['lights'])
+            seriesCapture(logger, interval, duration, cycles, wait_time, exposure_time, conf['aperture'],conf['iso'], subject_name, conf['lights'], session, settings, pipelined, 
+                          overrun_policy=overrun_policy, output_dir=batch_dir, relay=relay, consumers=consumers, 
+                          idle=live.idle if live is not None else None, adaptive=adaptive)
+            logger.debug('Picture cycle ended')
+            
+        elif capture_profile == 'cycle':
+            
+            '''Run cycleCapture function over the compiled phases'''
+            logger.debug('Initiating timelapse loop: ' + str(cycles) + ' cycles with ' + str(interval) + 's intervals')
+            cycleCapture(logger, plan, interval, cycles, wait_time, subject_name, session, settings, pipelined, 
+                         overrun_policy=overrun_policy, output_dir=batch_dir, relay=relay, consumers=consumers, 
+                         idle=live.idle if live is not None else None, adaptive=adaptive)
             logger.debug('Picture cycle ended')
             
         else:
@@ -527,15 +723,112 @@ if __name__ == "__main__":
             dualSeriesCapture(logger, interval, duration, cycles, wait_time, exposure_time_light, exposure_time_dark, 
                           aperture_light=conf['aperture_light'], aperture_dark=conf['aperture_dark'], 
                           iso_light=conf['iso_light'], iso_dark=conf['iso_dark'], 
-                          subject_name=subject_name)
+                          subject_name=subject_name, session=session, settings=settings, pipelined=pipelined, 
+                          overrun_policy=overrun_policy, output_dir=batch_dir, relay=relay, consumers=consumers, 
+                          idle=live.idle if live is not None else None, adaptive=adaptive)
             logger.debug('Picture cycle ended')
             
     else:
         
         logger.debug('capture_profile not recognized')
+    stopPreviews(logger, preview_worker)
+    if live is not None:
+        live.close()
+    return
+
+def runCloseoutOps(logger, pins=(2,)):
+    '''Closeout operations'''
+    for pin in pins:
+        logger.debug('Setting pin ' + str(pin) + ' voltage to low...')
+        getRelay(pin).set(False) # make sure turned off prior to closing
+    #GPIO.cleanup() # reset any previous settings
+    logger.debug('...done.')
+    return
+
+if __name__ == "__main__":
     
-    ''' Run any cleanup operations (i.e. reset relay) '''
-    runCloseoutOps(logger)
+    '''Set up logger routing to console and to file'''
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.StreamHandler())
+    logger.addHandler(logging.FileHandler('gphoto_capture_control.log', mode='w'))
+    logger.debug('gPhoto2 wrapper utility launched!')
+    
+    # Per-phase timing of every cycle, as JSON lines plus a Prometheus snapshot
+    # (see capture_metrics).
+    setMetrics(CaptureMetrics('capture_metrics.jsonl', 'capture_metrics.prom'))
+   
+    proceed = True # script procedural stop-check value
+     
+    '''Set up relay control via GPIO, with power off'''
+    if proceed:
+        proceed = initRelayControl(logger)
+     
+    '''Find the camera and free it from any background process that locks
+    camera control (see startup_probe) '''
+    if proceed:
+        cameras = probeStartup(logger)
+        proceed = len(cameras) > 0
+     
+    ''' Open the camera session used for all capture traffic from here on, and
+    verify the camera model and bulb mode from one snapshot of its config '''
+    session = CameraSession(logger, port=cameras[0]['port'] if proceed else None)
+    if proceed:
+        try:
+            session.open()
+            snapshot = session.getConfigSnapshot()
+        except CameraError as e:
+            logger.debug('ERROR: could not open the camera session: ' + str(e))
+            proceed = False
+    if proceed:
+        proceed = verifyCameraModel(logger, snapshot)
+    if proceed:
+        proceed = verifyBulbMode(logger, snapshot=snapshot)
+    if proceed:
+        settings = openCameraSettings(logger, session, snapshot=snapshot)
+         
+    ''' Specify the capture profile '''
+    capture_profile = 'dual_series'
+      
+    ''' Read config file for command and parse universal config options'''
+    conf_filename = capture_profile + '.conf'
+    conf = readConfFile(conf_filename, capture_profile)
+    # Wait time for the camera prior to pulling the image for download. I
+    # originally used 2 seconds per examples I saw online, and this worked fine
+    # until I found a bug whereby for very long exposures (>10m), the camera
+    # call would return with no error but no image would be downloaded. I
+    # hypothesize this is because longer exposure images are larger, and that 2s
+    # was insufficient for the data to transfer from the camera to the Pi (or
+    # from camera RAM to storage, or whatever data transfer occurs therein).
+    # Downloads are now driven by the camera's FileAdded event, so this is only
+    # an upper bound; None scales it with the size of previous frames (see
+    # camera_session.downloadTimeout).
+    wait_time = None # in seconds
+    
+    # Download each frame in the background, during the next exposure and the
+    # wait for the next cycle (series profiles only, see capture_pipeline).
+    pipelined = False
+    
+    # What to do when a capture overruns into the next cycle: 'skip', 'catchup'
+    # or 'compress' (see capture_scheduler).
+    overrun_policy = 'skip'
+    
+    # Write a thumbnail and a preview image next to every frame, off the
+    # capture thread (see preview_pyramid).
+    previews = False
+      
+    ''' Call appropriate capture function '''
+    if proceed:
+        runCaptureProfile(logger, capture_profile, conf, session, settings, wait_time, pipelined, overrun_policy, 
+                          previews=previews)
+    else:
+        logger.debug('Startup checks failed, no capture run. See the messages above.')
+    
+    ''' Run any cleanup operations (i.e. reset relay, release camera) '''
+    if proceed:
+        runCloseoutOps(logger)
+    session.close()
+    getMetrics().close()
     
     
     
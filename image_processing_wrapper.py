@@ -5,11 +5,21 @@ Author: James Chamness
 Version: 1.0 (October 6, 2019)
 
 '''
+import collections
+import concurrent.futures
 import os
 import re
 import subprocess
+import tempfile
 import time
 
+import calibration
+import frame_manifest
+import frame_names
+import frame_processing
+import frame_registration
+from imagej_pool import ImageJPool
+
 def callBatchMacro(ij_jar_path, input_dir, output_dir, macro_path, macro_name):
     '''Call a single ImageJ macro
     
@@ -35,56 +45,230 @@ def callBatchMacro(ij_jar_path, input_dir, output_dir, macro_path, macro_name):
     output = subprocess.run(call_cmd, stdout=subprocess.PIPE).stdout.decode('utf-8')
     return
 
-def timestampImageFolder(imageFolderPath):
-    '''Add name-extracted timestamps as watermarks across a directory of images.
-    
-    NOTE: figure out how to place text in corner with fixed buffer distance; there's
-    a slight bit of horizontal jitter, regarding placement, between frames, due to
-    variable width of the watermark text. Idea: could use reference to text height
-    instead of width (th instead of tw), since this is less likely to vary. or do in
-    a monospace font?
-    
-    NOTE: could add a counter, useful for tracking progress over long batches
-    
-    NOTE: probably actually more efficient to move this step into ImageJ pipeline
+def callPooledMacro(pool, input_dir, output_dir, macro_name, file_names):
+    '''Pooled equivalent of callBatchMacro: apply a named macro to file_names
+    across the workers of an ImageJPool, printing failures as they come in.
+    Returns the names of the files processed successfully.'''
+    def report(file_name, outcome):
+        if not outcome == 'ok':
+            print('ImageJ failed on ' + file_name + ': ' + outcome)
+    results = pool.processFiles(macro_name, input_dir, output_dir, file_names, progress=report)
+    return [x for x in file_names if results.get(x) == 'ok']
+
+# timestamps are parsed from the capture file names (see singleCapture), e.g.
+# 'subject_2019-10-06_14:30:00_dark_exp480s__f2.8_isoAuto.jpg'
+#TIMESTAMP_EXPRESSION = re.compile(r'\d\d\d\d-\d\d-\d\d_\d\d:\d\d:\d\d') # entire timestamp
+TIMESTAMP_EXPRESSION = re.compile(r'\d\d:\d\d:\d\d') # just the time, not the date
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+
+# drawtext settings for the burned-in timestamp; the text is read per frame from
+# the 'timestamp' metadata that the concat list attaches to each file
+TIMESTAMP_DRAWTEXT = "drawtext=text='%{metadata\\:timestamp}':fontcolor=white:fontsize=140:x=w-tw-(tw/8):y=th+(th/8)"
+
+def frameTimestamp(file_name):
+    '''Name-extracted timestamp for a frame, or '' if it has none.'''
+    match = TIMESTAMP_EXPRESSION.search(file_name)
+    return match.group(0) if match else ''
+
+def listFrames(imageFolderPath):
+    '''Sorted names of the image files in a folder, i.e. the video frames.'''
+    return sorted(x for x in os.listdir(imageFolderPath)
+                  if x.lower().endswith(IMAGE_EXTENSIONS) and not frame_names.isPreviewName(x)
+                  and not os.path.isdir(os.path.join(imageFolderPath, x)))
+
+def writeConcatList(list_path, image_paths, inputFPS, timestamps=True):
+    '''Write an ffmpeg concat demuxer script that shows each image for
+    1/inputFPS seconds, in order, with its name-extracted timestamp attached as
+    packet metadata (unless timestamps is False).'''
+    duration = 1.0 / inputFPS
+    # the concat demuxer ignores the duration of the last entry, so list the
+    # last image twice
+    entries = list(image_paths) + image_paths[-1:]
+    with open(list_path, 'w') as f:
+        f.write('ffconcat version 1.0\n')
+        for path in entries:
+            f.write("file '" + path.replace("'", "'\\''") + "'\n")
+            f.write('duration ' + str(duration) + '\n')
+            if timestamps:
+                f.write('file_packet_metadata timestamp=' + frameTimestamp(os.path.basename(path)) + '\n')
+    return list_path
+
+def encodeFrames(image_paths, inputFPS, video_path, timestamps=True):
+    '''Encode the given frames, in order, into one video file with a single
+    ffmpeg run, burning in their name-extracted timestamps.'''
+    with tempfile.TemporaryDirectory() as list_dir:
+        list_path = writeConcatList(os.path.join(list_dir, 'frames.ffconcat'), image_paths, inputFPS, timestamps)
+        call_cmd = ['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', list_path]
+        if timestamps:
+            call_cmd += ['-vf', TIMESTAMP_DRAWTEXT]
+        call_cmd += ['-r', '30', video_path]
+        subprocess.call(call_cmd)
+    return video_path
+
+def makeVideo(imageFolderPath, inputFPS, image_files=None, timestamps=True):
+    '''Make video from a single set of frames, with name-extracted timestamps
+    burned in as watermarks.
+
+    This is one ffmpeg run: the frames are decoded once, the timestamp is drawn
+    on each one from per-frame metadata, and the result is encoded straight to
+    the video. No watermarked copies of the frames are written.
+
+    NOTE: there's a slight bit of horizontal jitter, regarding placement,
+    between frames, due to variable width of the watermark text (x is relative
+    to tw). Could use a monospace font.
     '''
-    
-    # move into target directory to perform operations
-    old_dir = os.getcwd()
-    os.chdir(imageFolderPath)
-    orderedImages = sorted([x for x in os.listdir()])
-    
-    # apply operation to all the image files
-    frameCounter = 0 # FFMPEG expects frame numbering to start at 0 (used later)
-    for x in orderedImages:
-        # use regex for parsing is the simplest thing since date has fixed format
-        #timestamp_expression = re.compile(r'\d\d\d\d-\d\d-\d\d_\d\d:\d\d:\d\d') # entire timestamp
-        timestamp_expression = re.compile(r'\d\d:\d\d:\d\d') # just the time, not the date
-        timestamp = timestamp_expression.search(x).group(0)
-        timestamp = timestamp.replace(':','\:') # necessary so that standard colon doesn't break ffmpeg option parsing
-        cmdStr = 'ffmpeg -i ' + x + ' -vf "drawtext=text=' + "'" + timestamp + "'" + ':fontcolor=white:fontsize=140:x=w-tw-(tw/8):y=th+(th/8)" frame-' + str(frameCounter) + '.jpg'
-        subprocess.call(cmdStr, shell=True)
-        frameCounter += 1
-     
-    os.chdir(old_dir)
-    return
+    if image_files is None:
+        image_files = listFrames(imageFolderPath)
+    image_paths = [os.path.abspath(os.path.join(imageFolderPath, x)) for x in image_files]
+    subject_name = os.path.basename(os.path.normpath(imageFolderPath))
+    return encodeFrames(image_paths, inputFPS, os.path.join(imageFolderPath, subject_name + '.avi'), timestamps)
+
+def processingHashes(processing_engine, macro_name, macros_path, calibration_dir=None):
+    '''Return (params_hash, overlay_hash) identifying how frames are
+    processed: the filter parameters (including the master darks used) and the
+    ROI/label overlay.'''
+    if processing_engine == 'numpy':
+        params = {'engine': 'numpy', 'filters': frame_processing.FILTER_CHAIN, 'jpeg_quality': frame_processing.JPEG_QUALITY}
+        if calibration_dir is not None:
+            params['master_darks'] = dict((x, os.stat(os.path.join(calibration_dir, x)).st_mtime_ns)
+                                          for x in sorted(os.listdir(calibration_dir)) if x.startswith(calibration.MASTER_DARK_PREFIX))
+        overlay = frame_processing.getLayout(macro_name)
+    else:
+        # the macro file holds both the filters and the overlay
+        params = {'engine': 'imagej', 'macros_hash': frame_manifest.fileHash(macros_path)}
+        overlay = macro_name
+    return frame_manifest.valueHash(params), frame_manifest.valueHash(overlay)
 
-def makeVideo(imageFolderPath, inputFPS):
-    '''Make video from a single set of frames.'''
+def processIncremental(image_dir, output_dir, image_files, processing_engine, macro_name, ij_jar_path, macros_path,
+                       calibration_dir=None, pool=None, registration=None):
+    '''Process only the frames that are new, or whose raw image, filter
+    parameters or overlay changed since they were last processed (see
+    frame_manifest). Returns the updated manifest.
     
-    olddir = os.getcwd()
-    os.chdir(imageFolderPath)
-    subject_name = imageFolderPath[imageFolderPath.rfind(os.sep)+1:]
-    name = subject_name + '.avi'
-    cmdstr = 'ffmpeg -framerate ' + str(inputFPS) + ' -i frame-%d.jpg -r 30 ' + name
-    subprocess.call(cmdstr, shell=True)
-
-    # clean up all the intermediate files (watermarked frames)
-    cmdstr = 'rm frame-*'
-    subprocess.call(cmdstr, shell=True)
+    With the imagej engine, an ImageJPool given as pool runs the macro instead
+    of a new ImageJ per batch. With either, frames ImageJ fails on stay stale
+    for next time.
     
-    os.chdir(olddir)
-    return
+    With the numpy engine, registration ({file name: transform}, see
+    frame_registration) aligns each frame's overlay; a frame is reprocessed
+    when its transform changes.'''
+    manifest = frame_manifest.FrameManifest(output_dir)
+    image_files = sorted(image_files)
+    output_names = ['processed_' + x for x in image_files]
+    params_hash, overlay_hash = processingHashes(processing_engine, macro_name, macros_path, calibration_dir)
+    if processing_engine == 'numpy' and registration is not None:
+        overlay_hash = dict((x, frame_manifest.valueHash([overlay_hash, registration.get(x)])) for x in image_files)
+    stale = manifest.staleFrames(image_dir, image_files, output_names, params_hash, overlay_hash)
+    print(str(len(stale)) + ' of ' + str(len(image_files)) + ' frames need processing')
+    if len(stale) > 0:
+        if processing_engine == 'numpy':
+            frame_processing.processFolder(image_dir, output_dir, macro_name, stale, calibration_dir=calibration_dir,
+                                           registration=registration)
+        elif pool is not None:
+            stale = callPooledMacro(pool, image_dir, output_dir, macro_name, stale)
+        else:
+            # the macro processes whole folders, so give it one of just the stale frames
+            with tempfile.TemporaryDirectory() as stale_dir:
+                for x in stale:
+                    os.symlink(os.path.join(image_dir, x), os.path.join(stale_dir, x))
+                    if os.path.exists(os.path.join(output_dir, 'processed_' + x)):
+                        os.remove(os.path.join(output_dir, 'processed_' + x))
+                callBatchMacro(ij_jar_path, stale_dir, output_dir, macros_path, macro_name)
+            # ImageJ doesn't report per-file failures, so only record the frames it wrote
+            failed = [x for x in stale if not os.path.isfile(os.path.join(output_dir, 'processed_' + x))]
+            for x in failed:
+                print('ImageJ failed on ' + x + ': no output written')
+            stale = [x for x in stale if not x in failed]
+        manifest.recordFrames(image_dir, stale, ['processed_' + x for x in stale], params_hash, overlay_hash)
+    manifest.forgetFrames(output_names)
+    manifest.save()
+    return manifest
+
+def updateVideo(output_dir, manifest, inputFPS, segment_frames=frame_manifest.SEGMENT_FRAMES, timestamps=True):
+    '''Incremental makeVideo: encode the processed frames recorded in the
+    manifest as fixed-size segments, re-encoding only segments whose frames or
+    video settings changed, then join the segments into the video without
+    re-encoding.'''
+    subject_name = os.path.basename(os.path.normpath(output_dir))
+    segment_dir = os.path.join(output_dir, 'segments')
+    os.makedirs(segment_dir, exist_ok=True)
+    video_settings = {'fps': inputFPS, 'timestamps': TIMESTAMP_DRAWTEXT if timestamps else None}
+
+    segment_paths = []
+    changed = False
+    for i, names in enumerate(frame_manifest.splitSegments(sorted(manifest.data['frames']), segment_frames)):
+        segment_name = os.path.join('segments', 'segment-%04d.avi' % i)
+        segment_hash = manifest.segmentHash(names, video_settings)
+        if not manifest.segmentIsCurrent(segment_name, segment_hash):
+            print('Encoding ' + segment_name)
+            encodeFrames([os.path.join(output_dir, x) for x in names], inputFPS, os.path.join(output_dir, segment_name), timestamps)
+            manifest.recordSegment(segment_name, segment_hash)
+            changed = True
+        segment_paths.append(os.path.abspath(os.path.join(output_dir, segment_name)))
+
+    # segments past the end of a shortened series
+    for segment_name in list(manifest.data['segments']):
+        if not os.path.abspath(os.path.join(output_dir, segment_name)) in segment_paths:
+            del manifest.data['segments'][segment_name]
+            changed = True
+            if os.path.exists(os.path.join(output_dir, segment_name)):
+                os.remove(os.path.join(output_dir, segment_name))
+    manifest.save()
+
+    name = os.path.join(output_dir, subject_name + '.avi')
+    if not changed and os.path.exists(name):
+        return name
+    with tempfile.TemporaryDirectory() as list_dir:
+        list_path = os.path.join(list_dir, 'segments.ffconcat')
+        with open(list_path, 'w') as f:
+            f.write('ffconcat version 1.0\n')
+            for path in segment_paths:
+                f.write("file '" + path.replace("'", "'\\''") + "'\n")
+        subprocess.call(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', list_path, '-c', 'copy', name])
+    return name
+
+def streamVideo(input_dir, image_files, macro_name, video_path, inputFPS, workers=None, max_in_flight=None, size=None,
+                calibration_dir=None, registration=None):
+    '''Streaming alternative to processing to disk and then calling makeVideo.
+
+    Every raw frame is decoded once, then filtered, annotated and timestamped in
+    memory by frame_processing.renderFrame across a pool of worker processes.
+    The results are piped in order as raw RGB into one ffmpeg encode, so nothing
+    is written or recompressed in between. At most max_in_flight frames (default:
+    one per worker) are rendered or waiting at a time, which bounds memory to a
+    few frames even when the encoder is the slower side. size optionally
+    rescales the video frames to (width, height). registration optionally
+    aligns each frame's overlay (see frame_registration).
+    '''
+    image_files = list(image_files)
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers
+    encoder = None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        next_frame = 0
+        try:
+            while next_frame < len(image_files) or len(pending) > 0:
+                while next_frame < len(image_files) and len(pending) < max_in_flight:
+                    x = image_files[next_frame]
+                    pending.append(pool.submit(frame_processing.renderFrame, os.path.join(input_dir, x),
+                                               macro_name, frameTimestamp(x), size, calibration_dir,
+                                               registration.get(x) if registration is not None else None))
+                    next_frame += 1
+                width, height, frame = pending.popleft().result()
+                if encoder is None:
+                    call_cmd = ['ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', str(width) + 'x' + str(height),
+                                '-framerate', str(inputFPS), '-i', '-', '-r', '30', video_path]
+                    encoder = subprocess.Popen(call_cmd, stdin=subprocess.PIPE)
+                encoder.stdin.write(frame)
+        finally:
+            for future in pending:
+                future.cancel()
+            if encoder is not None:
+                encoder.stdin.close()
+                encoder.wait()
+    return video_path
 
 if __name__ == "__main__":
     
@@ -93,6 +277,24 @@ if __name__ == "__main__":
     #macro_name = 'sv1'
     subject_name = 'SV2_Recycling_comparison'
     macro_name = 'sv2'
+    # 'numpy' runs the macro's filters and layout in Python across all cores
+    # (see frame_processing); 'imagej' runs batch_macros.ijm as before
+    processing_engine = 'imagej'
+    # with the numpy engine, stream frames from the raw images straight into
+    # the video encoder instead of writing processed images first
+    streaming = False
+    # only reprocess new or changed frames and re-encode the video segments
+    # they fall in (see frame_manifest); not used when streaming
+    incremental = False
+    # folder of master darks (see calibration) to subtract from the frames
+    # before processing, with the numpy engine; None to skip
+    calibration_dir = None
+    # with the imagej engine, run the macro on this many long-lived headless
+    # ImageJ workers (see imagej_pool); None for one ImageJ per batch
+    imagej_workers = os.cpu_count()
+    # with the numpy engine, move the overlay along with the subjects, as
+    # registered against the first light frame (see frame_registration)
+    register = False
      
     image_dir = '/home/james/Code/P4/images/raw/' + subject_name
      
@@ -101,7 +303,7 @@ if __name__ == "__main__":
     os.chdir(image_dir)
     image_files = []
     for x in os.listdir():
-        if not os.path.isdir(x) and x[:len(subject_name)] == subject_name:
+        if not os.path.isdir(x) and x[:len(subject_name)] == subject_name and not frame_names.isPreviewName(x):
             image_files.append(x)
         
     ''' Create output directory for processed images '''
@@ -111,19 +313,39 @@ if __name__ == "__main__":
     os.chdir(subject_name)
     output_dir = os.getcwd()
         
-    ''' Call ImageJ macro(s) '''
+    ''' Call ImageJ macro(s), or the equivalent NumPy engine '''
     ij_jar_path = '/usr/local/ImageJ/ij.jar'
     macros_path = '/home/james/Code/P4/batch_macros.ijm'
     start = time.time()
-    callBatchMacro(ij_jar_path, image_dir, output_dir, macros_path, macro_name)
+    registration = None
+    if processing_engine == 'numpy' and register:
+        registration = frame_registration.registerSeries(image_dir, sorted(image_files), cache_dir=output_dir)
+    pool = None
+    if processing_engine == 'imagej' and imagej_workers is not None:
+        pool = ImageJPool(ij_jar_path, macros_path, imagej_workers)
+    if processing_engine == 'numpy' and streaming:
+        streamVideo(image_dir, sorted(image_files), macro_name, os.path.join(output_dir, subject_name + '.avi'), 4,
+                    calibration_dir=calibration_dir, registration=registration)
+    elif incremental:
+        manifest = processIncremental(image_dir, output_dir, image_files, processing_engine, macro_name,
+                                      ij_jar_path, macros_path, calibration_dir, pool, registration)
+        updateVideo(output_dir, manifest, 4)
+    else:
+        if processing_engine == 'numpy':
+            frame_processing.processFolder(image_dir, output_dir, macro_name, sorted(image_files),
+                                           calibration_dir=calibration_dir, registration=registration)
+        elif pool is not None:
+            callPooledMacro(pool, image_dir, output_dir, macro_name, sorted(image_files))
+        else:
+            callBatchMacro(ij_jar_path, image_dir, output_dir, macros_path, macro_name)
+
+        ''' Concatenate frames into a video file, with timestamps extracted
+        from the image filenames burned in '''
+        makeVideo(output_dir, 4)
+    if pool is not None:
+        pool.close()
     end = time.time()
     #print(end-start)
-       
-    ''' Extract timestamps from image filenames and add to images '''
-    timestampImageFolder(output_dir)
-      
-    ''' Concatenate frames into a video file '''
-    makeVideo(output_dir, 4)
     
     #import os
     #os.chdir("/home/james/Code/P4/images/raw/SV2_Recycling_comparison")
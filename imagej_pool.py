@@ -0,0 +1,214 @@
+'''
+Pool of long-lived headless ImageJ workers for the batch_macros.ijm macros.
+
+callBatchMacro (see image_processing_wrapper) starts a fresh JVM for every
+batch, and the macro then works through the folder one file at a time. An
+ImageJPool instead starts a few headless ImageJ processes once, each loading
+batch_macros.ijm and running its runWorker() loop, and hands them jobs through
+a spool directory:
+
+    <spool>/worker-0/job-000001.job      written by the pool (atomically)
+    <spool>/worker-0/job-000001.status   appended to by the worker, per file:
+                                         start / ok / error lines, then done
+    <spool>/worker-0/quit                tells the worker to exit
+    <spool>/worker-0.log                 the worker's console output
+
+A job names the macro, the input and output folders and the files to process as
+key=value lines, so no argument string has to be split apart again. The file
+list of a batch is divided across the workers and each file's outcome is
+reported back as it finishes.
+
+An ImageJ macro can't catch its own errors: a file that makes the macro fail
+takes its worker down with it. The pool then marks that file (the last one
+started) as failed, restarts the worker and gives it the rest of its share. A
+file still running after file_timeout seconds is handled the same way.
+
+'''
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+# status lines written by runWorker() in batch_macros.ijm
+STATUS_START = 'start'
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+STATUS_DONE = 'done'
+
+class ImageJPool(object):
+    '''Headless ImageJ worker processes, each running runWorker() from the
+    macro file.
+
+        with ImageJPool(ij_jar_path, macros_path, workers=4) as pool:
+            results = pool.processFiles('sv2', input_dir, output_dir, file_names)
+
+    workers defaults to one per core. memory is the JVM heap per worker (e.g.
+    '2g'); None leaves the JVM default. The spool directory is a new temporary
+    directory unless given, and is removed on close() if it was created here.
+    '''
+
+    def __init__(self, ij_jar_path, macros_path, workers=None, spool_dir=None, java='java', memory=None,
+                 file_timeout=600, poll_interval=0.2):
+        self.ij_jar_path = ij_jar_path
+        self.macros_path = macros_path
+        self.workers = workers or os.cpu_count() or 1
+        self.own_spool = spool_dir is None
+        self.spool_dir = tempfile.mkdtemp(prefix='imagej-pool-') if spool_dir is None else spool_dir
+        self.java = java
+        self.memory = memory
+        self.file_timeout = file_timeout
+        self.poll_interval = poll_interval
+        self.processes = [None] * self.workers
+        self.logs = [None] * self.workers
+        self.job_count = 0
+        for worker in range(self.workers):
+            os.makedirs(self.workerDir(worker), exist_ok=True)
+            self.startWorker(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def workerDir(self, worker):
+        # ImageJ is not smart about recognizing paths
+        return os.path.join(self.spool_dir, 'worker-' + str(worker)) + os.sep
+
+    def startWorker(self, worker):
+        '''(Re)start one worker process.'''
+        quit_path = os.path.join(self.workerDir(worker), 'quit')
+        if os.path.exists(quit_path):
+            os.remove(quit_path)
+        call_cmd = [self.java, '-Djava.awt.headless=true']
+        if self.memory is not None:
+            call_cmd.append('-Xmx' + self.memory)
+        call_cmd += ['-jar', self.ij_jar_path, '-batch', self.macros_path, 'worker#' + self.workerDir(worker)]
+        if self.logs[worker] is None:
+            self.logs[worker] = open(os.path.join(self.spool_dir, 'worker-' + str(worker) + '.log'), 'a')
+        self.processes[worker] = subprocess.Popen(call_cmd, stdout=self.logs[worker], stderr=subprocess.STDOUT)
+
+    def submit(self, worker, macro_name, input_dir, output_dir, file_names):
+        '''Write a job for one worker. Returns the path of its status file.'''
+        self.job_count += 1
+        job_name = 'job-%06d' % self.job_count
+        job_path = os.path.join(self.workerDir(worker), job_name + '.job')
+        lines = ['macro=' + macro_name, 'input_dir=' + input_dir, 'output_dir=' + output_dir]
+        lines += ['file=' + x for x in file_names]
+        with open(job_path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(job_path + '.tmp', job_path) # the worker only picks up complete jobs
+        return os.path.join(self.workerDir(worker), job_name + '.status')
+
+    def processFiles(self, macro_name, input_dir, output_dir, file_names, progress=None):
+        '''Apply a named macro to file_names in input_dir, writing to output_dir,
+        spread across the workers. Blocks until every file has an outcome.
+
+        progress, if given, is called as progress(file_name, outcome) as each
+        file finishes. Returns {file name: outcome}, where outcome is 'ok' or a
+        description of the failure.
+        '''
+        if not input_dir[-1] == os.sep:
+            input_dir = input_dir + os.sep
+        if not output_dir[-1] == os.sep:
+            output_dir = output_dir + os.sep
+        results = {}
+        # interleaved shares, so runs of large (dark) frames are split evenly
+        shares = [list(file_names[worker::self.workers]) for worker in range(self.workers)]
+        jobs = {} # worker -> job state
+        for worker, share in enumerate(shares):
+            if len(share) > 0:
+                jobs[worker] = self._startJob(worker, macro_name, input_dir, output_dir, share)
+        while len(jobs) > 0:
+            for worker in list(jobs):
+                job = jobs[worker]
+                finished = self._readStatus(job, results, progress)
+                if finished:
+                    del jobs[worker]
+                    continue
+                running = job['started'] is not None
+                stuck = running and time.monotonic() - job['started_at'] > self.file_timeout
+                exited = self.processes[worker].poll() is not None
+                if not (stuck or exited):
+                    continue
+                # re-read in case the worker reported more on its way out
+                if self._readStatus(job, results, progress):
+                    del jobs[worker]
+                    continue
+                if stuck:
+                    self.processes[worker].kill()
+                    self.processes[worker].wait()
+                    reason = 'timed out after ' + str(self.file_timeout) + 's'
+                else:
+                    reason = 'ImageJ worker exited (code ' + str(self.processes[worker].returncode) + ')'
+                remaining = [x for x in job['files'] if not x in results]
+                if job['started'] is not None:
+                    self._finish(job['started'], reason, results, progress)
+                    remaining.remove(job['started'])
+                elif not job['progressed']:
+                    # died before touching a file, so it won't get any further
+                    # after a restart either (e.g. no java, or a broken macro)
+                    for x in remaining:
+                        self._finish(x, reason, results, progress)
+                    remaining = []
+                self.startWorker(worker)
+                if len(remaining) > 0:
+                    jobs[worker] = self._startJob(worker, macro_name, input_dir, output_dir, remaining)
+                else:
+                    del jobs[worker]
+            if len(jobs) > 0:
+                time.sleep(self.poll_interval)
+        return results
+
+    def _startJob(self, worker, macro_name, input_dir, output_dir, files):
+        status_path = self.submit(worker, macro_name, input_dir, output_dir, files)
+        return {'status_path': status_path, 'files': files, 'read': 0, 'started': None, 'started_at': None, 'progressed': False}
+
+    def _finish(self, file_name, outcome, results, progress):
+        results[file_name] = outcome
+        if progress is not None:
+            progress(file_name, outcome)
+
+    def _readStatus(self, job, results, progress):
+        '''Take in the complete status lines written since the last read.
+        Returns True once the job is done.'''
+        try:
+            with open(job['status_path']) as f:
+                f.seek(job['read'])
+                text = f.read()
+        except FileNotFoundError:
+            return False
+        complete = text[:text.rfind('\n') + 1] # leave a partly written line for next time
+        job['read'] += len(complete)
+        for line in complete.splitlines():
+            fields = line.split('\t')
+            job['progressed'] = True
+            if fields[0] == STATUS_START:
+                job['started'] = fields[1]
+                job['started_at'] = time.monotonic()
+            elif fields[0] == STATUS_OK:
+                job['started'] = None
+                self._finish(fields[1], 'ok', results, progress)
+            elif fields[0] == STATUS_ERROR:
+                self._finish(fields[1], fields[2] if len(fields) > 2 else 'failed', results, progress)
+            elif fields[0] == STATUS_DONE:
+                return True
+        return False
+
+    def close(self, timeout=30):
+        '''Ask every worker to quit, and kill those that don't in time.'''
+        for worker in range(self.workers):
+            open(os.path.join(self.workerDir(worker), 'quit'), 'w').close()
+        deadline = time.monotonic() + timeout
+        for worker, process in enumerate(self.processes):
+            try:
+                process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            self.logs[worker].close()
+        if self.own_spool:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
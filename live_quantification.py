@@ -0,0 +1,164 @@
+'''
+Live ROI quantification on the Pi while a series is running.
+
+A LiveQuantifier measures the configured ROIs (see roi_layouts) on each new
+dark frame and appends the results to a small CSV next to the images, so a
+dead reporter line shows up an hour into a run instead of after it.
+
+It must never delay a capture, so the work runs in a separate process that:
+
+  - is started with spawn rather than fork, so it inherits none of the capture
+    loop's threads or the locks they hold (the pipeline and preview workers,
+    the metrics writer), which a forked child could block on forever,
+  - logs through the module logger, whose records are passed back over a
+    queue to the logger of the capture loop,
+  - runs at the lowest CPU priority (nice 19), pinned to one core where the
+    platform allows it,
+  - has its address space capped by RLIMIT_AS; a frame that would need more
+    is skipped rather than pushing the Pi into swap,
+  - only starts a frame while the capture loop is idle, i.e. while its
+    CycleScheduler is sleeping towards the next deadline (the idle event),
+  - is fed through a bounded queue with non-blocking puts, so if it falls
+    behind, frames are dropped rather than the capture loop waiting.
+
+ROI sums are taken directly from the decoded frame rather than from a
+summed-area table (see roi_quantification), which for a handful of ROIs needs
+no more memory than the frame itself.
+
+'''
+
+import csv
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import resource
+
+import numpy as np
+from PIL import Image
+
+from frame_names import parseFrameName
+from roi_layouts import getLayout
+
+LIVE_COLUMNS = ['datetime', 'file', 'roi', 'mean', 'integrated_density', 'pixel_count']
+
+# address space cap for the worker process, in bytes; a decoded 24 MP frame
+# is 72 MB, and the interpreter with NumPy and PIL takes about as much again
+LIVE_MEMORY_LIMIT = 512 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+def roiSums(image, rects):
+    '''Exact sums over each (x, y, width, height) rectangle of an RGB frame,
+    of the unweighted channel mean as in roi_quantification, plus the clipped
+    pixel counts; computed on crops, without frame-sized temporaries.'''
+    height, width = image.shape[0], image.shape[1]
+    sums = []
+    counts = []
+    for x, y, w, h in rects:
+        x0, y0 = min(max(x, 0), width), min(max(y, 0), height)
+        x1, y1 = min(max(x + w, 0), width), min(max(y + h, 0), height)
+        sums.append(int(image[y0:y1, x0:x1].sum(dtype=np.int64)) / float(image.shape[2]))
+        counts.append((x1 - x0) * (y1 - y0))
+    return sums, counts
+
+def _limitWorker(memory_limit, cpu):
+    os.nice(19)
+    if memory_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, [cpu])
+        except OSError:
+            pass
+
+def _runWorker(frames, idle, log_records, rois, output_filename, memory_limit, cpu):
+    logger.addHandler(logging.handlers.QueueHandler(log_records))
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    _limitWorker(memory_limit, cpu)
+    new_file = not os.path.exists(output_filename)
+    with open(output_filename, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(LIVE_COLUMNS)
+            f.flush()
+        while True:
+            image_path = frames.get()
+            if image_path is None:
+                return
+            idle.wait() # start only while the capture loop sleeps
+            try:
+                with Image.open(image_path) as source:
+                    image = np.asarray(source.convert('RGB'))
+                sums, counts = roiSums(image, [roi['rect'] for roi in rois])
+                del image
+            except (IOError, OSError, MemoryError) as e:
+                logger.debug('WARNING: live quantification skipped ' + os.path.basename(image_path) + ': ' + str(e))
+                continue
+            info = parseFrameName(image_path) or {}
+            timestamp = info['datetime'].isoformat() if 'datetime' in info else ''
+            for roi, total, count in zip(rois, sums, counts):
+                mean = round(total / count, 4) if count > 0 else ''
+                writer.writerow([timestamp, os.path.basename(image_path), roi['name'], mean, round(total, 1), count])
+            f.flush()
+
+class LiveQuantifier(object):
+    '''Low-priority worker process measuring ROIs on new frames.
+
+    rois is a list of ROI dicts or the name of a layout; only frames with a tag
+    in tags are measured. Frames are handed over with submit(), which is the
+    frame-consumer interface singleCapture and CapturePipeline use. Pass idle
+    to the CycleScheduler of the capture loop so the worker knows when the
+    loop has slack.
+    '''
+
+    def __init__(self, logger, rois, output_filename, tags=('dark',), max_pending=4, memory_limit=LIVE_MEMORY_LIMIT, cpu=None):
+        if isinstance(rois, str):
+            rois = getLayout(rois)['rois']
+        self.logger = logger
+        self.tags = tags
+        self.output_filename = output_filename
+        self.skipped = 0
+        if cpu is None and hasattr(os, 'sched_getaffinity'):
+            cpu = max(os.sched_getaffinity(0)) # keep clear of core 0, where most IRQs land
+        context = multiprocessing.get_context('spawn')
+        self.frames = context.Queue(maxsize=max_pending)
+        self.idle = context.Event()
+        # the worker's log records are handled by logger (a Logger has handle())
+        self.log_records = context.Queue()
+        self.log_listener = logging.handlers.QueueListener(self.log_records, logger)
+        self.log_listener.start()
+        self.worker = context.Process(target=_runWorker, name='live-quantification', daemon=True,
+                                      args=(self.frames, self.idle, self.log_records, rois, output_filename, memory_limit, cpu))
+        self.worker.start()
+        logger.debug('Live ROI quantification of ' + str(len(rois)) + ' ROIs into ' + output_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def submit(self, image_path):
+        '''Queue a downloaded frame, without ever blocking.'''
+        info = parseFrameName(image_path)
+        if info is None or not info['tag'] in self.tags:
+            return
+        try:
+            self.frames.put_nowait(image_path)
+        except queue.Full:
+            self.skipped += 1
+            self.logger.debug('\tLive quantification behind, skipping ' + os.path.basename(image_path))
+
+    def close(self, timeout=60):
+        '''Let the worker finish the queued frames (the capture loop is done, so
+        it is idle from here on) and stop it.'''
+        self.idle.set()
+        self.frames.put(None)
+        self.worker.join(timeout)
+        if self.worker.is_alive():
+            self.worker.terminate()
+        self.log_listener.stop()
@@ -0,0 +1,230 @@
+'''
+Group-wise statistics for luminescence measurements.
+
+The analyses of the paper figures share a few steps: subtract the background
+signal, average the technical repeats (ROIs, frames) of each biological
+replicate, normalize, and compare genotypes or treatments with Welch's t-test.
+The functions here do each step for every group at once with pandas group-by
+operations, so one call covers every genotype, treatment and timepoint of a
+table, whether it holds a few dozen hand-measured rows or millions of per-ROI,
+per-frame rows from the results store:
+
+    data = queryResults('results', columns=['time', 'mean', 'genotype', 'treatment', 'replicate'],
+                        time=(2, 30)).to_pandas()
+    data = subtractBackground(data, 'mean', BACKGROUND_LEVEL)
+    summary = aggregateReplicates(data, 'mean', ['genotype', 'treatment', 'time'])
+    tests = welchTests(data, 'mean', 'genotype', by=['treatment', 'time'], replicate='replicate')
+
+Every function returns a new tidy DataFrame (one observation per row, one
+variable per column) that can be passed straight to seaborn, e.g.
+sns.FacetGrid(summary, col='treatment').map(sns.lineplot, 'time', 'mean').
+
+'''
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+# camera background of the figure 1 images, in mean pixel intensity
+BACKGROUND_LEVEL = 23.013
+
+NORMALIZE_METHODS = ['max', 'first', 'zscore', 'control']
+
+def _groupKeys(data, columns):
+    # group-by keys for the columns; one group for all rows without any
+    if len(columns) == 0:
+        return np.zeros(len(data), dtype=np.int8)
+    return [data[x] for x in columns]
+
+def _columns(by):
+    if by is None:
+        return []
+    if isinstance(by, str):
+        return [by]
+    return list(by)
+
+def selectRows(data, time=None, **equals):
+    '''Rows of data matching every filter, as in results_store.queryResults:
+    time=(low, high) keeps low < time < high (either end may be None), and
+    column=value or column=[values] keeps the matching rows. The filters are
+    combined into one mask, so the table is scanned once.'''
+    mask = np.ones(len(data), dtype=bool)
+    if time is not None:
+        low, high = time
+        if low is not None:
+            mask &= (data['time'] > low).to_numpy()
+        if high is not None:
+            mask &= (data['time'] < high).to_numpy()
+    for name, value in equals.items():
+        if isinstance(value, (list, tuple, set)):
+            mask &= data[name].isin(list(value)).to_numpy()
+        else:
+            mask &= (data[name] == value).to_numpy()
+    return data[mask]
+
+def backgroundLevels(data, value, background_rows, by=None):
+    '''Median of value over the background rows (a boolean mask, e.g.
+    data['roi'] == 'background') in each group of the by columns. Returns a
+    Series indexed by the groups, or a number without by.'''
+    background = data[np.asarray(background_rows, dtype=bool)]
+    columns = _columns(by)
+    if len(columns) == 0:
+        return float(background[value].median())
+    return background.groupby(columns)[value].median()
+
+def subtractBackground(data, value, background=BACKGROUND_LEVEL, by=None, output=None):
+    '''Copy of data with background subtracted from the value column, written to
+    the output column (default: value itself).
+
+    background is a number, the name of a column holding each row's
+    background, or a Series of levels per group of the by columns (see
+    backgroundLevels). Rows of a group without a level get NaN.'''
+    output = value if output is None else output
+    result = data.copy()
+    columns = _columns(by)
+    if isinstance(background, pd.Series):
+        if len(columns) == 0:
+            raise ValueError('background levels per group need the by columns they are grouped by')
+        keys = pd.MultiIndex.from_frame(result[columns]) if len(columns) > 1 else pd.Index(result[columns[0]])
+        levels = background.reindex(keys).to_numpy()
+    elif isinstance(background, str):
+        levels = result[background].to_numpy()
+    else:
+        levels = float(background)
+    result[output] = result[value].to_numpy(dtype=float) - levels
+    return result
+
+def replicateMeans(data, value, by, replicate='replicate'):
+    '''Mean of value over the technical repeats (ROIs, frames) of each
+    biological replicate in each group of the by columns. Returns one row per
+    group and replicate, with columns by, replicate and value.'''
+    columns = _columns(by) + [replicate]
+    return data.groupby(columns, as_index=False, observed=True, sort=True)[value].mean()
+
+def aggregateReplicates(data, value, by, replicate=None):
+    '''Summary of value in each group of the by columns: n, mean, std (ddof=1)
+    and sem. With replicate given, each replicate is first averaged over its
+    technical repeats (see replicateMeans), so n counts replicates rather than
+    rows. Returns one row per group.'''
+    columns = _columns(by)
+    if replicate is not None:
+        data = replicateMeans(data, value, columns, replicate)
+    summary = data.groupby(columns, as_index=False, observed=True, sort=True)[value].agg(['count', 'mean', 'std'])
+    summary = summary.rename(columns={'count': 'n'})
+    summary['sem'] = summary['std'] / np.sqrt(summary['n'])
+    return summary
+
+def normalize(data, value, by=None, method='max', output=None, time='time', control=None):
+    '''Copy of data with value normalized within each group of the by columns,
+    written to the output column (default: value + '_normalized').
+
+    method -- 'max': divide by the group maximum
+              'first': divide by the group's value at its earliest time (the
+                       mean, if several rows share that time)
+              'zscore': subtract the group mean and divide by its std
+              'control': divide by the mean of the control rows of the same
+                         group, control being (column, level), e.g.
+                         ('genotype', 'WT') with by=['treatment', 'time']
+    '''
+    if not method in NORMALIZE_METHODS:
+        raise ValueError('method must be one of ' + ', '.join(NORMALIZE_METHODS) + ', not "' + str(method) + '"')
+    if method == 'control' and control is None:
+        raise ValueError('method "control" needs control=(column, level)')
+    output = value + '_normalized' if output is None else output
+    columns = _columns(by)
+    result = data.copy()
+    values = result[value].astype(float)
+    keys = _groupKeys(result, columns)
+    if method == 'max':
+        result[output] = values / values.groupby(keys, observed=True).transform('max')
+    elif method == 'zscore':
+        groups = values.groupby(keys, observed=True)
+        result[output] = (values - groups.transform('mean')) / groups.transform('std')
+    elif method == 'first':
+        first_time = result[time].groupby(keys, observed=True).transform('min')
+        at_first = values.where(result[time] == first_time)
+        result[output] = values / at_first.groupby(keys, observed=True).transform('mean')
+    else:
+        column, level = control
+        if column in columns:
+            raise ValueError('the control column "' + column + '" can\'t also be a by column')
+        # NaN outside the control rows, so the group means are over the controls only
+        controls = values.where(result[column] == level)
+        result[output] = values / controls.groupby(keys, observed=True).transform('mean')
+    return result
+
+def adjustPValues(p_values):
+    '''Benjamini-Hochberg false discovery rate adjustment of an array of
+    p-values (NaNs are left out and kept as NaN).'''
+    p_values = np.asarray(p_values, dtype=float)
+    adjusted = np.full(p_values.shape, np.nan)
+    valid = np.nonzero(~np.isnan(p_values))[0]
+    if len(valid) == 0:
+        return adjusted
+    order = valid[np.argsort(p_values[valid])]
+    ranked = p_values[order] * len(order) / np.arange(1, len(order) + 1)
+    adjusted[order] = np.minimum(1, np.minimum.accumulate(ranked[::-1])[::-1])
+    return adjusted
+
+def welchTests(data, value, group, by=None, replicate=None):
+    '''Welch's unequal-variance t-test between every pair of levels of the
+    group column, within each group of the by columns (e.g. every pair of
+    genotypes at each treatment and timepoint). With replicate given, the
+    replicate means (see replicateMeans) are the samples.
+
+    Returns one row per comparison, with the by columns, <group>_a and
+    <group>_b, n_a, n_b, mean_a, mean_b, difference (mean_a - mean_b), t, df,
+    p (two-sided, as scipy.stats.ttest_ind(a, b, equal_var=False)) and
+    p_adjusted (Benjamini-Hochberg over the whole table). Comparisons with
+    fewer than two samples on a side get NaN statistics.'''
+    columns = _columns(by)
+    if replicate is not None:
+        data = replicateMeans(data, value, columns + [group], replicate)
+    cells = data.groupby(columns + [group], as_index=False, observed=True, sort=True)[value].agg(['count', 'mean', 'var'])
+    cells = cells.rename(columns={'count': 'n'})
+    # rank the levels so each unordered pair is taken once, whatever their type
+    levels = pd.Index(pd.unique(cells[group]))
+    cells['_rank'] = levels.get_indexer(cells[group])
+    if len(columns) > 0:
+        pairs = cells.merge(cells, on=columns, suffixes=('_a', '_b'))
+    else:
+        pairs = cells.merge(cells, how='cross', suffixes=('_a', '_b'))
+    pairs = pairs[pairs['_rank_a'] < pairs['_rank_b']].drop(columns=['_rank_a', '_rank_b'])
+    n_a = pairs['n_a'].to_numpy(dtype=float)
+    n_b = pairs['n_b'].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        se2_a = pairs['var_a'].to_numpy(dtype=float) / n_a
+        se2_b = pairs['var_b'].to_numpy(dtype=float) / n_b
+        difference = pairs['mean_a'].to_numpy(dtype=float) - pairs['mean_b'].to_numpy(dtype=float)
+        t = difference / np.sqrt(se2_a + se2_b)
+        df = (se2_a + se2_b) ** 2 / (se2_a ** 2 / (n_a - 1) + se2_b ** 2 / (n_b - 1))
+    small = (n_a < 2) | (n_b < 2)
+    t[small] = np.nan
+    df[small] = np.nan
+    p = 2 * stats.t.sf(np.abs(t), df)
+    tests = pairs[columns + [group + '_a', group + '_b', 'n_a', 'n_b', 'mean_a', 'mean_b']].copy()
+    tests['difference'] = difference
+    tests['t'] = t
+    tests['df'] = df
+    tests['p'] = p
+    tests['p_adjusted'] = adjustPValues(p)
+    return tests.reset_index(drop=True)
+
+if __name__ == "__main__":
+
+    # usage: python luminescence_stats.py <results csv or results store dir> <output csv> <value column> <group column> [by column ...]
+    # writes the Welch tests between every pair of group levels within each group of the by columns
+    input_path, output_filename, value, group = sys.argv[1:5]
+    by = sys.argv[5:]
+    if os.path.isdir(input_path):
+        from results_store import queryResults # needs pyarrow
+        data = queryResults(input_path, columns=[value, group] + by).to_pandas()
+    else:
+        data = pd.read_csv(input_path)
+    tests = welchTests(data, value, group, by=by)
+    tests.to_csv(output_filename + '.tmp', index=False)
+    os.replace(output_filename + '.tmp', output_filename)
+    print('Wrote ' + str(len(tests)) + ' comparisons to ' + output_filename)
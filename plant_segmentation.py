@@ -0,0 +1,280 @@
+'''
+Automatic per-plant ROIs from the light frames of a dual series.
+
+Instead of placing ROIs by hand (see roi_layouts), segment the plants in each
+light frame and measure the luminescence of every plant in the dark frame of
+the same cycle (paired by timestamp, see frame_names.pairFrames):
+
+  1. decode the light frame at 1/SEGMENTATION_SCALE resolution (JPEG draft
+     mode), and score each pixel's greenness by the excess green index
+     ExG = 2g - r - b on chromatic coordinates (r = R / (R + G + B), ...),
+  2. threshold ExG with Otsu's method and open the mask by one pixel to drop
+     speckle,
+  3. label the connected components and keep those of at least min_area
+     full-resolution pixels as plants,
+  4. sum the dark frame over scale x scale blocks, which gives the exact
+     full-resolution sum in every mask pixel, and total the blocks per plant.
+
+Plant numbers come from the reference (by default the first) light frame, in
+reading order, and plants in later frames take the number of the reference
+plant they overlap most, so the rows of one plant form a time series as it
+grows. Components that overlap no reference plant are left out. When plants
+grow into each other, the merged component is measured once and reported for
+every reference plant it took over, with the others listed in merged_with.
+
+Cycles are processed in parallel across a process pool. Connected components
+are labelled with scipy.ndimage where it is installed, and with an equivalent
+run-length labelling in NumPy otherwise.
+
+'''
+
+import datetime
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import calibration
+from frame_names import exposureScale, pairFrames, parseFrameName
+from roi_quantification import writeCsv
+
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None # labelComponents falls back to NumPy
+
+SEGMENTATION_SCALE = 8
+MIN_PLANT_AREA = 1000 # in full-resolution pixels
+
+def loadReducedRgb(path, scale=SEGMENTATION_SCALE):
+    '''RGB frame at 1/scale resolution, as uint8.'''
+    with Image.open(path) as source:
+        size = (max(1, source.width // scale), max(1, source.height // scale))
+        source.draft('RGB', size)
+        image = source.convert('RGB')
+    if not image.size == size:
+        image = image.resize(size, Image.BILINEAR)
+    return np.asarray(image)
+
+def excessGreen(image):
+    '''Excess green index 2g - r - b of an RGB array, on chromatic
+    coordinates, in [-1, 2].'''
+    rgb = image.astype(np.float32)
+    total = rgb.sum(axis=2)
+    total[total == 0] = 1
+    r, g, b = rgb[..., 0] / total, rgb[..., 1] / total, rgb[..., 2] / total
+    return 2 * g - r - b
+
+def otsuThreshold(values, bins=256):
+    '''Threshold maximizing the between-class variance of values.'''
+    counts, edges = np.histogram(values, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight_below = np.cumsum(counts)
+    weight_above = weight_below[-1] - weight_below
+    sum_below = np.cumsum(counts * centers)
+    mean_below = sum_below / np.maximum(weight_below, 1)
+    mean_above = (sum_below[-1] - sum_below) / np.maximum(weight_above, 1)
+    between = weight_below * weight_above * (mean_below - mean_above) ** 2
+    return edges[np.argmax(between) + 1]
+
+def _shiftAll(mask, combine):
+    # 3x3 neighbourhood min (erosion) or max (dilation), edges replicated
+    padded = np.pad(mask, 1, mode='edge')
+    out = mask.copy()
+    for dy in range(3):
+        for dx in range(3):
+            combine(out, padded[dy:dy + mask.shape[0], dx:dx + mask.shape[1]], out=out)
+    return out
+
+def openMask(mask):
+    '''Binary opening with a 3x3 square: removes specks and one-pixel bridges.'''
+    return _shiftAll(_shiftAll(mask, np.logical_and), np.logical_or)
+
+def _labelRuns(mask):
+    '''Connected components (4-connectivity, like scipy.ndimage.label) of a 2D
+    boolean array via run-length encoding and union-find over the runs.'''
+    height, width = mask.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    steps = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(steps == 1)
+    _, ends = np.nonzero(steps == -1) # exclusive; same order as the starts
+    parent = np.arange(len(rows))
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    row_first = np.searchsorted(rows, np.arange(height + 1))
+    for row in range(height - 1):
+        above = range(row_first[row], row_first[row + 1])
+        below = range(row_first[row + 1], row_first[row + 2])
+        j0 = below.start
+        for i in above:
+            # runs below are sorted; skip those ending before this one starts
+            while j0 < below.stop and ends[j0] <= starts[i]:
+                j0 += 1
+            j = j0
+            while j < below.stop and starts[j] < ends[i]:
+                a, b = root(i), root(j)
+                if a != b:
+                    parent[max(a, b)] = min(a, b)
+                j += 1
+    roots = np.array([root(i) for i in range(len(rows))], dtype=np.int64)
+    unique_roots, run_labels = np.unique(roots, return_inverse=True)
+    labels = np.zeros((height, width), dtype=np.int32)
+    for row, start, end, label in zip(rows, starts, ends, run_labels + 1):
+        labels[row, start:end] = label
+    return labels, len(unique_roots)
+
+def labelComponents(mask):
+    '''Label the 4-connected components of a boolean mask 1..n. Returns
+    (labels, n).'''
+    if ndimage is not None:
+        return ndimage.label(mask)
+    return _labelRuns(mask)
+
+def segmentLight(path, scale=SEGMENTATION_SCALE, min_area=MIN_PLANT_AREA):
+    '''Plant labels of a light frame at 1/scale resolution: 0 for background,
+    1..n for the plants of at least min_area full-resolution pixels, numbered
+    in reading order of their centroids.'''
+    exg = excessGreen(loadReducedRgb(path, scale))
+    mask = openMask(exg > otsuThreshold(exg))
+    labels, count = labelComponents(mask)
+    areas = np.bincount(labels.ravel(), minlength=count + 1)
+    keep = np.nonzero(areas[1:] * scale * scale >= min_area)[0] + 1
+    ys, xs = np.indices(labels.shape)
+    centroid_y = np.bincount(labels.ravel(), weights=ys.ravel(), minlength=count + 1) / np.maximum(areas, 1)
+    centroid_x = np.bincount(labels.ravel(), weights=xs.ravel(), minlength=count + 1) / np.maximum(areas, 1)
+    # reading order: rows of plants about one plant height apart, then left to right
+    row_height = max(1.0, np.sqrt(np.median(areas[keep]))) if len(keep) > 0 else 1.0
+    order = sorted(keep, key=lambda k: (int(centroid_y[k] // row_height), centroid_x[k]))
+    relabel = np.zeros(count + 1, dtype=np.int32)
+    relabel[order] = np.arange(1, len(order) + 1)
+    return relabel[labels]
+
+def matchPlants(reference_labels, labels):
+    '''Number the plants of labels after the reference plant each overlaps
+    most (0 if none). Returns the renumbered label array and a dict of merges,
+    {reference plant: plant number it shares}, for the reference plants that
+    lost their number to another plant of the same component, i.e. plants
+    that have grown together.'''
+    count = int(labels.max())
+    reference_count = int(reference_labels.max())
+    overlap = np.bincount(labels.ravel() * (reference_count + 1) + reference_labels.ravel(),
+                          minlength=(count + 1) * (reference_count + 1)).reshape(count + 1, reference_count + 1)
+    overlap[:, 0] = 0
+    overlap[0, :] = 0
+    relabel = np.where(overlap.max(axis=1) > 0, overlap.argmax(axis=1), 0)
+    merges = {}
+    numbered = set(relabel.tolist())
+    for plant in range(1, reference_count + 1):
+        if not plant in numbered and overlap[:, plant].max() > 0:
+            merges[plant] = int(relabel[overlap[:, plant].argmax()])
+    return relabel[labels], merges
+
+def blockSums(image, scale, shape):
+    '''Sum of the channel-mean intensity over each scale x scale block of a
+    full-resolution frame, cropped to the blocks of a reduced frame of the
+    given (height, width).'''
+    height, width = shape
+    blocks = image[:height * scale, :width * scale].reshape(height, scale, width, scale, -1)
+    return blocks.sum(axis=(1, 3, 4), dtype=np.float64) / image.shape[2]
+
+def measurePair(input_dir, light_name, dark_name, reference_labels=None, scale=SEGMENTATION_SCALE, min_area=MIN_PLANT_AREA,
+                calibration_dir=None):
+    '''Segment one light frame and measure each plant in its dark frame. Plants
+    are numbered after reference_labels if given. Returns one row per plant,
+    with the columns of roi_quantification (roi being the plant) and
+    merged_with, the other plants measured as the same component ('' if
+    none; see matchPlants).'''
+    labels = segmentLight(os.path.join(input_dir, light_name), scale, min_area)
+    merges = {}
+    if reference_labels is not None:
+        labels, merges = matchPlants(reference_labels, labels)
+    components = {}
+    for plant, shared in merges.items():
+        components.setdefault(shared, [shared]).append(plant)
+    dark_path = os.path.join(input_dir, dark_name)
+    with Image.open(dark_path) as source:
+        image = np.asarray(source.convert('RGB'))
+    master_path = calibration.findMasterDark(calibration_dir, dark_path)
+    if master_path is not None:
+        image = calibration.subtractDark(image, calibration.loadMasterDark(master_path))
+    count = int(labels.max())
+    sums = np.bincount(labels.ravel(), weights=blockSums(image, scale, labels.shape).ravel(), minlength=count + 1)
+    areas = np.bincount(labels.ravel(), minlength=count + 1) * scale * scale
+    info = parseFrameName(dark_name) or {}
+    exposure_scale = exposureScale(info) if info else None
+    rows = []
+    for plant, shared in [(x, x) for x in range(1, count + 1)] + sorted(merges.items()):
+        if areas[shared] == 0:
+            continue
+        others = [x for x in sorted(components.get(shared, [])) if not x == plant]
+        rows.append({'file': dark_name,
+                     'subject': info.get('subject'),
+                     'datetime': info.get('datetime'),
+                     'tag': info.get('tag'),
+                     'exposure': info.get('exposure'),
+                     'aperture': info.get('aperture'),
+                     'iso': info.get('iso'),
+                     'roi': 'plant-%03d' % plant,
+                     'mean': float(sums[shared]) / areas[shared],
+                     'integrated_density': float(sums[shared]),
+                     'pixel_count': int(areas[shared]),
+                     'dark_subtracted': master_path is not None,
+                     'counts_per_s': float(sums[shared]) / areas[shared] / exposure_scale if exposure_scale else None,
+                     'light_file': light_name,
+                     'merged_with': ' '.join('plant-%03d' % x for x in others)})
+    return rows
+
+def quantifyPlants(input_dir, file_names=None, reference=None, workers=None, scale=SEGMENTATION_SCALE, min_area=MIN_PLANT_AREA,
+                   calibration_dir=None, light_aperture=None, light_exposure=None):
+    '''Segment the light frame and measure the plants in the dark frame of every
+    cycle of a dual series. reference names the light frame whose plants define
+    the numbering (default: the first). If the cycles take more than one light
+    frame, light_aperture and/or light_exposure pick the one to segment (see
+    frame_names.pairFrames). Returns rows sorted by capture time then plant,
+    with 'time' in hours since the first cycle, as in
+    roi_quantification.quantifySeries.'''
+    if file_names is None:
+        file_names = sorted(os.listdir(input_dir))
+    pairs = pairFrames(file_names, light_aperture, light_exposure)
+    if len(pairs) == 0:
+        return []
+    if reference is None:
+        reference = pairs[0][0]
+    reference_labels = segmentLight(os.path.join(input_dir, reference), scale, min_area)
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for pair_rows in pool.map(measurePair, [input_dir] * len(pairs), [light for light, dark in pairs], [dark for light, dark in pairs],
+                                  [reference_labels] * len(pairs), [scale] * len(pairs), [min_area] * len(pairs),
+                                  [calibration_dir] * len(pairs)):
+            rows.extend(pair_rows)
+    start = min([row['datetime'] for row in rows if row['datetime'] is not None], default=None)
+    for row in rows:
+        row['time'] = (row['datetime'] - start).total_seconds() / 3600.0 if start is not None and row['datetime'] is not None else None
+    rows.sort(key=lambda row: (row['datetime'] or datetime.datetime.min, row['file'], row['roi']))
+    return rows
+
+if __name__ == "__main__":
+
+    # usage: python plant_segmentation.py <image dir> <output csv or results store dir> [calibration dir] [--store] [--light-aperture=<f>]
+    # with --store, results go into the partitioned results store (see results_store) instead of a CSV;
+    # --light-aperture picks the light frame to segment when a cycle takes several (e.g. --light-aperture=7.1)
+    args = [x for x in sys.argv[1:] if not x.startswith('--')]
+    light_aperture = None
+    for x in sys.argv[1:]:
+        if x.startswith('--light-aperture='):
+            light_aperture = x.split('=', 1)[1]
+    input_dir, output_filename = args[:2]
+    calibration_dir = args[2] if len(args) > 2 else None
+    rows = quantifyPlants(input_dir, calibration_dir=calibration_dir, light_aperture=light_aperture)
+    if '--store' in sys.argv:
+        from results_store import writeResults # needs pyarrow
+        writeResults(rows, output_filename, source=os.path.basename(os.path.normpath(input_dir)) + '-plants')
+    else:
+        writeCsv(rows, output_filename)
+    print('Wrote ' + str(len(rows)) + ' plant measurements to ' + output_filename)
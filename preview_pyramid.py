@@ -0,0 +1,109 @@
+'''
+Preview pyramid for captured frames.
+
+Next to every downloaded frame, write reduced-resolution copies for browsing a
+running experiment without pulling full frames over the link to the Pi:
+
+    subject_..._isoAuto.jpg            full (the frame itself)
+    subject_..._isoAuto.preview.jpg    PYRAMID_LEVELS['preview'] px long side
+    subject_..._isoAuto.thumb.jpg      PYRAMID_LEVELS['thumb'] px long side
+
+The JPEG is decoded once, at reduced resolution: PIL's draft mode has libjpeg
+scale the DCT by 1/2, 1/4 or 1/8 while decoding, so a 6000x4000 frame is never
+expanded in full. Each level is then resized from the one above it.
+
+A PreviewWorker does this on its own low-priority thread, fed by the capture
+loop (or the pipelined downloader) after each verified download. submit()
+never blocks: if the worker falls behind, frames are skipped rather than
+delaying the next exposure.
+
+'''
+
+import os
+import queue
+import threading
+
+from PIL import Image
+
+from frame_names import previewName
+
+# long side in pixels for each reduced level, largest first
+PYRAMID_LEVELS = {'preview': 1600, 'thumb': 320}
+PREVIEW_QUALITY = 80
+
+def makePyramid(image_path, levels=PYRAMID_LEVELS):
+    '''Write the reduced levels of one frame next to it. Returns their paths.'''
+    ordered = sorted(levels.items(), key=lambda item: -item[1])
+    paths = []
+    with Image.open(image_path) as source:
+        width, height = source.size
+        scale = float(ordered[0][1]) / max(width, height)
+        # decode at the smallest DCT scale still at least as large as the top level
+        source.draft('RGB', (int(width * scale) + 1, int(height * scale) + 1))
+        image = source.convert('RGB')
+    for level, long_side in ordered:
+        scale = float(long_side) / max(image.size)
+        if scale < 1:
+            image = image.resize((max(1, int(round(image.width * scale))), max(1, int(round(image.height * scale)))), Image.BILINEAR)
+        path = previewName(image_path, level)
+        temp_path = path + '.tmp'
+        image.save(temp_path, 'JPEG', quality=PREVIEW_QUALITY)
+        os.replace(temp_path, path) # never leave a half-written preview to be pulled
+        paths.append(path)
+    return paths
+
+class PreviewWorker(object):
+    '''Background thread writing preview pyramids for submitted frames.
+
+    At most max_pending frames wait at any time; further submissions are
+    dropped (and logged) until the worker catches up. The thread lowers its
+    own scheduling priority to nice, where the platform allows it.
+    '''
+
+    def __init__(self, logger, levels=PYRAMID_LEVELS, max_pending=8, nice=19):
+        self.logger = logger
+        self.levels = levels
+        self.nice = nice
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.written = 0
+        self.skipped = 0
+        self.failed = 0
+        self.worker = threading.Thread(target=self._run, name='capture-previews', daemon=True)
+        self.worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def submit(self, image_path):
+        '''Queue a downloaded frame for previews, without ever blocking.'''
+        try:
+            self.pending.put_nowait(image_path)
+        except queue.Full:
+            self.skipped += 1
+            self.logger.debug('\tPreview queue full, no previews for ' + os.path.basename(image_path))
+
+    def close(self):
+        '''Finish the queued frames and stop the worker.'''
+        self.pending.put(None)
+        self.worker.join()
+
+    def _run(self):
+        try:
+            # per-thread on Linux: the native thread ID is a valid PRIO_PROCESS target
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            image_path = self.pending.get()
+            if image_path is None:
+                return
+            try:
+                makePyramid(image_path, self.levels)
+                self.written += 1
+            except Exception as e:
+                self.failed += 1
+                self.logger.debug('WARNING: previews for ' + os.path.basename(image_path) + ' failed: ' + str(e))
@@ -0,0 +1,172 @@
+'''
+Partitioned columnar store for quantification results.
+
+The rows of roi_quantification.quantifySeries and
+plant_segmentation.quantifyPlants are written to a Parquet dataset, split by
+subject and capture date into hive-style directories:
+
+    results/subject=SV2_Recycling_comparison/date=2019-10-06/<source>-0.parquet
+
+queryResults() reads it back as an Arrow table (.to_pandas() for a DataFrame),
+with the filters pushed down to the storage layer: subject and date filters
+skip whole directories, and time-window and ROI-property filters (e.g.
+genotype, replicate) are evaluated against the Parquet row-group statistics
+before any data is decoded. Only the requested columns are read.
+
+    data = queryResults('results', columns=['time', 'counts_per_s', 'genotype'],
+                        time=(2, 30), genotype=['pODO1:Luz', 'p35S:Luz']).to_pandas()
+
+Each write is tagged with a source name (e.g. the series folder): writing the
+same source again replaces its earlier files in the partitions it touches, so
+re-quantifying a series doesn't duplicate rows, while other series of the same
+subject and date are kept.
+
+'''
+
+import os
+import re
+import sys
+import urllib.parse
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+PARTITION_SCHEMA = pa.schema([('subject', pa.string()), ('date', pa.string())])
+
+# types of the standard quantification columns (see roi_quantification); extra
+# ROI properties (genotype, replicate, ...) get whatever type Arrow infers
+RESULTS_SCHEMA = pa.schema([('file', pa.string()),
+                            ('datetime', pa.timestamp('s')),
+                            ('time', pa.float64()),
+                            ('tag', pa.string()),
+                            ('exposure', pa.float64()),
+                            ('aperture', pa.string()),
+                            ('iso', pa.string()),
+                            ('roi', pa.string()),
+                            ('mean', pa.float64()),
+                            ('integrated_density', pa.float64()),
+                            ('pixel_count', pa.int64()),
+                            ('dark_subtracted', pa.bool_()),
+                            ('counts_per_s', pa.float64())])
+
+def rowsToTable(rows):
+    '''Arrow table of quantification rows, with the standard columns typed as
+    in RESULTS_SCHEMA and the partition columns subject and date added.'''
+    names = []
+    for row in rows:
+        for key in row:
+            if not key in names:
+                names.append(key)
+    arrays = []
+    fields = []
+    for name in names:
+        values = [row.get(name) for row in rows]
+        if name in RESULTS_SCHEMA.names:
+            field = RESULTS_SCHEMA.field(name)
+            arrays.append(pa.array(values, type=field.type))
+        elif name == 'subject':
+            arrays.append(pa.array(values, type=pa.string()))
+            field = pa.field(name, pa.string())
+        else:
+            array = pa.array(values)
+            arrays.append(array)
+            field = pa.field(name, array.type)
+        fields.append(field)
+    dates = [row['datetime'].date().isoformat() if row.get('datetime') is not None else 'unknown' for row in rows]
+    fields.append(pa.field('date', pa.string()))
+    arrays.append(pa.array(dates, type=pa.string()))
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+def _partitionOf(store_dir, path):
+    # (subject, date) of a data file from its hive directory names
+    values = {}
+    for part in os.path.relpath(os.path.dirname(path), store_dir).split(os.sep):
+        if '=' in part:
+            key, value = part.split('=', 1)
+            values[key] = urllib.parse.unquote(value)
+    return values.get('subject'), values.get('date')
+
+def writeResults(rows, store_dir, source='results'):
+    '''Add quantification rows to the store, replacing any earlier files of
+    the same source in the partitions they fall in. Returns the number of
+    rows written.'''
+    if len(rows) == 0:
+        return 0
+    table = rowsToTable(rows)
+    partitions = set(zip(table.column('subject').to_pylist(), table.column('date').to_pylist()))
+    # exactly this source's files: series1-plants-0.parquet is not a file of series1
+    own_file = re.compile(re.escape(source) + r'-\d+\.parquet')
+    if os.path.isdir(store_dir):
+        for directory, _, file_names in os.walk(store_dir):
+            for x in file_names:
+                path = os.path.join(directory, x)
+                if own_file.fullmatch(x) and _partitionOf(store_dir, path) in partitions:
+                    os.remove(path)
+    ds.write_dataset(table, store_dir, format='parquet', partitioning=ds.partitioning(PARTITION_SCHEMA, flavor='hive'),
+                     basename_template=source + '-{i}.parquet', existing_data_behavior='overwrite_or_ignore')
+    return table.num_rows
+
+def openResults(store_dir):
+    '''The store as a pyarrow Dataset, with one schema covering the columns of
+    every file (series quantified with different ROI properties differ).'''
+    partitioning = ds.partitioning(PARTITION_SCHEMA, flavor='hive')
+    dataset = ds.dataset(store_dir, format='parquet', partitioning=partitioning)
+    schemas = [fragment.physical_schema for fragment in dataset.get_fragments()]
+    if len(schemas) == 0:
+        return dataset
+    schema = pa.unify_schemas(schemas + [PARTITION_SCHEMA])
+    return ds.dataset(store_dir, schema=schema, format='parquet', partitioning=partitioning)
+
+def _matches(name, value):
+    if isinstance(value, (list, tuple, set)):
+        return ds.field(name).isin(list(value))
+    return ds.field(name) == value
+
+def queryResults(store_dir, columns=None, subjects=None, dates=None, time=None, **equals):
+    '''Read rows from the store as an Arrow table.
+
+    columns -- column names to load (default all)
+    subjects -- a subject name or list of them
+    dates -- (first, last) capture dates as 'YYYY-MM-DD' strings, inclusive
+    time -- (low, high): only rows with low < time < high (hours into the
+            series); either end may be None
+    equals -- column=value or column=[values], e.g. genotype='p35S:Luz',
+              replicate=[1, 3]
+
+    Every filter is pushed down into the dataset scan.
+    '''
+    dataset = openResults(store_dir)
+    expression = None
+    filters = []
+    if subjects is not None:
+        filters.append(_matches('subject', subjects))
+    if dates is not None:
+        first, last = dates
+        if first is not None:
+            filters.append(ds.field('date') >= first)
+        if last is not None:
+            filters.append(ds.field('date') <= last)
+    if time is not None:
+        low, high = time
+        if low is not None:
+            filters.append(ds.field('time') > low)
+        if high is not None:
+            filters.append(ds.field('time') < high)
+    for name, value in equals.items():
+        filters.append(_matches(name, value))
+    for condition in filters:
+        expression = condition if expression is None else expression & condition
+    return dataset.to_table(columns=columns, filter=expression)
+
+if __name__ == "__main__":
+
+    # usage: python results_store.py <store dir> [subject]
+    # prints the rows per subject and date, or for one subject
+    store_dir = sys.argv[1]
+    subjects = sys.argv[2] if len(sys.argv) > 2 else None
+    table = queryResults(store_dir, columns=['subject', 'date'], subjects=subjects)
+    counts = {}
+    for key in zip(table.column('subject').to_pylist(), table.column('date').to_pylist()):
+        counts[key] = counts.get(key, 0) + 1
+    for (subject, date), count in sorted(counts.items()):
+        print(subject + '\t' + date + '\t' + str(count) + ' rows')
@@ -0,0 +1,111 @@
+'''
+Controller for imaging rigs with several cameras attached to one Pi.
+
+Each camera is identified by the USB port it is plugged into (found by the
+startup probe, see startup_probe) and bound, in rig.conf, to its own capture
+profile, config file and relay pin. Every camera then runs its capture loop in
+its own thread over its own CameraSession.
+Cameras sharing a relay pin share one RelayControl, which keeps a light frame
+on one camera from overlapping a dark frame on another.
+
+'''
+
+import logging
+import os
+import threading
+
+from camera_session import CameraSession
+from capture_metrics import CaptureMetrics, getMetrics, setMetrics
+from gphoto_capture_control import (CAPTURE_PROFILES, getRelay, initRelayControl, openCameraSettings, parseConfFile, readConfFile,
+                                    runCaptureProfile, runCloseoutOps, verifyBulbMode)
+from startup_probe import probeStartup, verifyCameraModel
+
+def findBoundCamera(binding, cameras):
+    '''Return the probed camera (see startup_probe.findUsbCameras) plugged into
+    the binding's port, given either as a physical port path (e.g. '1-1.2') or
+    as a gphoto2 port ('usb:001,005'). Return None if there is none.'''
+    for camera in cameras:
+        if binding['port'] in (camera['sysfs_port'], camera['port']):
+            return camera
+    return None
+
+def readRigConfFile(filename):
+    '''Parse camera bindings from a rig config file (see rig.conf). Return a
+    list of dicts with keys name, port, capture_profile, conf_filename and
+    relay_pin, in file order.'''
+    bindings = []
+    for name, value in parseConfFile(filename).items():
+        fields = value.split()
+        if not len(fields) == 4:
+            print('Camera "' + name + '" needs <usb port> <capture profile> <config file> <relay pin>!')
+            continue
+        port, capture_profile, conf_filename, relay_pin = fields
+        if not capture_profile in CAPTURE_PROFILES:
+            print('Camera "' + name + '" has unknown capture profile "' + capture_profile + '"!')
+            continue
+        bindings.append({'name': name,
+                         'port': port,
+                         'capture_profile': capture_profile,
+                         'conf_filename': conf_filename,
+                         'relay_pin': int(relay_pin)})
+    return bindings
+
+def runCamera(logger, binding, port, images_dir, wait_time, pipelined, overrun_policy, previews):
+    '''Capture loop for one camera of the rig (thread target). The camera is
+    skipped if it fails the startup checks of the single-camera script.'''
+    try:
+        conf = readConfFile(binding['conf_filename'], binding['capture_profile'])
+        with CameraSession(logger, port) as session:
+            snapshot = session.getConfigSnapshot()
+            if not (verifyCameraModel(logger, snapshot) and verifyBulbMode(logger, snapshot=snapshot)):
+                logger.debug('WARNING: startup checks failed for ' + binding['name'] + ', skipping it')
+                return
+            settings = openCameraSettings(logger, session, snapshot=snapshot)
+            camera_images_dir = os.path.join(images_dir, binding['name'])
+            os.makedirs(camera_images_dir, exist_ok=True)
+            runCaptureProfile(logger, binding['capture_profile'], conf, session, settings, wait_time, pipelined,
+                              overrun_policy, camera_images_dir, getRelay(binding['relay_pin']), previews)
+    except Exception:
+        logger.exception('Camera ' + binding['name'] + ' stopped with an error')
+
+def runRig(logger, rig_conf_filename, images_dir='images', wait_time=None, pipelined=False, overrun_policy='skip', previews=False):
+    '''Start a capture loop for every camera bound in the rig config file and
+    wait for all of them to finish.'''
+    bindings = readRigConfFile(rig_conf_filename)
+    pins = sorted(set(binding['relay_pin'] for binding in bindings))
+    initRelayControl(logger, pins)
+    cameras = probeStartup(logger)
+
+    workers = []
+    for binding in bindings:
+        camera = findBoundCamera(binding, cameras)
+        if camera is None:
+            logger.debug('WARNING: no camera found for ' + binding['name'] + ' on port ' + binding['port'] + ', skipping it')
+            continue
+        logger.debug(binding['name'] + ': ' + camera['name'] + ' on ' + camera['port'] + ', ' + binding['capture_profile'] + ' from ' + binding['conf_filename'] + ', relay pin ' + str(binding['relay_pin']))
+        camera_logger = logger.getChild(binding['name'])
+        worker = threading.Thread(target=runCamera, name=binding['name'],
+                                  args=(camera_logger, binding, camera['port'], images_dir, wait_time, pipelined, overrun_policy, previews))
+        workers.append(worker)
+
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    runCloseoutOps(logger, pins)
+
+if __name__ == "__main__":
+
+    '''Set up logger routing to console and to file'''
+    logger = logging.getLogger('rig')
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(threadName)s: %(message)s')
+    for handler in [logging.StreamHandler(), logging.FileHandler('rig_controller.log', mode='w')]:
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    logger.debug('Rig controller launched!')
+    setMetrics(CaptureMetrics('rig_metrics.jsonl', 'rig_metrics.prom')) # spans are labelled by camera (thread) name
+
+    runRig(logger, 'rig.conf')
+    getMetrics().close()
@@ -0,0 +1,56 @@
+'''
+Declarative ROI and label layouts for the imaging experiments.
+
+Each layout describes, for one experiment, the regions of interest (plates or
+plants) and the text labels burned into the processed frames. They replace the
+hardcoded makeRectangle/drawString calls of the sv1/sv2 macros in
+batch_macros.ijm, and the same ROIs are what gets quantified.
+
+Coordinates are full-resolution pixels (6000x4000 on the 80D), as in ImageJ:
+rois are (x, y, width, height) with the origin at the top left, label positions
+are the left end of the text baseline, like drawString.
+
+'''
+
+LAYOUTS = {
+    'sv1': {
+        'font_size': 150,
+        'rois': [],
+        'labels': [
+            {'text': '+ control\nwatered', 'x': 270, 'y': 810},
+            {'text': '+ control\ndesiccated', 'x': 1800, 'y': 3270},
+            {'text': 'rab18\nwatered', 'x': 4800, 'y': 1000},
+            {'text': 'rab18\ndesiccated', 'x': 4900, 'y': 3000},
+        ],
+    },
+    'sv2': {
+        'line_width': 10,
+        'font_size': 100,
+        'rois': [
+            {'name': '1-Recycling', 'rect': (1050, 144, 930, 882)}, # upper left P6
+            {'name': '1-Unrecycled', 'rect': (2046, 588, 840, 1026)}, # upper left P2
+            {'name': '2-Unrecycled', 'rect': (3048, 144, 1296, 948)}, # upper right P2
+            {'name': '2-Recycling', 'rect': (3012, 1266, 1230, 936)}, # upper right P6
+            {'name': '3-Recycling', 'rect': (2826, 2292, 1092, 690)}, # lower left P6
+            {'name': '3-Unrecycled', 'rect': (2478, 3084, 1374, 816)}, # lower left P2
+            {'name': '4-Unrecycled', 'rect': (4026, 2430, 786, 912)}, # lower right P2
+            {'name': '4-Recycling', 'rect': (4950, 2856, 900, 1056)}, # lower right P6
+        ],
+        'labels': [
+            {'text': '1-Recycling', 'x': 1220, 'y': 300},
+            {'text': '1-Unrecycled', 'x': 2118, 'y': 768},
+            {'text': '2-Unrecycled', 'x': 3400, 'y': 310},
+            {'text': '2-Recycling', 'x': 3640, 'y': 1420},
+            {'text': '3-Recycling', 'x': 2910, 'y': 2950},
+            {'text': '3-Unrecycled', 'x': 3075, 'y': 3860},
+            {'text': '4-Unrecycled', 'x': 4100, 'y': 3300},
+            {'text': '4-Recycling', 'x': 5160, 'y': 3000},
+        ],
+    },
+}
+
+def getLayout(name):
+    '''Return the named layout, or raise KeyError listing the known ones.'''
+    if not name in LAYOUTS:
+        raise KeyError('No ROI layout "' + str(name) + '"; known layouts: ' + ', '.join(sorted(LAYOUTS)))
+    return LAYOUTS[name]
@@ -0,0 +1,178 @@
+'''
+ROI luminescence quantification for image series.
+
+For every frame of a series and every ROI of a layout (see roi_layouts), measure
+what ImageJ's Measure gives for a rectangle on an RGB image: the mean intensity,
+the integrated density (sum of pixel values, ImageJ's RawIntDen) and the pixel
+count. Intensity is the unweighted mean of R, G and B, as ImageJ uses by default
+for RGB measurements.
+
+Each frame is decoded once and reduced to a summed-area table, after which any
+number of rectangle sums cost four lookups each, all ROIs at once. Frames are
+quantified in parallel across a process pool.
+
+Capture metadata comes from the file names written by singleCapture, e.g.
+'subject_2019-10-06_14:30:00_dark_exp480s__f2.8_isoAuto.jpg' (optionally with
+the 'processed_' prefix of the processing step). Quantify the raw frames: the
+processed ones are contrast stretched and have the layout drawn over the ROI
+borders. The result is a tidy table, one row per frame and ROI, written as CSV.
+
+Given the transforms of a frame registration (see frame_registration), the ROIs
+follow the subjects as they move over the series.
+
+'''
+
+import csv
+import datetime
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import calibration
+from frame_names import exposureScale, parseFrameName
+from frame_registration import alignRois, registerSeries
+from roi_layouts import getLayout
+
+CSV_COLUMNS = ['file', 'subject', 'datetime', 'time', 'tag', 'exposure', 'aperture', 'iso',
+               'roi', 'mean', 'integrated_density', 'pixel_count', 'dark_subtracted', 'counts_per_s']
+
+def summedAreaTable(intensity):
+    '''Summed-area table of a 2D array, with a leading row and column of
+    zeros, so the sum over rows y0:y1 and columns x0:x1 is
+    S[y1, x1] - S[y0, x1] - S[y1, x0] + S[y0, x0].'''
+    table = np.zeros((intensity.shape[0] + 1, intensity.shape[1] + 1), dtype=np.float64)
+    np.cumsum(intensity, axis=0, dtype=np.float64, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+def rectangleSums(table, rects):
+    '''Sums and pixel counts for an (n, 4) array of (x, y, width, height)
+    rectangles, clipped to the image, from a summed-area table.'''
+    rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+    height, width = table.shape[0] - 1, table.shape[1] - 1
+    x0 = np.clip(rects[:, 0], 0, width)
+    y0 = np.clip(rects[:, 1], 0, height)
+    x1 = np.clip(rects[:, 0] + rects[:, 2], 0, width)
+    y1 = np.clip(rects[:, 1] + rects[:, 3], 0, height)
+    sums = table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+    return sums, (x1 - x0) * (y1 - y0)
+
+def frameIntensity(image):
+    '''Per-pixel intensity of an RGB (or grayscale) array, as ImageJ measures
+    it: the unweighted mean of the channels.'''
+    if image.ndim == 2:
+        return image.astype(np.float64)
+    return image.sum(axis=2, dtype=np.float64) / image.shape[2]
+
+def quantifyFrame(path, rois, calibration_dir=None, transform=None):
+    '''Measure every ROI (dicts with 'name' and 'rect') in one frame, after
+    subtracting the matching master dark from calibration_dir if there is one
+    (see calibration). Returns one row dict per ROI, with the frame's capture
+    metadata and any extra keys of the ROI dict (e.g. genotype, replicate)
+    included. counts_per_s is the mean normalized to 1 s at ISO 100, so
+    frames with different (e.g. adaptive) exposures compare directly.
+    
+    With a registration transform for the frame, the ROIs are moved along with
+    it and the rows get its dx and dy.'''
+    rois = alignRois(rois, transform)
+    with Image.open(path) as source:
+        image = np.asarray(source.convert('RGB'))
+    master_path = calibration.findMasterDark(calibration_dir, path)
+    if master_path is not None:
+        image = calibration.subtractDark(image, calibration.loadMasterDark(master_path))
+    table = summedAreaTable(frameIntensity(image))
+    sums, counts = rectangleSums(table, [roi['rect'] for roi in rois])
+    info = parseFrameName(path) or {}
+    scale = exposureScale(info) if info else None
+    rows = []
+    for roi, total, count in zip(rois, sums, counts):
+        row = {'file': os.path.basename(path),
+               'subject': info.get('subject'),
+               'datetime': info.get('datetime'),
+               'tag': info.get('tag'),
+               'exposure': info.get('exposure'),
+               'aperture': info.get('aperture'),
+               'iso': info.get('iso'),
+               'roi': roi['name'],
+               'mean': float(total) / count if count > 0 else float('nan'),
+               'integrated_density': float(total),
+               'pixel_count': int(count),
+               'dark_subtracted': master_path is not None,
+               'counts_per_s': float(total) / count / scale if count > 0 and scale else None}
+        for key, value in roi.items():
+            if not key in ('name', 'rect'):
+                row[key] = value
+        if transform is not None:
+            row['dx'] = round(float(transform['dx']), 2)
+            row['dy'] = round(float(transform['dy']), 2)
+        rows.append(row)
+    return rows
+
+def listSeriesFrames(input_dir, tag=None):
+    '''Sorted names of the frames in a folder that follow the capture naming
+    convention, optionally only those tagged 'light' or 'dark'.'''
+    names = []
+    for x in sorted(os.listdir(input_dir)):
+        info = parseFrameName(x)
+        if info is not None and (tag is None or info['tag'] == tag):
+            names.append(x)
+    return names
+
+def quantifySeries(input_dir, rois, file_names=None, tag='dark', workers=None, calibration_dir=None, registration=None):
+    '''Measure every ROI in every frame of a series. rois is a list of ROI
+    dicts or the name of a layout in roi_layouts; file_names defaults to every
+    frame in input_dir with the given tag (None for all). With calibration_dir,
+    frames are dark-subtracted first (see quantifyFrame). registration is a
+    {file name: transform} dict from frame_registration.registerSeries, to
+    measure each frame at its aligned ROIs.
+
+    Returns rows sorted by capture time then ROI, each with 'time' set to the
+    hours elapsed since the first frame.'''
+    if isinstance(rois, str):
+        rois = getLayout(rois)['rois']
+    if file_names is None:
+        file_names = listSeriesFrames(input_dir, tag)
+    paths = [os.path.join(input_dir, x) for x in file_names]
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        transforms = [registration.get(x) if registration is not None else None for x in file_names]
+        for frame_rows in pool.map(quantifyFrame, paths, [rois] * len(paths), [calibration_dir] * len(paths), transforms, chunksize=4):
+            rows.extend(frame_rows)
+    start = min([row['datetime'] for row in rows if row['datetime'] is not None], default=None)
+    for row in rows:
+        if start is not None and row['datetime'] is not None:
+            row['time'] = (row['datetime'] - start).total_seconds() / 3600.0
+        else:
+            row['time'] = None
+    rows.sort(key=lambda row: (row['datetime'] or datetime.datetime.min, row['file'], row['roi']))
+    return rows
+
+def writeCsv(rows, filename):
+    '''Write quantification rows as CSV, the standard columns first and any
+    ROI-specific ones after them.'''
+    extra = sorted(set(key for row in rows for key in row) - set(CSV_COLUMNS))
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_COLUMNS + extra)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    return filename
+
+if __name__ == "__main__":
+
+    # usage: python roi_quantification.py <image dir> <layout> <output csv or results store dir> [calibration dir] [--register] [--store]
+    # with --store, results go into the partitioned results store (see results_store) instead of a CSV
+    args = [x for x in sys.argv[1:] if not x in ('--register', '--store')]
+    input_dir, layout_name, output_filename = args[:3]
+    calibration_dir = args[3] if len(args) > 3 else None
+    registration = registerSeries(input_dir) if '--register' in sys.argv else None
+    rows = quantifySeries(input_dir, layout_name, calibration_dir=calibration_dir, registration=registration)
+    if '--store' in sys.argv:
+        from results_store import writeResults # needs pyarrow
+        writeResults(rows, output_filename, source=os.path.basename(os.path.normpath(input_dir)))
+    else:
+        writeCsv(rows, output_filename)
+    print('Wrote ' + str(len(rows)) + ' measurements to ' + output_filename)
@@ -0,0 +1,145 @@
+'''
+Single-pass startup probe for the capture scripts.
+
+The original startup ran `ps aux | grep gvfs`, then a `ps -p` and a `kill`
+subprocess per PID, then separate gphoto2 calls for --auto-detect and for the
+shutterspeed check. The probe instead:
+
+  1. enumerates USB still-image (PTP) devices from sysfs,
+  2. scans /proc once, and signals only gvfs processes that actually hold one
+     of those device nodes open,
+  3. takes one snapshot of the full camera config over the session, which the
+     bulb-mode check and the settings cache (CameraSettings) reuse.
+
+'''
+
+import os
+import signal
+import time
+
+SYSFS_USB_DEVICES = '/sys/bus/usb/devices'
+USB_CLASS_STILL_IMAGE = 0x06
+
+def _readSysfs(device_dir, name):
+    try:
+        with open(os.path.join(device_dir, name)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+def findUsbCameras(sysfs_dir=SYSFS_USB_DEVICES):
+    '''Return a dict for every attached USB device with a still-image (PTP)
+    interface, with keys sysfs_port (physical port path, e.g. '1-1.2'), port
+    (gphoto2 port, e.g. 'usb:001,005'), device_node, vendor, product and name.'''
+    try:
+        entries = sorted(os.listdir(sysfs_dir))
+    except OSError:
+        return []
+    cameras = []
+    for entry in entries:
+        if ':' in entry:
+            continue # interfaces are listed as <device>:<config>.<interface>
+        device_dir = os.path.join(sysfs_dir, entry)
+        busnum = _readSysfs(device_dir, 'busnum')
+        devnum = _readSysfs(device_dir, 'devnum')
+        if busnum is None or devnum is None:
+            continue
+        still_image = False
+        for interface in os.listdir(device_dir):
+            if interface.startswith(entry + ':'):
+                interface_class = _readSysfs(os.path.join(device_dir, interface), 'bInterfaceClass')
+                if interface_class is not None and int(interface_class, 16) == USB_CLASS_STILL_IMAGE:
+                    still_image = True
+        if not still_image:
+            continue
+        cameras.append({'sysfs_port': entry,
+                        'port': 'usb:%03d,%03d' % (int(busnum), int(devnum)),
+                        'device_node': '/dev/bus/usb/%03d/%03d' % (int(busnum), int(devnum)),
+                        'vendor': _readSysfs(device_dir, 'idVendor'),
+                        'product': _readSysfs(device_dir, 'idProduct'),
+                        'name': (_readSysfs(device_dir, 'manufacturer') or '') + ' ' + (_readSysfs(device_dir, 'product') or '')})
+    return cameras
+
+def findDeviceHolders(device_nodes, pattern='gvfs'):
+    '''Scan /proc once. Return (matching, holders): the PIDs of every process
+    whose command line contains pattern, and the subset of those with one of
+    device_nodes open.'''
+    device_nodes = set(device_nodes)
+    matching = []
+    holders = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/' + entry + '/cmdline', 'rb') as f:
+                cmdline = f.read().replace(b'\0', b' ').decode('utf-8', 'replace')
+        except (IOError, OSError):
+            continue # process exited mid-scan
+        if not pattern in cmdline:
+            continue
+        pid = int(entry)
+        matching.append(pid)
+        fd_dir = '/proc/' + entry + '/fd'
+        try:
+            for fd in os.listdir(fd_dir):
+                if os.readlink(os.path.join(fd_dir, fd)) in device_nodes:
+                    holders.append(pid)
+                    break
+        except (IOError, OSError):
+            pass # exited, or not ours to inspect (and so not ours to kill)
+    return matching, holders
+
+def releaseDevices(logger, device_nodes, timeout=2.0):
+    '''Terminate gvfs processes holding any of device_nodes, escalating to
+    SIGKILL if they don't exit within timeout seconds. Return the PIDs that
+    were signalled.'''
+    matching, holders = findDeviceHolders(device_nodes)
+    logger.debug('    ' + str(len(matching)) + ' gvfs process(es) running, ' + str(len(holders)) + ' holding the camera')
+    for pid in holders:
+        try:
+            os.kill(pid, signal.SIGTERM)
+            logger.debug('    Sent SIGTERM to monitor process (PID = ' + str(pid) + ')')
+        except OSError:
+            pass
+    deadline = time.monotonic() + timeout
+    remaining = list(holders)
+    while len(remaining) > 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+        remaining = [pid for pid in remaining if _alive(pid)]
+    for pid in remaining:
+        try:
+            os.kill(pid, signal.SIGKILL)
+            logger.debug('    Killed monitor process (PID = ' + str(pid) + ')')
+        except OSError:
+            pass
+    return holders
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def probeStartup(logger):
+    '''Find attached cameras and free them from gvfs. Return the camera list
+    from findUsbCameras.'''
+    logger.debug('Probing for cameras...')
+    cameras = findUsbCameras()
+    for camera in cameras:
+        logger.debug('    Found ' + camera['name'] + ' on ' + camera['sysfs_port'] + ' (' + camera['port'] + ')')
+    if len(cameras) == 0:
+        logger.debug('    WARNING: camera NOT found!')
+        return cameras
+    releaseDevices(logger, [camera['device_node'] for camera in cameras])
+    return cameras
+
+def verifyCameraModel(logger, snapshot, model='Canon EOS 80D'):
+    '''Return True iff the config snapshot identifies the expected camera
+    model. The bulb-mode check is gphoto_capture_control.verifyBulbMode.'''
+    found = snapshot.get('cameramodel')
+    if found != model:
+        logger.debug('    WARNING: expected ' + model + ', camera reports ' + str(found))
+        return False
+    logger.debug('    Found: ' + model)
+    return True